@@ -0,0 +1,170 @@
+'''This module implements the batching of the messages a server forwards to the other servers (and to its other
+workers).
+
+Every message for a user connected to another server is appended to the batch of the link to that server. A batch
+is written at once (one frame per message, envelopes as they were received) as soon as it reaches ``max_bytes`` or
+``max_messages``, or once its oldest message has waited ``linger_us`` microseconds. With the default linger of 0,
+every batch is sent at the end of the round of the event loop in which it was started, so a burst or a group fan-out
+costs one write per peer per round.
+
+Attributes
+----------
+MAX_BYTES : int
+    Default size (in bytes) at which a batch is sent right away
+
+MAX_MESSAGES : int
+    Default number of messages at which a batch is sent right away
+
+LINGER_US : int
+    Default time (in microseconds) a batch may wait for more messages
+'''
+
+import collections
+import json
+import time
+
+import framing
+
+MAX_BYTES = 262144
+MAX_MESSAGES = 512
+LINGER_US = 0
+
+
+class Batch(object):
+    '''The messages waiting to be sent on one link.
+
+    Parameters
+    ----------
+    deadline : float
+        Time (``time.monotonic``) at which the batch must be sent.
+
+    '''
+
+    def __init__(self, deadline):
+        self.parts = []
+        self.size = 0
+        self.deadline = deadline
+
+
+class Batcher(object):
+    '''Batches of all the links of a server, with the counters of the sent batches.
+
+    Parameters
+    ----------
+    max_bytes : int (optional)
+        A batch reaching this size is sent right away.
+    max_messages : int (optional)
+        A batch reaching this number of messages is sent right away.
+    linger_us : int (optional)
+        Time (in microseconds) a batch may wait for more messages.
+
+    '''
+
+    def __init__(self, max_bytes=MAX_BYTES, max_messages=MAX_MESSAGES, linger_us=LINGER_US):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.linger = linger_us / 1e6
+        # link -> Batch, the oldest batch first
+        self.batches = collections.OrderedDict()
+        # Number of sent batches by number of messages (rounded up to a power of 2)
+        self.histogram = collections.Counter()
+        # Number of sent batches by the reason they were sent ('bytes', 'messages' or 'linger')
+        self.reasons = collections.Counter()
+        self.messages = 0
+        self.bytes = 0
+
+    def add(self, link, message):
+        ''' Appends a message to the batch of a link.
+
+        Parameters
+        ----------
+        link : obj
+            The link (socket or connection) the message is sent on.
+        message : dict, str, bytes or framing.Envelope
+            The message, dicts are serialised to JSON, envelopes are kept as they were received.
+
+        Returns
+        -------
+        list or None
+            The payloads of the frames of the batch if it is full and has to be sent now, else None.
+
+        '''
+        if isinstance(message, framing.Envelope):
+            message = message.frame
+        elif isinstance(message, dict):
+            message = json.dumps(message)
+        if isinstance(message, str):
+            message = message.encode()
+        batch = self.batches.get(link)
+        if batch is None:
+            batch = self.batches[link] = Batch(time.monotonic() + self.linger)
+        batch.parts.append(message)
+        batch.size += len(message) + framing.HEADER.size
+        if batch.size >= self.max_bytes:
+            return self.take(link, 'bytes')
+        if len(batch.parts) >= self.max_messages:
+            return self.take(link, 'messages')
+        return None
+
+    def take(self, link, reason):
+        ''' Removes the batch of a link and returns the payloads of its frames, counting it in the statistics.
+        '''
+        batch = self.batches.pop(link)
+        count = len(batch.parts)
+        self.histogram[1 << (count - 1).bit_length()] += 1
+        self.reasons[reason] += 1
+        self.messages += count
+        self.bytes += batch.size
+        return batch.parts
+
+    def due(self, now=None):
+        ''' Returns the batches whose linger time is over.
+
+        Parameters
+        ----------
+        now : float (optional)
+            The current ``time.monotonic``.
+
+        Returns
+        -------
+        list of (link, list)
+            The links and the payloads to be sent on them.
+
+        '''
+        if now is None:
+            now = time.monotonic()
+        ready = []
+        for link, batch in list(self.batches.items()):
+            if batch.deadline > now:
+                break
+            ready.append((link, self.take(link, 'linger')))
+        return ready
+
+    def timeout(self, now=None):
+        ''' Returns the time (in seconds) until the next batch is due, None if no batch is waiting.
+        '''
+        if not self.batches:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0, next(iter(self.batches.values())).deadline - now)
+
+    def discard(self, link):
+        ''' Forgets the batch of a link which has been closed, and returns the payloads of its frames (which have not
+        been sent).
+        '''
+        batch = self.batches.pop(link, None)
+        return batch.parts if batch is not None else []
+
+    def stats(self):
+        ''' Returns the counters of the sent batches.
+
+        Returns
+        -------
+        dict
+            ``batches`` (total), ``messages`` and ``bytes`` sent, ``histogram`` (number of batches by number of
+            messages, rounded up to a power of 2) and ``reasons`` (number of batches by the threshold which sent them).
+
+        '''
+        return {'batches': sum(self.reasons.values()), 'messages': self.messages, 'bytes': self.bytes,
+                'histogram': dict(sorted(self.histogram.items())), 'reasons': dict(self.reasons)}
@@ -0,0 +1,69 @@
+'''This module implements the in-memory caches of the servers, which keep the answers of the central database for
+the data read on every message (for example the server a user is connected to).
+
+A cache only holds what the database has answered, the database stays the reference : when a server changes an
+entry it updates the database and then tells the other servers to drop their copy, which is read again from the
+database on the next miss.
+
+Attributes
+----------
+SIZE : int
+    Default max number of entries of a cache
+'''
+
+import collections
+
+SIZE = 65536
+
+
+class LRUCache(object):
+    '''A dict bounded to ``size`` entries, the least recently used entry is dropped first.
+
+    Parameters
+    ----------
+    size : int (optional)
+        The max number of entries.
+
+    '''
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        ''' Returns the entry of a key (and marks it as recently used), ``default`` on a miss.
+        '''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        ''' Stores the entry of a key, dropping the least recently used entry if the cache is full.
+        '''
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        ''' Drops the entry of a key, if it is cached.
+        '''
+        self.entries.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        ''' Returns the number of entries, hits and misses of the cache.
+        '''
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
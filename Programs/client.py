@@ -22,14 +22,19 @@ MAX_SIZE : int
 
 """
 import sys
+import os
 import socket
 import selectors
 import types
 import json
-from enc import Encrypt
+from enc import Encrypt, SessionKeys, CryptoPool, CRYPTO_WORKERS
+from keypool import KeyPool, KEY_STASH
+import framing
 import threading
 import datetime
 import base64
+import hashlib
+import time
 
 
 IP = '127.0.0.1'
@@ -52,7 +57,13 @@ class Client(object):
         self.PORT = args[1]
         self.IP_S = args[2]
         self.PORT_S = args[3]
+        # The address of the load balancer, asked again for a ticket when the ticket expires
+        self.IP_B = args[2]
+        self.PORT_B = args[3]
+        # Started once the user picks Sign Up (see `register`), a user who logs in does not need a key pair
+        self.key_pool = None
         self.server_sign = 0
+        self.ticket_expires = 0
         self.call_balancer()
         self.user = 0
         # Maintains the list of group_ids the user is a part of
@@ -61,13 +72,22 @@ class Client(object):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect_ex((args[2], self.PORT_S))
         self.socket.setblocking(False)
+        # Reassembly buffer of the frames received from the server
+        self.decoder = framing.FrameDecoder()
         self.selector = selectors.DefaultSelector()
         self.read = selectors.EVENT_READ
         self.write = selectors.EVENT_WRITE
         self.selector.register(self.socket, self.read | self.write, data=None)
         self.exit_flag = 0
+        # Held while writing a frame : the receiving thread writes the acknowledgements of the inbox pages
+        self.send_lock = threading.Lock()
         self.keys = None
+        # Public keys of the other users and participants of the groups, saved in `client_<id>_keys.json`
+        self.key_cache = {'users': {}, 'groups': {}}
         self.encrypt = 0
+        # Session keys of the direct messages, set up once the user is known
+        self.sessions = None
+        self.crypto = None
         self.handle()
 
     def call_balancer(self):
@@ -76,9 +96,9 @@ class Client(object):
         # create a TCP/ IP socket at the client side using TCP/ IP protocol
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # connect it to server and port number to local computer
-        s.connect((self.IP_S, self.PORT_S))
-        # receive message form the server - 1024 B at a times
-        msg = json.loads(s.recv(MAX_SIZE))
+        s.connect((self.IP_B, self.PORT_B))
+        # receive the (framed) message from the load balancer
+        msg = framing.recv_message(s, framing.FrameDecoder())
         # msg = s.recv(MAX_SIZE).decode()
         print(msg)
         # while msg:
@@ -87,10 +107,28 @@ class Client(object):
         self.PORT_S = (msg['server_port'])
         self.IP_S = msg['server_ip']
         self.server_sign = msg['sign']
+        self.ticket_expires = msg['expires']
         print(self.PORT_S)
         # disconnect the client
         s.close()
 
+    def reconnect(self, sock):
+        """Closes the connection to the server and opens a new one, with a new ticket from the load balancer : the ticket may have expired (the server closes the connection of a client whose ticket is not valid), and the load balancer may send the client to another server
+
+        Parameters
+        ----------
+        sock : obj
+            The socket connected to the server
+        """
+        self.selector.unregister(sock)
+        sock.close()
+        self.call_balancer()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect_ex((self.IP_S, self.PORT_S))
+        self.socket.setblocking(False)
+        self.decoder = framing.FrameDecoder()
+        self.selector.register(self.socket, self.read | self.write, data=None)
+
     def handle(self):
         """This is the function that handles the different possibilities of events. It handles read and write events, as well as the initial connecting of the client to the server.
         
@@ -106,9 +144,14 @@ class Client(object):
         print('Successful Login')
         thread = threading.Thread(target=self.message_read, daemon=True)
         thread.start()
-        while True:
-            if self.message_send() == 0:
-                break
+        try:
+            while True:
+                if self.message_send() == 0:
+                    break
+        finally:
+            # The worker processes of the crypto pool do not outlive the client
+            if self.crypto is not None:
+                self.crypto.close()
         # thread.join()
         print('Bye!! ...')
         
@@ -189,16 +232,22 @@ class Client(object):
                 part_id = int(
                     input("You've entered an invalid user ID, please re_enter: "))
 
-        # Handle this case in server.py
-        # Create the database functions to get the participnts and the keys
+        # The keys are taken from the key cache, the server is only asked when some are missing
         if a == 1 or a == 2:
+            self.keys = self.cached_keys(isgroup, user)
+        if (a == 1 or a == 2) and self.keys is None:
             events = self.selector.select(timeout=None)
             for key, mask in events:
                 if mask & self.write:
                     sock = key.fileobj
                     msg = {'type': 'keys', 'dest': 'server', 'from': self.user,
                            'message': user, 'isgroup': isgroup, 'response': 0}
-                    sock.send(json.dumps(msg).encode())
+                    group = self.key_cache['groups'].get(str(user))
+                    if isgroup == 1 and group is not None:
+                        # Only the keys which are not cached are sent back
+                        msg['version'] = group['version']
+                        msg['known'] = [m for m in group['members'] if str(m) in self.key_cache['users']]
+                    self.send(sock, msg)
             while True:
                 if isinstance(self.keys, dict):
                     
@@ -228,9 +277,9 @@ class Client(object):
                                 except:
                                     continue
                             try:
+                                # The image is sent as bytes (encrypted with AES-GCM), it is not base64 encoded
                                 with open(filename, "rb") as img_file:
-                                    img_bin = base64.b64encode(img_file.read())
-                                img_string = img_bin.decode('utf-8')
+                                    img_bytes = img_file.read()
                             except:
                                 print("No Such file present")
 
@@ -239,67 +288,73 @@ class Client(object):
                             # Direct message
                             if (a == 1):
                                 print("Sending Direct images")
-                                key_user, enc_message, public = self.encrypt.encrypt(
-                                    img_string, self.keys[str(user)])
+                                key_id, enc_image, key_user = self.sessions.encrypt_message(
+                                    img_bytes, user, self.keys[str(user)], binary=True)
                                 msg = {'type': 'img', 'time': time, 'dest': user, 'from': self.user,
-                                       'message': enc_message.decode(), 'isgroup': isgroup, 'response': 0, 'key': key_user.decode()}
+                                       'isgroup': isgroup, 'response': 0, 'key_id': key_id}
+                                if key_user is not None:
+                                    msg['key'] = key_user.decode()
                                 dt = datetime.datetime.now()
-                                encoded = json.dumps(msg).encode()
+                                # Sent as a binary envelope, the servers route it without decoding it
+                                encoded = framing.envelope(msg, enc_image)
                                 with open('client{0}_log_dm.txt'.format(self.user), 'a') as f:
-                                    f.write('{0},{1},{2}\n'.format(img_string, str(dt.time()), len(encoded)))
+                                    f.write('{0},{1},{2}\n'.format(hashlib.sha1(img_bytes).hexdigest(), str(dt.time()), len(encoded)))
                                 # self.logfile_dm.flush()
-                                sock.send(encoded)
+                                self.send(sock, encoded)
                             # Group message
                             elif (a == 2):
                                 print("Sending Group Images")
-                                lst_messages = []
-                                for user_id in self.keys.keys():
-                                    # print("Sending message ", message, "to user {0}".format(int(user_id)))
-                                    key_group_user, enc_message, public = self.encrypt.encrypt(
-                                        img_string, self.keys[str(user_id)])
-                                    msg = {'type': 'img', 'time': time, 'dest': int(user_id), 'group': user, 'from': self.user,  # user refers to GROUP_ID over here
-                                           'message': enc_message.decode(), 'isgroup': 1, 'response': 0, 'key': key_group_user.decode()}
-                                    lst_messages.append(msg)
+                                # The image is encrypted once with the sending key of the user in the group
+                                key_id, enc_image, group_keys = self.sessions.encrypt_group(
+                                    img_bytes, user, self.keys, self.group_version(user), binary=True)
+                                msg = {'type': 'img', 'time': time, 'dest': [int(user_id) for user_id in self.keys], 'group': user, 'from': self.user,  # user refers to GROUP_ID over here
+                                       'isgroup': 1, 'response': 0, 'key_id': key_id}
+                                if group_keys is not None:
+                                    msg['keys'] = {user_id: key.decode() for user_id, key in group_keys.items()}
                                 dt = datetime.datetime.now()
-                                lst_encoded = json.dumps(lst_messages).encode()
+                                # A single binary envelope, the servers pass it on to every participant
+                                encoded = framing.envelope(msg, enc_image)
                                 with open('client{0}_log_g.txt'.format(self.user), 'a') as f:
-                                    f.write('{0},{1},{2}\n'.format(lst_messages, str(dt.time()), len(lst_encoded)))
+                                    f.write('{0},{1},{2}\n'.format(msg, str(dt.time()), len(encoded)))
 
-                                print(lst_messages)
-                                sock.send(lst_encoded)
+                                print(msg)
+                                self.send(sock, encoded)
                             
                         else:
                             sock = key.fileobj
                             time = str(datetime.datetime.now())
                             # Direct message
                             if (a == 1):
-                                key_user, enc_message, public = self.encrypt.encrypt(
-                                    message, self.keys[str(user)])
+                                # Only the first message of a session carries the (RSA encrypted) key
+                                key_id, enc_message, key_user = self.sessions.encrypt_message(
+                                    message, user, self.keys[str(user)])
                                 msg = {'type': 'msg', 'time': time, 'dest': user, 'from': self.user,
-                                       'message': enc_message.decode(), 'isgroup': isgroup, 'response': 0, 'key': key_user.decode()}
+                                       'message': enc_message.decode(), 'isgroup': isgroup, 'response': 0, 'key_id': key_id}
+                                if key_user is not None:
+                                    msg['key'] = key_user.decode()
                                 print("Sending this message : ",msg)
 
                                 dt = datetime.datetime.now()
-                                encoded = json.dumps(msg).encode()
+                                encoded = framing.envelope(msg)
                                 with open('client{0}_log_dm.txt'.format(self.user), 'a') as f:
 
                                     f.write('{0},{1},{2}\n'.format(message, str(dt.time()), len(encoded)))
-                                sock.send(encoded)
+                                self.send(sock, encoded)
                             # Group message
                             elif (a == 2):
-                                lst_messages = []
-                                for user_id in self.keys.keys():
-                                    key_group_user, enc_message, public = self.encrypt.encrypt(
-                                        message, self.keys[str(user_id)])
-                                    msg = {'type': 'msg', 'time': time, 'dest': int(user_id), 'group': user, 'from': self.user,  # user refers to GROUP_ID over here
-                                           'message': enc_message.decode(), 'isgroup': 1, 'response': 0, 'key': key_group_user.decode()}
-                                    lst_messages.append(msg)
+                                # Only the first message with a new sending key carries it (encrypted for each participant)
+                                key_id, enc_message, group_keys = self.sessions.encrypt_group(
+                                    message, user, self.keys, self.group_version(user))
+                                msg = {'type': 'msg', 'time': time, 'dest': [int(user_id) for user_id in self.keys], 'group': user, 'from': self.user,  # user refers to GROUP_ID over here
+                                       'message': enc_message.decode(), 'isgroup': 1, 'response': 0, 'key_id': key_id}
+                                if group_keys is not None:
+                                    msg['keys'] = {user_id: key.decode() for user_id, key in group_keys.items()}
                                 dt = datetime.datetime.now()
-                                lst_encoded = json.dumps(lst_messages).encode()
+                                encoded = framing.envelope(msg)
                                 with open('client{0}_log_g.txt'.format(self.user), 'a') as f:
-                                    f.write('from {0} to group {1},{2},{3},{4}'.format(self.user,user , str(dt.time()), len(lst_encoded), lst_messages)+"\n")
-                                print("Sending these split messages : ",lst_messages)
-                                sock.send(lst_encoded)
+                                    f.write('from {0} to group {1},{2},{3},{4}'.format(self.user,user , str(dt.time()), len(encoded), msg)+"\n")
+                                print("Sending this message : ",msg)
+                                self.send(sock, encoded)
         
 
                     elif mask & self.write and a == 3:
@@ -310,7 +365,7 @@ class Client(object):
                         msg = {'type': 'msg', 'time': time, 'dest': participants, 'from': self.user, # sends the list of participants to the server for the database
                                'message': 'create_group', 'isgroup': 1, 'response': 0}
                         print("Creating groups ---- json created")
-                        sock.send(json.dumps(msg).encode())
+                        self.send(sock, msg)
                         print("Creating groups ---- message sent")
                         return 1
 
@@ -321,7 +376,7 @@ class Client(object):
                         msg = {'type': 'msg', 'time': time, 'group': group_id, 'dest': part_id, 'from': self.user,  # sends the id of the participant to be added
                                'message': 'add_to_group', 'isgroup': 1, 'response': 0}
                         print("Adding to groups ---- json created")
-                        sock.send(json.dumps(msg).encode())
+                        self.send(sock, msg)
                         print("Adding to groups ---- message sent")
                         return 1
 
@@ -332,7 +387,7 @@ class Client(object):
                         msg = {'type': 'msg', 'time': time, 'group': group_id, 'dest': part_id, 'from': self.user,  # sends the id of the participant to be added
                                'message': 'remove_from_group', 'isgroup': 1, 'response': 0}
                         print("Removing from groups ---- json created")
-                        sock.send(json.dumps(msg).encode())
+                        self.send(sock, msg)
                         print("Removing from groups ---- message sent")
                         return 1
 
@@ -341,13 +396,26 @@ class Client(object):
                         time = str(datetime.datetime.now())
                         msg = {'type': 'msg', 'time': time, 'dest': 'server', 'from': self.user,
                                'message': 'close', 'isgroup': isgroup, 'response': 0}
-                        sock.send(json.dumps(msg).encode())
+                        self.send(sock, msg)
                         sock.close()
                         return 0
         except Exception as e:
             print("Exception as ",e)
             return 1
 
+    def send(self, sock, message):
+        """Writes a frame to the server, the frames written by the sending and the receiving threads are not mixed
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the server
+        message : dict, list, str, bytes
+            The message to be sent
+        """
+        with self.send_lock:
+            framing.send_message(sock, message)
+
     def Receive(self, key):
         """This function handles all the data that is received by the client
 
@@ -357,10 +425,32 @@ class Client(object):
             An object which holds the socket through which the communication happens, along with other information    
         """
         sock = key.fileobj
-        receive_data = sock.recv(MAX_SIZE)
-        # print(receive_data)
-        # print()
-        receive_data = json.loads(receive_data)
+        for frame in framing.read_frames(sock, self.decoder, MAX_SIZE):
+            self.process_frame(frame)
+
+    def process_frame(self, frame):
+        """Handles one frame received from the server : a JSON list of messages, or a binary envelope (an image) on its own
+
+        Parameters
+        ----------
+        frame : bytes
+            The payload of the frame
+        """
+        receive_data = framing.decode(frame)
+        if isinstance(receive_data, framing.Envelope):
+            msg, attachment = receive_data.attachment()
+            msg['attachment'] = attachment
+            receive_data = [msg]
+        self.process(receive_data)
+
+    def process(self, receive_data):
+        """Handles one frame received from the server
+
+        Parameters
+        ----------
+        receive_data : list
+            The decoded frame, a list of messages (dicts or JSON strings)
+        """
         # The following line ignores (does not print to the file) the ping message by the server to check whether the current client is online
         # if(recv_data['message']=='ping'):
         #     return
@@ -372,11 +462,15 @@ class Client(object):
                     receive_data[i] = json.loads(receive_data[i])
             except Exception as e:
                 print('Exception in Receive [1]', e)
-                
-            if (receive_data[i]['type'] == 'keys'):
-                self.keys = receive_data[i]['message']  
+        # The messages received together are decrypted as a batch, on all the CPUs with a crypto pool
+        self.decrypt_batch(receive_data)
+        for i in range(len(receive_data)):
+            if (receive_data[i]['type'] == 'inbox'):
+                self.inbox(receive_data[i])
+            elif (receive_data[i]['type'] == 'keys'):
+                self.update_keys(receive_data[i])
                 print()
-                print("Public Keys : ", self.keys)
+                print("Public Keys : ", receive_data[i]['message'])
                 print()
             elif (receive_data[i]['from'] == 'server'):
                 with open('group' + str(receive_data[i]['group']) + '_client' + str(self.user), 'a') as f:
@@ -386,8 +480,11 @@ class Client(object):
                     f.write('\n' + receive_data[i]['message'] + '\n')
             elif (receive_data[i]['isgroup'] == 0):
                 if (receive_data[i]['type'] != 'img'):
-                    message = self.encrypt.decrypt(
-                        receive_data[i]['message'], receive_data[i]['key'])
+                    message = self.decrypt_direct(receive_data[i])
+                    if message is None:
+                        # The session key is unknown, it is sent again with one of the next messages of the sender
+                        print("Could not decrypt the message from", receive_data[i]['from'])
+                        continue
                     dt = datetime.datetime.now()
                     with open('client{0}_log_dm.txt'.format(self.user), 'a') as f:
                         f.write('{0},{1},{2}\n'.format(message, str(dt.time()), len(message)))
@@ -398,24 +495,33 @@ class Client(object):
                         f.write('\n' + message + '\n')
                         f.flush()
                 elif (receive_data[i]['type'] == 'img'):
-                    img_recovered = self.encrypt.decrypt(
-                        receive_data[i]['message'], receive_data[i]['key'])  
-
+                    if 'attachment' in receive_data[i]:
+                        img_recovered = self.decrypt_attachment(receive_data[i], receive_data[i].get('key'))
+                    else:
+                        # Sent base64 encoded in the message by an older client
+                        img_recovered = self.decrypt_direct(receive_data[i])
+                        if isinstance(img_recovered, str):
+                            img_recovered = img_recovered.encode()
+                        if img_recovered is not None:
+                            img_recovered = base64.b64decode(img_recovered)
+
+                    if img_recovered is None:
+                        print("Could not decrypt the image from", receive_data[i]['from'])
+                        continue
                     dt = datetime.datetime.now()
                     with open('client{0}_log_dm.txt'.format(self.user), 'a') as f:
-                        f.write('{0},{1},{2}\n'.format(img_recovered, str(dt.time()), len(img_recovered)))
+                        f.write('{0},{1},{2}\n'.format(hashlib.sha1(img_recovered).hexdigest(), str(dt.time()), len(img_recovered)))
 
-                    if not isinstance(img_recovered,bytes):
-                        img_recovered = img_recovered.encode()
-                    img_recovered = base64.b64decode(img_recovered)
                     f = open('img_from' + str(receive_data[i]['from']) + 'to' + str(self.user) + '.png', "wb")
                     f.write(img_recovered)
                     f.flush()
                     f.close() 
             elif (receive_data[i]['isgroup'] == 1):
                 if (receive_data[i]['type'] != 'img'):
-                    message = self.encrypt.decrypt(
-                        receive_data[i]['message'], receive_data[i]['key'])
+                    message = self.decrypt_group(receive_data[i])
+                    if message is None:
+                        print("Could not decrypt the message from", receive_data[i]['from'])
+                        continue
 
                     dt = datetime.datetime.now()
                     with open('client{0}_log_g.txt'.format(self.user), 'a') as f:
@@ -428,19 +534,225 @@ class Client(object):
                         f.flush()
                 elif (receive_data[i]['type'] == 'img'):
                     print("Received group images")
-                    img_recovered = self.encrypt.decrypt(
-                        receive_data[i]['message'], receive_data[i]['key'])
-
+                    if 'attachment' in receive_data[i]:
+                        img_recovered = self.decrypt_attachment(receive_data[i], receive_data[i].get('keys', {}).get(str(self.user)))
+                    else:
+                        img_recovered = self.decrypt_group(receive_data[i])
+                        if isinstance(img_recovered, str):
+                            img_recovered = img_recovered.encode()
+                        if img_recovered is not None:
+                            img_recovered = base64.b64decode(img_recovered)
+
+                    if img_recovered is None:
+                        print("Could not decrypt the image from", receive_data[i]['from'])
+                        continue
                     dt = datetime.datetime.now()
                     with open('client{0}_log_g.txt'.format(self.user), 'a') as f:
-                        f.write('from {0} to group {1},{2},{3},{4}'.format(receive_data[i]['from'], receive_data[i]['group'], str(dt.time()), len(img_recovered),  img_recovered)+"\n")
-                    if not isinstance(img_recovered,bytes):
-                        img_recovered = img_recovered.encode()
-                    img_recovered = base64.b64decode(img_recovered)
+                        f.write('from {0} to group {1},{2},{3},{4}'.format(receive_data[i]['from'], receive_data[i]['group'], str(dt.time()), len(img_recovered),  hashlib.sha1(img_recovered).hexdigest())+"\n")
                     f = open('group' + str(receive_data[i]['group']) + 'img_from' + str(receive_data[i]['from']) + 'to' + str(self.user) + '.png', "wb")
                     f.write(img_recovered)
                     f.close()
 
+    def inbox(self, msg):
+        """Handles an inbox message of the server, sent after the unread messages of a page (or with the number of unread messages at login) : the messages of the page, which have been handled, are acknowledged (the server then deletes them) and the next page is asked for
+
+        Parameters
+        ----------
+        msg : dict
+            The inbox message, `ack` lists the IDs of the messages of the page, `after` is the ID the next page starts after and `more` tells whether there may be a next page
+        """
+        if msg.get('error'):
+            print("The server could not read the inbox, trying again :", msg['error'])
+        if msg.get('unread'):
+            print("Unread messages : {0} (direct by sender : {1}, by group : {2})".format(msg['unread'], msg['direct'], msg['groups']))
+        if not msg['ack'] and not msg['more']:
+            return
+        reply = {'type': 'inbox', 'dest': 'server', 'from': self.user, 'ack': msg['ack'],
+                 'after': msg['after'] if msg['more'] else None, 'isgroup': 0, 'response': 0}
+        self.send(self.socket, reply)
+
+    def decrypt_batch(self, receive_data):
+        """Decrypts the messages and images of a batch encrypted with session keys, the result is stored in 'decrypted' and returned by the `decrypt_*` functions
+
+        Parameters
+        ----------
+        receive_data : list
+            The decoded messages (dicts) of a frame
+        """
+        batch = []
+        for msg in receive_data:
+            if not isinstance(msg, dict) or msg.get('type') not in ('msg', 'img') or 'key_id' not in msg or msg.get('from') == 'server':
+                continue
+            if msg.get('isgroup') == 1:
+                encrypted_key = msg.get('keys', {}).get(str(self.user))
+            else:
+                encrypted_key = msg.get('key')
+            binary = 'attachment' in msg
+            batch.append((msg, (msg['from'], msg['attachment'] if binary else msg['message'], msg['key_id'], encrypted_key, binary)))
+        if len(batch) < 2:
+            return
+        for (msg, _), decrypted in zip(batch, self.sessions.decrypt_messages([item for _, item in batch])):
+            msg['decrypted'] = decrypted
+
+    def decrypt_direct(self, msg):
+        """Decrypts a direct message, with the session key of the sender if the message carries a key ID
+
+        Parameters
+        ----------
+        msg : dict
+            The message
+
+        Returns
+        -------
+        str or None
+            The decrypted message, None if it can not be decrypted
+        """
+        if 'decrypted' in msg:
+            return msg['decrypted']
+        if 'key_id' in msg:
+            return self.sessions.decrypt_message(msg['from'], msg['message'], msg['key_id'], msg.get('key'))
+        return self.encrypt.decrypt(msg['message'], msg['key'])
+
+    def decrypt_group(self, msg):
+        """Decrypts a group message, with the sending key of the sender if the message carries a key ID
+
+        Parameters
+        ----------
+        msg : dict
+            The message, a message sent to all the participants at once carries the (encrypted) key of each of them
+
+        Returns
+        -------
+        str or None
+            The decrypted message, None if it can not be decrypted
+        """
+        if 'decrypted' in msg:
+            return msg['decrypted']
+        keys = msg.get('keys', {})
+        if 'key_id' in msg:
+            return self.sessions.decrypt_message(msg['from'], msg['message'], msg['key_id'], keys.get(str(self.user)))
+        return self.encrypt.decrypt(msg['message'], keys.get(str(self.user), msg.get('key')))
+
+    def decrypt_attachment(self, msg, encrypted_key=None):
+        """Decrypts the attachment (an image) of a message received in a binary envelope
+
+        Parameters
+        ----------
+        msg : dict
+            The message, with the encrypted bytes in 'attachment'
+        encrypted_key : str (optional)
+            The encrypted session key of the sender, sent with the first message of a session
+
+        Returns
+        -------
+        bytes or None
+            The decrypted attachment, None if it can not be decrypted (or has been modified)
+        """
+        if 'decrypted' in msg:
+            return msg['decrypted']
+        return self.sessions.decrypt_message(msg['from'], msg['attachment'], msg['key_id'], encrypted_key, binary=True)
+
+    def start_sessions(self):
+        """Sets up the session keys of the user once logged in, with a crypto pool (worker processes, started before the receiving thread) if `CRYPTO_WORKERS` is set above 1
+        """
+        self.crypto = CryptoPool(self.encrypt) if CRYPTO_WORKERS > 1 else None
+        self.sessions = SessionKeys(self.encrypt, 'client_' + str(self.user), pool=self.crypto)
+
+    def group_version(self, group_id):
+        """Returns the version of the participant list of a group in the key cache (the sending key of the user in the group is replaced when it changes)
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+
+        Returns
+        -------
+        int or None
+            The version, None if the group is not cached
+        """
+        return self.key_cache['groups'].get(str(group_id), {}).get('version')
+
+    def load_key_cache(self):
+        """Loads the key cache saved by a previous session of the user, if any
+        """
+        try:
+            with open('client_{0}_keys.json'.format(self.user)) as f:
+                self.key_cache = json.load(f)
+        except (OSError, ValueError):
+            self.key_cache = {'users': {}, 'groups': {}}
+
+    def save_key_cache(self):
+        """Saves the key cache next to the keys of the user (written to a temporary file first, so that a crash does not leave half a file)
+        """
+        filename = 'client_{0}_keys.json'.format(self.user)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(self.key_cache, f)
+        os.replace(filename + '.tmp', filename)
+
+    def cached_keys(self, isgroup, dest):
+        """Returns the public keys needed to send a message from the key cache
+
+        Parameters
+        ----------
+        isgroup : int
+            1 for a group message, 0 for a direct message
+        dest : int
+            The group ID or the user ID of the receiver
+
+        Returns
+        -------
+        dict or None
+            dict with key value pairs of the receivers and their public keys, None if the group or a key is not cached
+        """
+        users = self.key_cache['users']
+        if isgroup == 0:
+            receivers = [dest]
+        else:
+            group = self.key_cache['groups'].get(str(dest))
+            if group is None:
+                return None
+            receivers = [m for m in group['members'] if m != self.user]
+        if any(str(m) not in users for m in receivers):
+            return None
+        return {str(m): users[str(m)] for m in receivers}
+
+    def update_keys(self, msg):
+        """Applies a message of the server about keys to the key cache : the reply to a request (which `Send` is waiting for), the sync sent after the login, or the new participant list of a group pushed when it changes
+
+        Parameters
+        ----------
+        msg : dict
+            The message, its `message` holds the keys (-1 if the user is not a participant of the group asked for)
+        """
+        groups = self.key_cache['groups']
+        if msg['message'] == -1:
+            groups.pop(str(msg['group']), None)
+            self.save_key_cache()
+            self.keys = -1
+            return
+        self.key_cache['users'].update(msg['message'])
+        if 'sync' in msg:
+            for group_id, group in msg['groups'].items():
+                groups[str(group_id)] = group
+            for group_id in msg['left']:
+                groups.pop(str(group_id), None)
+        elif 'members' in msg:
+            if self.user in msg['members']:
+                groups[str(msg['group'])] = {'version': msg['version'], 'members': msg['members']}
+            else:
+                # Removed from the group
+                groups.pop(str(msg['group']), None)
+        self.save_key_cache()
+        if 'sync' in msg or 'push' in msg:
+            return
+        if msg['isgroup'] == 0:
+            self.keys = msg['message']
+        else:
+            group = groups[str(msg['group'])]
+            self.keys = {str(m): self.key_cache['users'][str(m)] for m in group['members']
+                         if m != self.user and str(m) in self.key_cache['users']}
+
     def message_send(self):
         """Reads from the selector and calls the `Send()` function if the event is to write
 
@@ -468,6 +780,9 @@ class Client(object):
         int
             0 when the exit flag is 1 (which never happens)
         """
+        # Frames that arrived together with the login reply
+        for frame in self.decoder.take_backlog():
+            self.process_frame(frame)
         while True:
             if self.exit_flag == 1:
                 return 0
@@ -505,7 +820,7 @@ class Client(object):
                         sock = key.fileobj
                         msg = {'type': 'close', 'user': 'close',
                                'password': 'close'}
-                        sock.send(json.dumps(msg).encode())
+                        framing.send_message(sock, msg)
                         print("MESSAGE SENT FOR CLOSE")
                         sock.close()
                         raise SystemExit
@@ -520,7 +835,7 @@ class Client(object):
                     print("Caught keyboard interrupt, exiting")
                     sock = key.fileobj
                     msg = {'type': 'close', 'user': 'close', 'password': 'close'}
-                    sock.send(json.dumps(msg).encode())
+                    framing.send_message(sock, msg)
                     print("MESSAGE SENT FOR CLOSE")
                     sock.close()
                     sys.exit()
@@ -546,6 +861,10 @@ class Client(object):
         SystemExit
             If the user wants to exit
         """
+        if self.key_pool is None:
+            # The key pair is generated in the background while the user types the credentials, or taken from the
+            # stash if there is one (no worker process is needed then)
+            self.key_pool = KeyPool(size=0) if KEY_STASH else KeyPool()
         try:
             user = int(input('User ID : '))
             password = input('Password : ')
@@ -553,12 +872,16 @@ class Client(object):
             print('Invalid Username!')
             return False
         sock = key.fileobj
-        self.encrypt = Encrypt()
+        if self.ticket_expires <= time.time():
+            # The ticket has expired while the user was at the menu
+            self.reconnect(sock)
+            sock = self.socket
+        self.encrypt = self.key_pool.take()
         public_key = self.encrypt.get_public_key()
         msg = {'type': 'new', 'user': user, 'password': password,
-               'sign': self.server_sign, 'public_key': public_key.decode()}
+               'sign': self.server_sign, 'expires': self.ticket_expires, 'public_key': public_key.decode()}
         try:
-            sock.send(json.dumps(msg).encode())
+            framing.send_message(sock, msg)
         except:
             return False
         while True:
@@ -566,7 +889,7 @@ class Client(object):
             for key, mask in events:
                 if mask & self.read:
                     sock = key.fileobj
-                    recv_data = json.loads(sock.recv(MAX_SIZE))
+                    recv_data = framing.recv_message(sock, self.decoder)
                     try:
                         print("Response : ", recv_data['response'])
                         if recv_data['response'] == 1:
@@ -575,15 +898,7 @@ class Client(object):
                             print('0. Exit')
                             a = int(input('Your choice : '))
                             if a == 1:
-                                self.selector.unregister(sock)
-                                sock.close()
-                                self.socket = socket.socket(
-                                    socket.AF_INET, socket.SOCK_STREAM)
-                                self.socket.connect_ex(
-                                    (self.IP_S, self.PORT_S))
-                                self.socket.setblocking(False)
-                                self.selector.register(
-                                    self.socket, self.read | self.write, data=None)
+                                self.reconnect(sock)
                                 return False
                             elif a == 0:
                                 raise SystemExit
@@ -591,19 +906,15 @@ class Client(object):
                             print(recv_data['server_message'])
                             self.user = user
                             self.encrypt.save_keys('client_' + str(self.user))
+                            self.key_pool.close()
+                            self.start_sessions()
+                            self.key_cache = {'users': {}, 'groups': {}}
                             return True
                     except SystemExit:
                         sys.exit()
                     except Exception as e:
                         print('Invalid option!', e)
-                        self.selector.unregister(sock)
-                        sock.close()
-                        self.socket = socket.socket(
-                            socket.AF_INET, socket.SOCK_STREAM)
-                        self.socket.connect_ex((self.IP_S, self.PORT_S))
-                        self.socket.setblocking(False)
-                        self.selector.register(
-                            self.socket, self.read | self.write, data=None)
+                        self.reconnect(sock)
                         return False
 
     def login(self, key):
@@ -631,15 +942,19 @@ class Client(object):
             print('Invalid Username!')
             return False
         sock = key.fileobj
+        if self.ticket_expires <= time.time():
+            # The ticket has expired while the user was at the menu
+            self.reconnect(sock)
+            sock = self.socket
         msg = {'type': 'login', 'user': user,
-               'password': password, 'sign': self.server_sign}
-        sock.send(json.dumps(msg).encode())
+               'password': password, 'sign': self.server_sign, 'expires': self.ticket_expires}
+        framing.send_message(sock, msg)
         while True:
             events = self.selector.select(timeout=None)
             for key, mask in events:
                 if mask & self.read:
                     sock = key.fileobj
-                    recv_data = json.loads(sock.recv(MAX_SIZE))
+                    recv_data = framing.recv_message(sock, self.decoder)
                     try:
                         if recv_data['response'] == 1:
                             print(recv_data['server_message'])
@@ -647,15 +962,7 @@ class Client(object):
                             print('0. Exit')
                             a = int(input('Your choice : '))
                             if a == 1:
-                                self.selector.unregister(sock)
-                                sock.close()
-                                self.socket = socket.socket(
-                                    socket.AF_INET, socket.SOCK_STREAM)
-                                self.socket.connect_ex(
-                                    (self.IP_S, self.PORT_S))
-                                self.socket.setblocking(False)
-                                self.selector.register(
-                                    self.socket, self.read | self.write, data=None)
+                                self.reconnect(sock)
                                 return False
                             elif a == 0:
                                 raise SystemExit
@@ -663,19 +970,21 @@ class Client(object):
                             print(recv_data['server_message'])
                             self.user = user
                             self.encrypt = Encrypt('client_'+str(self.user))
+                            if self.key_pool is not None:
+                                self.key_pool.close()
+                            self.start_sessions()
+                            # Brings the cached keys of the groups of the user up to date, in a single request
+                            self.load_key_cache()
+                            msg = {'type': 'keys', 'dest': 'server', 'from': self.user, 'message': 'sync', 'isgroup': 1,
+                                   'groups': {group_id: group['version'] for group_id, group in self.key_cache['groups'].items()},
+                                   'known': [int(user_id) for user_id in self.key_cache['users']], 'response': 0}
+                            framing.send_message(sock, msg)
                             return True
                     except SystemExit:
                         sys.exit()
                     except Exception as e:
                         print('Invalid option!', e)
-                        self.selector.unregister(sock)
-                        sock.close()
-                        self.socket = socket.socket(
-                            socket.AF_INET, socket.SOCK_STREAM)
-                        self.socket.connect_ex((self.IP_S, self.PORT_S))
-                        self.socket.setblocking(False)
-                        self.selector.register(
-                            self.socket, self.read | self.write, data=None)
+                        self.reconnect(sock)
                         return False
 
 
@@ -2,8 +2,127 @@
 """This file is a collection of functions to access and modify the postgreSQL database `fastchat`.
 
 We have used the package psycopg2, which provides us a connector through which we are able to query, modify and change the database.
+
+The tables are created and updated by the migrations in `MIGRATIONS`, the version of the schema is kept in the table schema_version. The pending migrations are applied when a `CentralDatabase` is constructed, by a single process of the cluster at a time (the others wait for it and then find nothing left to do), and the data is kept across restarts.
+
+Attributes
+----------
+MIGRATIONS : list
+    The migrations of the schema, in order : the migration at index i takes the schema from version i to version i+1. Each is a list of statements which can be run again on a schema which already has them
+    
+MIGRATION_LOCK : int
+    The key of the PostgreSQL advisory lock held while migrating
+    
+DB_RESET : bool
+    If True the tables are dropped (and created again) by `CentralDatabase`, from the `DB_RESET` environment variable (set to 1 by the benchmarks, which start from an empty database)
+    
+DB_DSN : str
+    The connection string of the database, from the `DB_DSN` environment variable
+    
+DB_POOL_SIZE : int
+    The max number of connections of a `CentralDatabase` (so of queries running at the same time), from the `DB_POOL_SIZE` environment variable (4 if it is not set)
+    
+DB_SYNC_COMMIT : bool
+    If False the batches of offline messages (`insert_messages`) are committed without waiting for PostgreSQL to flush them to the disk (`synchronous_commit` off) : a crash of the database can lose the last batches (never corrupt the tables), in exchange for many more batches per second. From the `DB_SYNC_COMMIT` environment variable (True unless it is set to 0)
+    
+PREPARED : dict
+    The server-side prepared statements of the queries run on every message (parsed and planned once per connection), by name
 """
+import contextlib
+import os
+import threading
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+
+MIGRATIONS = [
+    # 1 : the tables
+    ['''CREATE TABLE IF NOT EXISTS messages
+    (SENDER_ID    INT    NOT NULL,
+    RECEIVER_ID   INT     NOT NULL,
+    TIME          TEXT     NOT NULL,
+    MESSAGE       TEXT     NOT NULL);''',
+     # If not connected to any server, the server_id will be -1
+     '''CREATE TABLE IF NOT EXISTS users
+    (USER_ID    INT   PRIMARY KEY  NOT NULL,
+    PASSWORD    TEXT  NOT NULL,
+    SERVER_ID   INT   NOT NULL,
+    PUBLIC_KEY  TEXT  NOT NULL);''',
+     '''CREATE TABLE IF NOT EXISTS groups
+    (GROUP_ID    SERIAL PRIMARY KEY,
+    PARTICIPANTS INT ARRAY  NOT NULL,
+    ADMIN_ID INT  NOT NULL);''',
+     '''CREATE TABLE IF NOT EXISTS groupmessages
+    (SENDER_ID  INT  NOT NULL,
+    GROUP_ID    INT  NOT NULL,
+    TIME        TEXT NOT NULL,
+    MESSAGE     TEXT NOT NULL,
+    RECEIVER_ID INT  NOT NULL);''',
+     '''CREATE TABLE IF NOT EXISTS numclients
+    (SERVER_ID  INT PRIMARY KEY  NOT NULL,
+    NUM_CLIENTS INT NOT NULL);'''],
+    # 2 : the version of the participant list of each group
+    ['''ALTER TABLE groups ADD COLUMN IF NOT EXISTS VERSION INT NOT NULL DEFAULT 0;'''],
+    # 3 : the images of the offline messages, stored as bytes
+    ['''ALTER TABLE messages ADD COLUMN IF NOT EXISTS ATTACHMENT BYTEA;''',
+     '''ALTER TABLE groupmessages ADD COLUMN IF NOT EXISTS ATTACHMENT BYTEA;'''],
+    # 4 : the indexes of the lookups done on every login and every message
+    ['''CREATE INDEX IF NOT EXISTS messages_receiver_id ON messages (RECEIVER_ID);''',
+     '''CREATE INDEX IF NOT EXISTS groupmessages_receiver_id ON groupmessages (RECEIVER_ID);''',
+     '''CREATE INDEX IF NOT EXISTS users_server_id ON users (SERVER_ID);'''],
+    # 5 : the ID of the offline messages, from a sequence shared by both tables so that the inbox of a user is read
+    # (and acknowledged) in pages, in the order the messages were stored
+    ['''CREATE SEQUENCE IF NOT EXISTS inbox_msg_id;''',
+     '''ALTER TABLE messages ADD COLUMN IF NOT EXISTS MSG_ID BIGINT NOT NULL DEFAULT nextval('inbox_msg_id');''',
+     '''ALTER TABLE groupmessages ADD COLUMN IF NOT EXISTS MSG_ID BIGINT NOT NULL DEFAULT nextval('inbox_msg_id');''',
+     '''CREATE INDEX IF NOT EXISTS messages_receiver_msg_id ON messages (RECEIVER_ID, MSG_ID);''',
+     '''CREATE INDEX IF NOT EXISTS groupmessages_receiver_msg_id ON groupmessages (RECEIVER_ID, MSG_ID);''',
+     '''DROP INDEX IF EXISTS messages_receiver_id;''',
+     '''DROP INDEX IF EXISTS groupmessages_receiver_id;'''],
+    # 6 : the number of clients of each server, the servers report their load to the load balancer instead
+    ['''DROP TABLE IF EXISTS numclients;'''],
+]
+MIGRATION_LOCK = 0x66617374
+DB_RESET = os.environ.get('DB_RESET') == '1'
+DB_DSN = os.environ.get('DB_DSN', "dbname=fastchat user=atharvat")
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+DB_SYNC_COMMIT = os.environ.get('DB_SYNC_COMMIT') != '0'
+PREPARED = {
+    'check_server': '''(int) AS SELECT SERVER_ID FROM users WHERE USER_ID = $1''',
+    'fetch_key': '''(int) AS SELECT PUBLIC_KEY FROM users WHERE USER_ID = $1''',
+    'group_participants': '''(int) AS SELECT PARTICIPANTS FROM groups WHERE GROUP_ID = $1''',
+    'group_members': '''(int) AS SELECT PARTICIPANTS, VERSION FROM groups WHERE GROUP_ID = $1''',
+    # Inserted only if the receiver is registered
+    'insert_message': '''(int, int, text, text, bytea) AS INSERT INTO messages (SENDER_ID, RECEIVER_ID, TIME, MESSAGE, ATTACHMENT)
+        SELECT $1, $2, $3, $4, $5 WHERE EXISTS (SELECT 1 FROM users WHERE USER_ID = $2)''',
+    'insert_group_message': '''(int, int, text, int, text, bytea) AS INSERT INTO groupmessages (SENDER_ID, GROUP_ID, TIME, RECEIVER_ID, MESSAGE, ATTACHMENT)
+        VALUES ($1, $2, $3, $4, $5, $6)''',
+    # The next page of the inbox of a user, direct and group messages together
+    'inbox_page': '''(int, bigint, int) AS
+        (SELECT MSG_ID, MESSAGE, ATTACHMENT FROM messages WHERE RECEIVER_ID = $1 AND MSG_ID > $2 ORDER BY MSG_ID LIMIT $3)
+        UNION ALL
+        (SELECT MSG_ID, MESSAGE, ATTACHMENT FROM groupmessages WHERE RECEIVER_ID = $1 AND MSG_ID > $2 ORDER BY MSG_ID LIMIT $3)
+        ORDER BY MSG_ID LIMIT $3''',
+}
+
+def split_attachment(message):
+    """Splits a message into the MESSAGE and ATTACHMENT columns of the messages tables
+
+    Parameters
+    ----------
+    message : str or bytes
+        The message, bytes for a message with an attachment (binary envelope)
+
+    Returns
+    -------
+    tuple
+        The text of the message ('' for bytes) and the attachment (None for a text message)
+    """
+    if isinstance(message, bytes):
+        return '', psycopg2.Binary(message)
+    return message, None
+
 
 def list_to_postgre_array(lst):
     """Converts a Python list into a PostgreSQL array
@@ -43,55 +162,127 @@ def postgre_array_to_list(arr_str):
     lst = s.split(',')
     return lst
 
+class Connection(psycopg2.extensions.connection):
+    """A connection of the pool, which remembers whether the statements in `PREPARED` have been prepared on it
+    """
+    prepared = False
+
+
 class CentralDatabase:
     """Class for the Central Database, to be accessed by all the servers
+
+    The queries are run on the connections of a pool (at most `DB_POOL_SIZE` at the same time, from any thread), each method uses a connection for a single transaction.
     """
-    def __init__(self):
+    def __init__(self, reset=DB_RESET):
         """Initialising the Central Database, only accessible by the servers
         
-        Creates 5 tables in the database, which serve the following functions: 
+        Brings the schema up to date (see `migrate`), 4 tables which serve the following functions: 
         
         messages : Table to store unread messages for direct chats
         users : Table to store the details of registered users
         groups : Table to store information about all the groups
         groupmessages : Table to store unread group messages
-        numclients : Stores the number of clients which are connected to each server
+
+        Parameters
+        ----------
+        reset : bool (optional)
+            If True the existing tables are dropped first (`DB_RESET` by default). A worker process of a server connects with reset=False, so that it keeps the tables already in use
         
         """
 
-        self.conn = psycopg2.connect("dbname=fastchat user=atharvat") #Connector object to connect with the database
-        cur = self.conn.cursor()
-        cur.execute("DROP TABLE IF EXISTS messages;")
-        cur.execute("DROP TABLE IF EXISTS users;")
-        cur.execute("DROP TABLE IF EXISTS groups;")
-        cur.execute("DROP TABLE IF EXISTS groupmessages;")
-        cur.execute("DROP TABLE IF EXISTS numclients;")
-        
-        cur.execute('''CREATE TABLE IF NOT EXISTS messages
-        (SENDER_ID    INT    NOT NULL,
-        RECEIVER_ID   INT     NOT NULL,
-        TIME          TEXT     NOT NULL,
-        MESSAGE       TEXT     NOT NULL);''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS users
-        (USER_ID    INT   PRIMARY KEY  NOT NULL,
-        PASSWORD    TEXT  NOT NULL,
-        SERVER_ID   INT   NOT NULL,
-        PUBLIC_KEY  TEXT  NOT NULL);''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS groups
-        (GROUP_ID    SERIAL PRIMARY KEY,
-        PARTICIPANTS INT ARRAY  NOT NULL,
-        ADMIN_ID INT  NOT NULL);''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS groupmessages
-        (SENDER_ID  INT  NOT NULL,
-        GROUP_ID    INT  NOT NULL,
-        TIME        TEXT NOT NULL,
-        MESSAGE     TEXT NOT NULL,
-        RECEIVER_ID INT  NOT NULL);''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS numclients
-        (SERVER_ID  INT PRIMARY KEY  NOT NULL,
-        NUM_CLIENTS INT NOT NULL);''')
-        # If not connected to any server, the server_id will be -1
-        self.conn.commit()
+        # Pool of connectors to connect with the database, a connection is lent to one method at a time
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_SIZE, DB_DSN, connection_factory=Connection)
+        # The pool raises an error instead of waiting when all its connections are in use
+        self.available = threading.BoundedSemaphore(DB_POOL_SIZE)
+        # The statements are prepared once the tables exist
+        self.migrated = False
+        self.migrate(reset)
+        self.migrated = True
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Lends a connection of the pool for a transaction, which is committed when the block ends (rolled back if it raises an exception)
+
+        Yields
+        ------
+        cursor
+            A cursor of the connection
+        """
+        with self.available:
+            conn = self.pool.getconn()
+            try:
+                if self.migrated and not conn.prepared:
+                    with conn.cursor() as cur:
+                        for name, statement in PREPARED.items():
+                            cur.execute("PREPARE {0} {1};".format(name, statement))
+                    conn.prepared = True
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+
+    def migrate(self, reset=False):
+        """Applies the migrations the database does not have yet. The version is read first without locking, so that once the schema is up to date the processes which connect do not wait for each other
+
+        Parameters
+        ----------
+        reset : bool (optional)
+            If True the existing tables are dropped first, and all the migrations applied again
+
+        Returns
+        -------
+        int
+            The version of the schema before the migration
+        """
+        if not reset:
+            # Only read here, the table is created while holding the lock
+            with self.cursor() as cur:
+                cur.execute('''SELECT to_regclass('schema_version');''')
+                row = None
+                if cur.fetchone()[0] is not None:
+                    cur.execute('''SELECT VERSION FROM schema_version;''')
+                    row = cur.fetchone()
+            if row is not None and row[0] == len(MIGRATIONS):
+                return row[0]
+        with self.cursor() as cur:
+            # Held until the commit, the other processes migrating at the same time wait here
+            cur.execute('''SELECT pg_advisory_xact_lock(%s);''', (MIGRATION_LOCK,))
+            if reset:
+                for table in ('messages', 'users', 'groups', 'groupmessages', 'numclients', 'schema_version'):
+                    cur.execute("DROP TABLE IF EXISTS {0};".format(table))
+            version = self.schema_version(cur)
+            for i in range(version, len(MIGRATIONS)):
+                for statement in MIGRATIONS[i]:
+                    cur.execute(statement)
+                print("Migrated the database to version", i + 1)
+            cur.execute('''UPDATE schema_version SET VERSION = %s;''', (len(MIGRATIONS),))
+        return version
+
+    def schema_version(self, cur):
+        """Returns the version of the schema (0 for a new database), creating the table schema_version if needed. Called while holding the lock
+
+        Parameters
+        ----------
+        cur : cursor
+            The cursor of the transaction
+
+        Returns
+        -------
+        int
+            The number of migrations applied
+        """
+        cur.execute('''CREATE TABLE IF NOT EXISTS schema_version
+        (VERSION INT NOT NULL);''')
+        cur.execute('''SELECT VERSION FROM schema_version;''')
+        row = cur.fetchone()
+        if row is None:
+            cur.execute('''INSERT INTO schema_version (VERSION) VALUES (0);''')
+            return 0
+        return row[0]
 
     #Added key attribute, made password a string
     def insert_newuser(self, user_id, password, server_id, public_key):
@@ -113,17 +304,11 @@ class CentralDatabase:
         bool
             `True` if the user wasn't already present, and `False` if it was already present
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT USER_ID FROM users;''')
-        output = cur.fetchall()
-
-        if ((user_id,) not in output):
+        with self.cursor() as cur:
             cur.execute('''INSERT INTO users (USER_ID, PASSWORD, SERVER_ID, PUBLIC_KEY)
-            VALUES ({0},'{1}',{2},'{3}');'''.format(user_id, password, server_id, public_key))
-            self.conn.commit()
-            return True  # if succesfully inserted
-        else:
-            return False  # unsuccessful insertion
+            VALUES (%s,%s,%s,%s) ON CONFLICT (USER_ID) DO NOTHING;''', (user_id, password, server_id, public_key))
+            # No row is inserted if the user was already present
+            return cur.rowcount == 1
         
     def fetch_key(self, user_id):
         """Gets the public key of a given user
@@ -138,10 +323,27 @@ class CentralDatabase:
         str
             Public Key of the user
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT PUBLIC_KEY FROM users WHERE USER_ID = {0};'''.format(user_id))
-        key = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE fetch_key (%s);''', (user_id,))
+            key = cur.fetchall()
         return key[0][0]
+
+    def fetch_keys(self, user_ids):
+        """Gets the public keys of several users with a single query
+
+        Parameters
+        ----------
+        user_ids : :obj:`list` of :obj:`int`
+            The user IDs of the users
+
+        Returns
+        -------
+        dict
+            A dictionary with keys being the user IDs and values being the public keys. Users who are not registered are left out
+        """
+        with self.cursor() as cur:
+            cur.execute('''SELECT USER_ID, PUBLIC_KEY FROM users WHERE USER_ID = ANY(%s);''', (list(user_ids),))
+            return dict(cur.fetchall())
     
     def fetch_group_keys(self, group_id, user_id):
         """Gets the public keys of all users in a group except the given user (Checks whether they're in the group or not)
@@ -159,16 +361,16 @@ class CentralDatabase:
             A dictionary with keys being the user IDs and values being the public keys. 
             Returns -1 if the user isn't present in the group
         """
-        cur = self.conn.cursor()
-        participants = self.group_participants(group_id)
-        if (user_id not in participants):
+        with self.cursor() as cur:
+            # The keys of all the participants (the user included) in a single query
+            cur.execute('''SELECT users.USER_ID, users.PUBLIC_KEY FROM groups
+                        JOIN users ON users.USER_ID = ANY(groups.PARTICIPANTS)
+                        WHERE groups.GROUP_ID = %s;''', (group_id,))
+            dict1 = dict(cur.fetchall())
+        if (user_id not in dict1):
             return -1
         else:
-            participants.remove(user_id)
-        dict1 = dict()
-        for id in participants:
-            key = self.fetch_key(id)
-            dict1[id] = key
+            dict1.pop(user_id)
             
         return dict1
         
@@ -188,20 +390,13 @@ class CentralDatabase:
         int
             Returns the ID of the group created, -1 if a participant in the list isn't registered
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT USER_ID FROM users''')
-        a = cur.fetchall()
-        for i in range(len(participants)):
-            tup = (participants[i],)
-            if tup not in a:
+        with self.cursor() as cur:
+            cur.execute('''SELECT COUNT(*) FROM users WHERE USER_ID = ANY(%s);''', (list(participants),))
+            if cur.fetchone()[0] != len(set(participants)):
                 return -1
-        arr_str = list_to_postgre_array(participants)
-        cur.execute('''INSERT INTO groups (PARTICIPANTS, ADMIN_ID)
-        VALUES ('{0}',{1});'''.format(arr_str,admin_id))
-        self.conn.commit()
-        cur.execute('''SELECT GROUP_ID FROM groups ORDER BY GROUP_ID;''')
-        lst_ids = cur.fetchall()
-        return lst_ids[-1][0]
+            cur.execute('''INSERT INTO groups (PARTICIPANTS, ADMIN_ID)
+            VALUES (%s,%s) RETURNING GROUP_ID;''', (list(participants), admin_id))
+            return cur.fetchone()[0]
     
     def group_participants(self, group_id):
         """Gets all the participants of a group
@@ -216,10 +411,45 @@ class CentralDatabase:
         :obj:`list` of :obj:`int`
             List of participant IDs in the group
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT PARTICIPANTS FROM groups WHERE GROUP_ID = {0}'''.format(group_id))
-        lst = cur.fetchall()[0][0]
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE group_participants (%s);''', (group_id,))
+            lst = cur.fetchall()[0][0]
         return lst
+
+    def group_members(self, group_id):
+        """Gets all the participants of a group, with the version of the list (incremented by every addition or removal of a participant)
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID of the group
+
+        Returns
+        -------
+        tuple
+            List of participant IDs in the group, and the version of the list
+        """
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE group_members (%s);''', (group_id,))
+            participants, version = cur.fetchall()[0]
+        return participants, version
+
+    def user_groups(self, user_id):
+        """Gets all the groups a user is a participant of, with their participants, in a single query
+
+        Parameters
+        ----------
+        user_id : int
+            The user ID
+
+        Returns
+        -------
+        dict
+            dict with the group IDs as keys and (list of participant IDs, version of the list) as values
+        """
+        with self.cursor() as cur:
+            cur.execute('''SELECT GROUP_ID, PARTICIPANTS, VERSION FROM groups WHERE %s = ANY(PARTICIPANTS);''', (user_id,))
+            return {group_id: (participants, version) for group_id, participants, version in cur.fetchall()}
         
 
     def change_server(self, user_id, server_id):
@@ -232,12 +462,11 @@ class CentralDatabase:
         server_id : int
             The server ID to be updated to
         """
-        cur = self.conn.cursor()
-        cur.execute('''UPDATE users
-                        SET SERVER_ID = {1}
-                        WHERE USER_ID = {0};
-                        '''.format(user_id, server_id))
-        self.conn.commit()
+        with self.cursor() as cur:
+            cur.execute('''UPDATE users
+                            SET SERVER_ID = %s
+                            WHERE USER_ID = %s;
+                            ''', (server_id, user_id))
 
     def check_server(self, user_id):
         """_summary_
@@ -252,22 +481,38 @@ class CentralDatabase:
         int
             The server that the user is conencted to, -1 if offline and -2 if not registered
         """
-        cur = self.conn.cursor()
-        cur.execute(
-            '''SELECT SERVER_ID FROM users WHERE USER_ID = {0};'''.format(user_id))
-        a = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE check_server (%s);''', (user_id,))
+            a = cur.fetchall()
         print("Servers : ", a)
         if (a == []):
             return -2  # -2 is returned if the user has not been registered yet
         return a[0][0]
 
+    def check_servers(self, user_ids):
+        """Get the servers several users are connected to, with a single query
+
+        Parameters
+        ----------
+        user_ids : list
+            The user IDs
+
+        Returns
+        -------
+        dict
+            The server of each user (-1 if offline), the users who have not registered are left out
+        """
+        with self.cursor() as cur:
+            cur.execute('''SELECT USER_ID, SERVER_ID FROM users WHERE USER_ID = ANY(%s);''', (list(user_ids),))
+            return dict(cur.fetchall())
+
     #Users table got modified, so output would have an extra key
     def displayallusers(self):
         """Prints the details of all users
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT * FROM users;''')
-        output = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''SELECT * FROM users;''')
+            output = cur.fetchall()
         print(output)
 
     def check_user(self, user_id):
@@ -283,10 +528,10 @@ class CentralDatabase:
         bool
             `True` if the user is registered and `False` if not
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT USER_ID FROM users 
-        WHERE USER_ID = '''+str(user_id)+''';''')
-        output = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''SELECT USER_ID FROM users 
+            WHERE USER_ID = %s;''', (user_id,))
+            output = cur.fetchall()
         print("Check Server Function's output : ", output)
         if ((user_id,) in output):
             return True  # user is present in the database
@@ -309,10 +554,10 @@ class CentralDatabase:
         bool
             `True` if the credentials are valid and `False` if the credentials aren't
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT USER_ID FROM users 
-        WHERE USER_ID = '''+str(user_id)+''' AND PASSWORD = '{0}' '''.format(password)+''';''')
-        output = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''SELECT USER_ID FROM users 
+            WHERE USER_ID = %s AND PASSWORD = %s;''', (user_id, password))
+            output = cur.fetchall()
 
         if ((user_id,) in output):
             return True  # user is present in the database
@@ -332,32 +577,28 @@ class CentralDatabase:
             The receiver ID of the user
         datetime : str
             The datetime string of the message
-        message : _type_
-            The direct text message to be sent
+        message : str or bytes
+            The direct text message to be sent, bytes for a message with an attachment (stored in ATTACHMENT)
 
         Returns
         -------
         bool
             `True` if the receiver is registered and `False` if not
         """
-        cur = self.conn.cursor()
-        #### ADD CODE TO CHECK WHETHER RECEIVER IS IN THE DATABASE #####
-        if (self.check_user(receiver_id)):
-            cur.execute('''INSERT INTO messages (SENDER_ID,RECEIVER_ID,TIME,MESSAGE)
-            VALUES ({0},{1},'{2}','{3}');'''.format(sender_id, receiver_id, datetime, message))
-            self.conn.commit()
-            return True
-        else:
-            return False
+        message, attachment = split_attachment(message)
+        with self.cursor() as cur:
+            # The receiver is checked by the same statement, nothing is inserted if it is not registered
+            cur.execute('''EXECUTE insert_message (%s,%s,%s,%s,%s);''', (sender_id, receiver_id, datetime, message, attachment))
+            return cur.rowcount == 1
 
     #Displays an extra key column as well
     # Message is now a json
     def displayallmessage(self):
         """Displays all the messages stored in the tables messages
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT * FROM messages;''')
-        output = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''SELECT * FROM messages;''')
+            output = cur.fetchall()
         print(output)
       
     # Changed groupmessages to contain a single receiver_id instead of an array of unread participants 
@@ -386,86 +627,140 @@ class CentralDatabase:
             The datetime string of the message
         group_id : int
             The user ID of the sender
-        message : str
-            The unread group message to the offline receiver
+        message : str or bytes
+            The unread group message to the offline receiver, bytes for a message with an attachment (stored in ATTACHMENT)
 
         Returns
         -------
         bool
             `True` if inserting works and `False` otherwise
         """
-        cur = self.conn.cursor()
+        message, attachment = split_attachment(message)
         #### ADD CODE TO CHECK WHETHER RECEIVER IS IN THE DATABASE #####
         print("Inserting {0} into groupmessages table".format(message))
-        cur.execute('''INSERT INTO groupmessages (SENDER_ID,GROUP_ID,TIME,MESSAGE,RECEIVER_ID)
-        VALUES ({0},{1},'{2}','{3}',{4});'''.format(sender_id, group_id, datetime, message, receiver_id))
-        self.conn.commit()
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE insert_group_message (%s,%s,%s,%s,%s,%s);''', (sender_id, group_id, datetime, receiver_id, message, attachment))
         return True
+
+    def insert_messages(self, rows):
+        """Inserts a batch of direct messages for offline receivers into the messages table, with a single multi-row insert and a single commit
+
+        Parameters
+        ----------
+        rows : list
+            The messages, each one a tuple of the arguments of `insert_message` (sender_id, receiver_id, datetime, message). The receivers must be registered users
+
+        Returns
+        -------
+        int
+            The number of messages inserted
+        """
+        values = [(sender_id, receiver_id, datetime) + split_attachment(message)
+                  for sender_id, receiver_id, datetime, message in rows]
+        with self.cursor() as cur:
+            if not DB_SYNC_COMMIT:
+                cur.execute('''SET LOCAL synchronous_commit TO OFF;''')
+            psycopg2.extras.execute_values(cur, '''INSERT INTO messages (SENDER_ID, RECEIVER_ID, TIME, MESSAGE, ATTACHMENT)
+            VALUES %s;''', values, page_size=len(values))
+        return len(values)
+
+    def insert_group_messages(self, rows):
+        """Inserts a batch of group messages for offline receivers into the groupmessages table, with a single multi-row insert and a single commit
+
+        Parameters
+        ----------
+        rows : list
+            The messages, each one a tuple of the arguments of `insert_group_message` (sender_id, receiver_id, datetime, group_id, message)
+
+        Returns
+        -------
+        int
+            The number of messages inserted
+        """
+        values = [(sender_id, group_id, datetime, receiver_id) + split_attachment(message)
+                  for sender_id, receiver_id, datetime, group_id, message in rows]
+        with self.cursor() as cur:
+            if not DB_SYNC_COMMIT:
+                cur.execute('''SET LOCAL synchronous_commit TO OFF;''')
+            psycopg2.extras.execute_values(cur, '''INSERT INTO groupmessages (SENDER_ID, GROUP_ID, TIME, RECEIVER_ID, MESSAGE, ATTACHMENT)
+            VALUES %s;''', values, page_size=len(values))
+        return len(values)
         
     # Displays receiver_id and not participants array
     # message is a json message
     def displayallgroupmessage(self):
         """Print all the unread group messages
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT * FROM groupmessages;''')
-        output = cur.fetchall()
+        with self.cursor() as cur:
+            cur.execute('''SELECT * FROM groupmessages;''')
+            output = cur.fetchall()
         print(output)
 
-    # Will show the key as well, the output will contain the key
-    # Messages will be json
-    # output is of the form of a list of tuples of the form (sender_id, receiver_id, time, json_message, key)
-    def show_message(self, receiver_id):
-        """Returns the unread messages from the messages table, with the given receiver ID. Also deletes those messages from the table
+    def inbox_counts(self, receiver_id):
+        """Returns the number of unread direct messages of a user by sender, and of unread group messages by group, without reading the messages
 
         Parameters
         ----------
         receiver_id : int
-            The user ID of the receiver who is offline
+            The user ID of the receiver
 
         Returns
         -------
-        :obj:`list` of :obj:`tup`
-            Returns the row of the database with the correct receiver ID
+        dict
+            `direct` maps the senders to their number of unread messages, `groups` maps the groups to theirs
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT * FROM messages 
-        WHERE RECEIVER_ID = '''+str(receiver_id)+''';''')
-        output = cur.fetchall()
-        # Delete the message only after confirmation that the messages have been delivered
-        cur.execute('''DELETE from messages
-        WHERE RECEIVER_ID = '''+str(receiver_id)+''';''')
-        self.conn.commit()
-        # Return all the messages to be shown to the user
-        return (output)
-    
-    # Will not display participants, instead an additional key and receiver_id
-    # Will display json messages
-    def show_group_message(self, receiver_id):
-        """Returns the unread group messages from the groupmessages table, with the given receiver ID. Also deletes those messages from the table
+        counts = {'direct': dict(), 'groups': dict()}
+        with self.cursor() as cur:
+            cur.execute('''SELECT 'direct', SENDER_ID, COUNT(*) FROM messages WHERE RECEIVER_ID = %s GROUP BY SENDER_ID
+            UNION ALL
+            SELECT 'groups', GROUP_ID, COUNT(*) FROM groupmessages WHERE RECEIVER_ID = %s GROUP BY GROUP_ID;''',
+                        (receiver_id, receiver_id))
+            for kind, sender_or_group, count in cur.fetchall():
+                counts[kind][sender_or_group] = count
+        return counts
+
+    def inbox_page(self, receiver_id, after, limit):
+        """Returns the next page of unread messages (direct and group) of a user, in the order they were stored. The messages are not deleted, see `ack_inbox`
 
         Parameters
         ----------
         receiver_id : int
-            The user ID of the receiver who is offline
+            The user ID of the receiver
+        after : int
+            The page starts after the message with this ID (0 for the first page)
+        limit : int
+            The max number of messages of the page
 
         Returns
         -------
         :obj:`list` of :obj:`tup`
-            Returns the row of the database with the correct receiver ID
+            The ID and the message of each unread message (the message is bytes if it has an attachment)
         """
-        cur = self.conn.cursor()
-        print("I'm inside show_group_message, querying")
-        cur.execute('''SELECT * FROM groupmessages 
-        WHERE RECEIVER_ID = {0};'''.format(int(receiver_id)))
-        output = cur.fetchall()
-        # Delete the message only after confirmation that the messages have been delivered
-        print("I'm deleting from show_group_message")
-        cur.execute('''DELETE from groupmessages
-        WHERE RECEIVER_ID = '''+str(receiver_id)+''';''')
-        self.conn.commit()
-        # Return all the messages to be shown to the user
-        return (output)
+        with self.cursor() as cur:
+            cur.execute('''EXECUTE inbox_page (%s,%s,%s);''', (receiver_id, after, limit))
+            return [(msg_id, message if attachment is None else bytes(attachment))
+                    for msg_id, message, attachment in cur.fetchall()]
+
+    def ack_inbox(self, receiver_id, msg_ids):
+        """Deletes the unread messages of a user which the user has acknowledged (received and stored)
+
+        Parameters
+        ----------
+        receiver_id : int
+            The user ID of the receiver
+        msg_ids : list
+            The IDs of the acknowledged messages
+
+        Returns
+        -------
+        int
+            The number of messages deleted
+        """
+        with self.cursor() as cur:
+            cur.execute('''DELETE FROM messages WHERE RECEIVER_ID = %s AND MSG_ID = ANY(%s);''', (receiver_id, msg_ids))
+            deleted = cur.rowcount
+            cur.execute('''DELETE FROM groupmessages WHERE RECEIVER_ID = %s AND MSG_ID = ANY(%s);''', (receiver_id, msg_ids))
+            return deleted + cur.rowcount
 
     # def return_min_conn(self, num_servers):
     #     cur = self.conn.cursor()
@@ -482,81 +777,24 @@ class CentralDatabase:
     #         return a[0][0]
     #     return a
 
-    #server_pool contains the (server_ip, server_port) of all the servers
-    def init_numclients(self, num_servers): 
-        """Initializes the table numclients which maintains the tally of number of clients per server vs the corresponding ip and port number. Sets all values to 0
-
-        Parameters
-        ----------
-        num_servers : int
-            The number of servers running
-
-        Returns
-        -------
-        bool
-            `True` if it initialises correctly, else `False`
-        """
-        cur = self.conn.cursor()
-        try:
-            for i in range(num_servers):
-                cur.execute('''INSERT INTO numclients (SERVER_ID, NUM_CLIENTS)
-                    VALUES ({0},{1});'''.format(i+1, 0))
-                print("In insert numclients")
-                self.conn.commit()
-            return True
-        except Exception as e:
-            print("ERROR INITIALIZING THE NUMCLIENTS TABLE!!", e)
-            return False
-        
-    # increase = 1 if client joins the server, -1 if the client leavs the server
-    def update_numclients(self, server_ID, increase): 
-        """Updates the table numclients when user comes online or goes offline
+    def reset_server(self, server_ID):
+        """Marks the users of a server which is (re)starting as offline, as they were left by the previous run of the server
 
         Parameters
         ----------
         server_ID : int
-            ID of the server to be updated
-        increase : int
-            Either +1 or -1 depending on whether a user is going offline or coming online
-
-        Returns
-        -------
-        bool
-            `True` if there is no error, else `False` if the server itself isn't in the table to begin with
-        """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT SERVER_ID FROM numclients;''')
-        output = cur.fetchall()
-        if (server_ID,) not in output:
-            return False
-        else:
-            try:
-                cur.execute('''UPDATE numclients
-                SET NUM_CLIENTS = NUM_CLIENTS + {0}
-                WHERE SERVER_ID = {1};'''.format(increase, server_ID))
-                self.conn.commit()
-                print("TABLE UPDATED!!!!!!!!!!!!!!!!!!!!!!!!!")
-                return True
-            except:
-                print("Error occured in the updation of database!!")
-                return False
-
-
-    def get_min_numclients(self):
-        """Selects the server with the least number of clients connected to it
+            ID of the server
 
         Returns
         -------
         int
-            Server ID of the required server
+            The number of users marked as offline
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT SERVER_ID FROM numclients
-             ORDER BY NUM_CLIENTS;''')
-        a = cur.fetchall()
-        return a[0][0]
-
-    
+        with self.cursor() as cur:
+            cur.execute('''UPDATE users SET SERVER_ID = -1 WHERE SERVER_ID = %s;''', (server_ID,))
+            count = cur.rowcount
+        return count
+        
     def del_participant(self, part_id, admin_id, group_id):
         # Deletes the participant from the group iff he is not an the admin of the group
         # Should handle the case of part_id == admin_id before this function call, will be easier
@@ -584,20 +822,20 @@ class CentralDatabase:
             -3, if the group doesn't exist
             1, otherwise
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT admin_id, participants FROM groups WHERE group_id = {0}'''.format(group_id))
-        a = cur.fetchall()
-        if (len(a) == 0):
-            return -3
-        actual_admin_id = a[0][0]
-        if (actual_admin_id != admin_id):
-            return -1
-        if part_id not in a[0][1]:
-            return -2
-        cur.execute('''UPDATE groups
-                    SET PARTICIPANTS = array_remove(PARTICIPANTS,{0})
-                    WHERE group_id = {1};'''.format(part_id, group_id))
-        self.conn.commit()
+        with self.cursor() as cur:
+            # The row is locked until the end of the transaction, so that concurrent changes of the group are not lost
+            cur.execute('''SELECT admin_id, participants FROM groups WHERE group_id = %s FOR UPDATE;''', (group_id,))
+            a = cur.fetchall()
+            if (len(a) == 0):
+                return -3
+            actual_admin_id = a[0][0]
+            if (actual_admin_id != admin_id):
+                return -1
+            if part_id not in a[0][1]:
+                return -2
+            cur.execute('''UPDATE groups
+                        SET PARTICIPANTS = array_remove(PARTICIPANTS,%s), VERSION = VERSION + 1
+                        WHERE group_id = %s;''', (part_id, group_id))
         return 1
 
     def add_participant(self, part_id, admin_id, group_id):
@@ -628,30 +866,29 @@ class CentralDatabase:
             -4, if the user to be added doesn't exist
             1, otherwise
         """
-        cur = self.conn.cursor()
-        cur.execute('''SELECT admin_id, participants FROM groups WHERE group_id = {0}'''.format(group_id))
-        a = cur.fetchall()
-        if (len(a) == 0):
-            return -3
-        actual_admin_id = a[0][0]
-        if (actual_admin_id != admin_id):
-            return -1
-        if part_id in a[0][1]:
-            return -2
-        cur.execute('''SELECT user_id FROM users WHERE user_id = {0}'''.format(part_id))
-        a = cur.fetchall()
-        if (len(a) == 0):
-            return -4
-        cur.execute('''UPDATE groups
-                    SET participants = participants || '{0}' 
-                    WHERE group_id = {1};'''.format(list_to_postgre_array([part_id]),group_id))
-        self.conn.commit()
+        with self.cursor() as cur:
+            cur.execute('''SELECT admin_id, participants FROM groups WHERE group_id = %s FOR UPDATE;''', (group_id,))
+            a = cur.fetchall()
+            if (len(a) == 0):
+                return -3
+            actual_admin_id = a[0][0]
+            if (actual_admin_id != admin_id):
+                return -1
+            if part_id in a[0][1]:
+                return -2
+            cur.execute('''SELECT user_id FROM users WHERE user_id = %s;''', (part_id,))
+            a = cur.fetchall()
+            if (len(a) == 0):
+                return -4
+            cur.execute('''UPDATE groups
+                        SET participants = array_append(participants, %s), VERSION = VERSION + 1
+                        WHERE group_id = %s;''', (part_id, group_id))
         return 1
 
     def close_connection(self):
-        """Closes the connection between the python script and the postgreSQL database
+        """Closes the connections between the python script and the postgreSQL database
         """
-        self.conn.close()
+        self.pool.closeall()
         print("Connection closed")
 
 # D = CentralDatabase()
@@ -665,8 +902,6 @@ class CentralDatabase:
 
 # D.insert_message(1,2,"31122022","Hello How are you?")
 # D.displayallmessage()
-# output = D.show_message(2)
-# print(output)
 # D.displayallmessage()
 # #
 # #
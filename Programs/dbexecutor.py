@@ -0,0 +1,139 @@
+'''This module runs the database queries of a server on threads, so that its event loop does not wait for
+PostgreSQL : a slow query of one user only delays that user, the other connections are served in the meantime.
+
+A query is submitted with the function to be called with its result (the callback). The callbacks are not run by the
+threads but by the event loop, which is woken up through a socket pair : a thread appends its finished query to a
+queue and writes a byte to one end of the pair, the other end (``fileno``) is watched by the selector of the server
+like its sockets.
+
+The queries run on ``workers`` lanes, a thread each. The queries submitted with the same ``key`` (e.g. the user they
+are about) run on the same lane, in the order they were submitted, so that for example the messages stored for an
+offline user are written before its unread messages are read at login. The other queries go to the least busy lane.
+
+Attributes
+----------
+DB_WORKERS : int
+    Default number of lanes, from the ``DB_WORKERS`` environment variable. One less than the connections of the pool
+    of ``database.CentralDatabase`` if it is not set, so that the queries run at the start of a server (before the
+    lanes) always find a free connection. 0 runs the queries in the caller, and their callbacks right away
+'''
+
+import collections
+import concurrent.futures
+import os
+import socket
+
+import database
+
+DB_WORKERS = int(os.environ.get('DB_WORKERS', max(database.DB_POOL_SIZE - 1, 1)))
+
+
+class DBExecutor(object):
+    '''Threads running the database queries, and the queue of their results for the event loop.
+
+    Parameters
+    ----------
+    workers : int (optional)
+        The number of lanes (threads), 0 to run the queries in the caller.
+    post : callable (optional)
+        Called by the thread of a finished query with ``finish`` and its arguments, instead of queueing them and
+        waking the selector up (the asyncio engine posts them to its dispatcher).
+
+    '''
+
+    def __init__(self, workers=DB_WORKERS, post=None):
+        self.post = post
+        self.lanes = [concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='db') for i in range(workers)]
+        # Queries submitted and not finished yet, per lane
+        self.running = [0] * workers
+        self.finished = collections.deque()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.queries = 0
+        self.busiest = 0
+
+    def fileno(self):
+        return self.wakeup.fileno()
+
+    def submit(self, function, args=(), callback=None, key=None):
+        ''' Runs ``function(*args)`` on a lane, then ``callback(result, error)`` on the event loop : ``error`` is the
+        exception raised by the query (``result`` is then None), else None.
+        '''
+        self.queries += 1
+        if not self.lanes:
+            self.finish(None, callback, *self.call(function, args))
+            return
+        if key is None:
+            lane = self.running.index(min(self.running))
+        else:
+            lane = self.lane(key)
+        self.running[lane] += 1
+        self.busiest = max(self.busiest, sum(self.running))
+        self.lanes[lane].submit(self.run, lane, function, args, callback)
+
+    def lane(self, key):
+        ''' Returns the index of the lane running the queries submitted with a key (0 without lanes).
+        '''
+        return hash(key) % len(self.lanes) if self.lanes else 0
+
+    def call(self, function, args):
+        try:
+            return function(*args), None
+        except Exception as e:
+            print('Exception in the database query', getattr(function, '__name__', function), ':', e)
+            return None, e
+
+    def run(self, lane, function, args, callback):
+        # On the thread of the lane
+        result, error = self.call(function, args)
+        if self.post is not None:
+            self.post(self.finish, lane, callback, result, error)
+            return
+        self.finished.append((lane, callback, result, error))
+        try:
+            self.waker.send(b'\0')
+        except BlockingIOError:
+            # The socket buffer is full of wakeups, the event loop has not read them yet
+            pass
+
+    def finish(self, lane, callback, result, error):
+        ''' Runs the callback of a finished query, on the event loop.
+        '''
+        if lane is not None:
+            self.running[lane] -= 1
+        if callback is None:
+            return
+        try:
+            callback(result, error)
+        except Exception as e:
+            print('Exception in the callback of a database query', e)
+
+    def run_callbacks(self):
+        ''' Runs the callbacks of the finished queries, called by the event loop when ``fileno`` is readable.
+        '''
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.finished:
+            self.finish(*self.finished.popleft())
+
+    def pending(self):
+        ''' Returns the number of queries submitted and not finished yet.
+        '''
+        return sum(self.running)
+
+    def stats(self):
+        ''' Returns the number of queries run and the max number of queries which were running at the same time.
+        '''
+        return {'queries': self.queries, 'max in flight': self.busiest}
+
+    def close(self):
+        ''' Stops the lanes once their queries are done.
+        '''
+        for lane in self.lanes:
+            lane.shutdown(wait=False)
+        self.wakeup.close()
+        self.waker.close()
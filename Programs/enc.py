@@ -3,15 +3,69 @@
 AESCipher to perform AES encryption and Encryption class, which perfoms E2EE of messages.
 
 Message is encrypted using AES and the AES key is encrypted using RSA.
+
+Direct messages use session keys (``SessionKeys``) : the AES key is shared with a peer once (RSA encrypted in the
+first message of the session) and then reused, the following messages only carry its key ID. Group messages use the
+sending key of the sender in the group the same way, it is shared with all the participants at once and replaced
+when the participants change. A ``CryptoPool`` spreads the encryption of a new group key for all the participants, and
+the decryption of the messages received together, over all the CPUs. Attachments (images) are encrypted with the same keys but with ``GCMCipher`` : bytes in
+and bytes out, authenticated, without the padding and the base 64 encoding of ``AESCipher``.
+
+The RSA operations are done by a backend (``BACKENDS``) : ``rsa`` (the pure Python ``rsa`` package, PKCS#1 v1.5
+encryption and signatures) or ``pycryptodome`` (OAEP encryption and PSS signatures, much faster). The keys are saved
+in the same PEM files by both, but the encrypted keys and the signatures of one backend can not be read by the other,
+so the load balancer, the servers and the clients must all use the same one.
+
+Attributes
+----------
+CRYPTO_BACKEND : str
+    The backend used by default, from the ``CRYPTO_BACKEND`` environment variable (``rsa`` if it is not set)
+
+SESSION_MESSAGES : int
+    Default number of messages sent with a session key before a new one is used
+
+SESSION_AGE : int
+    Default age (in seconds) of a session key after which a new one is used
+
+SESSION_KEYS : int
+    Default max number of session keys of the peers kept to decrypt their messages
+
+SESSION_RESEND : int
+    Default number of messages of a session after which its encrypted key is sent again
+
+CRYPTO_WORKERS : int
+    Default number of processes (and threads) of a ``CryptoPool``, from the ``CRYPTO_WORKERS`` environment variable
+    (1 if it is not set : a client only starts a pool when it is set above 1)
 '''
 
 import rsa
 import base64
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
 from Crypto import Random
 from Crypto.Cipher import AES
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.IO import PEM
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pss
+from Crypto.Util.asn1 import DerSequence
 # from Crypto.PublicKey import RSA as rsa
 
+CRYPTO_BACKEND = os.environ.get('CRYPTO_BACKEND', 'rsa')
+
+SESSION_MESSAGES = 1000
+SESSION_AGE = 3600
+SESSION_KEYS = 4096
+SESSION_RESEND = 50
+CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', 1))
 
 
 class AESCipher(object):
@@ -110,6 +164,154 @@ class AESCipher(object):
         return s[:-ord(s[len(s)-1:])]
     
     
+class GCMCipher(object):
+    '''AES-GCM (authenticated) encryption of bytes, used for the attachments : no padding and no base64, the
+    encrypted bytes are the nonce, the encrypted data and the tag.
+
+    Parameters
+    ----------
+    key : bytes or str
+        This key is used to encrypt/decrypt the data.
+
+    '''
+
+    NONCE = 12
+    TAG = 16
+
+    def __init__(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode()
+        self.key = hashlib.sha256(key).digest()
+
+    def encrypt(self, raw):
+        '''
+        Parameters
+        ----------
+        raw : bytes or memoryview
+            The data that is to be encrypted.
+
+        Returns
+        -------
+        bytes
+            Nonce, encrypted data and tag.
+
+        '''
+        nonce = Random.new().read(self.NONCE)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        encrypted, tag = cipher.encrypt_and_digest(raw)
+        return nonce + encrypted + tag
+
+    def decrypt(self, enc):
+        '''
+        Parameters
+        ----------
+        enc : bytes or memoryview
+            Nonce, encrypted data and tag.
+
+        Returns
+        -------
+        bytes
+            Decrypted data.
+
+        Raises
+        ------
+        ValueError
+            If the data has been modified (or the key is not the right one).
+
+        '''
+        enc = memoryview(enc)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=enc[:self.NONCE])
+        return cipher.decrypt_and_verify(enc[self.NONCE:-self.TAG], enc[-self.TAG:])
+
+
+class RSABackend(object):
+    '''RSA with the pure Python ``rsa`` package : PKCS#1 v1.5 encryption and PKCS#1 v1.5 SHA-256 signatures.
+    '''
+
+    name = 'rsa'
+
+    def newkeys(self, bits):
+        ''' Returns a new (public key, private key) pair.
+        '''
+        return rsa.newkeys(bits)
+
+    @functools.lru_cache(maxsize=1024)
+    def load_public_key(self, pem):
+        ''' Returns the key object of a PEM format public key (the keys of the peers are parsed once).
+        '''
+        return rsa.PublicKey.load_pkcs1(pem)
+
+    def load_private_key(self, pem):
+        return rsa.PrivateKey.load_pkcs1(pem)
+
+    def save_public_key(self, key):
+        return key.save_pkcs1('PEM')
+
+    def save_private_key(self, key):
+        return key.save_pkcs1('PEM')
+
+    def encrypt(self, message, key):
+        return rsa.encrypt(message, key)
+
+    def decrypt(self, message, key):
+        ''' Decrypts a message, raises an exception if it can not be decrypted.
+        '''
+        return rsa.decrypt(message, key)
+
+    def sign(self, message, key):
+        return rsa.sign(message, key, 'SHA-256')
+
+    def verify(self, message, signature, key):
+        ''' Returns True if the signature is valid, raises an exception (or returns False) if not.
+        '''
+        return rsa.verify(message, signature, key) == 'SHA-256'
+
+
+class PycryptodomeBackend(object):
+    '''RSA with pycryptodome : OAEP encryption and PSS SHA-256 signatures. The keys are saved in the PKCS#1 PEM format
+    of the ``rsa`` package.
+    '''
+
+    name = 'pycryptodome'
+
+    def newkeys(self, bits):
+        private = RSA.generate(bits)
+        return (private.publickey(), private)
+
+    @functools.lru_cache(maxsize=1024)
+    def load_public_key(self, pem):
+        return RSA.import_key(pem)
+
+    def load_private_key(self, pem):
+        return RSA.import_key(pem)
+
+    def save_public_key(self, key):
+        # pycryptodome only exports public keys as SubjectPublicKeyInfo, the PKCS#1 form is built here
+        return (PEM.encode(DerSequence([key.n, key.e]).encode(), 'RSA PUBLIC KEY') + '\n').encode()
+
+    def save_private_key(self, key):
+        return key.export_key(format='PEM', pkcs=1)
+
+    def encrypt(self, message, key):
+        return PKCS1_OAEP.new(key).encrypt(message)
+
+    def decrypt(self, message, key):
+        return PKCS1_OAEP.new(key).decrypt(message)
+
+    def sign(self, message, key):
+        return pss.new(key).sign(SHA256.new(message))
+
+    def verify(self, message, signature, key):
+        try:
+            pss.new(key).verify(SHA256.new(message), signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+
+BACKENDS = {'rsa': RSABackend(), 'pycryptodome': PycryptodomeBackend()}
+
+
 class Encrypt(object):
     '''
     Parameters
@@ -118,17 +320,25 @@ class Encrypt(object):
         len(args) = 0 : creates Encrypt object with new RSA Private-Public key pair.
         len(args) = 1 : (str) creates Encrypt object with RSA Private-Public keys
         loaded from args[0]_public.pem and args[0]_private.pem
+        len(args) = 2 : (bytes, bytes) creates Encrypt object with the PEM format
+        public and private keys args[0] and args[1] (e.g. taken from a ``keypool.KeyPool``)
+    backend : str (optional)
+        The name of the RSA backend (see ``BACKENDS``), ``CRYPTO_BACKEND`` by default.
 
     '''
     
-    def __init__(self, *args):
+    def __init__(self, *args, backend=None):
       
+        self.backend = BACKENDS[backend or CRYPTO_BACKEND]
         self.private_RSA = 0
         self.public_RSA = 0
         if len(args) == 0:
-            self.public_RSA, self.private_RSA = rsa.newkeys(1024)
+            self.public_RSA, self.private_RSA = self.backend.newkeys(1024)
         elif len(args) == 1:
             self.load_keys(args[0])
+        elif len(args) == 2:
+            self.public_RSA = self.backend.load_public_key(args[0])
+            self.private_RSA = self.backend.load_private_key(args[1])
  
     def save_private_key(self, *args):
         ''' Return/store RSA private key.
@@ -149,9 +359,9 @@ class Encrypt(object):
         '''
         if len(args) == 1:  
             with open(args[0] +'_private.pem', 'wb') as f:
-                f.write(self.private_RSA.save_pkcs1('PEM'))
+                f.write(self.backend.save_private_key(self.private_RSA))
         else:
-            return self.private_RSA.save_pkcs1('PEM')
+            return self.backend.save_private_key(self.private_RSA)
         
     def get_public_key(self, *args):
         ''' Return/store RSA public key.
@@ -172,9 +382,9 @@ class Encrypt(object):
         '''
         if len(args) == 1:
             with open(args[0] +'_public.pem', 'wb') as f:
-                f.write(self.public_RSA.save_pkcs1('PEM'))
+                f.write(self.backend.save_public_key(self.public_RSA))
         else:
-            return self.public_RSA.save_pkcs1('PEM')
+            return self.backend.save_public_key(self.public_RSA)
         
     def save_keys(self, file):
         ''' Saves RSA public and private keys to the files 'file_public.pem' and 'file_private.pem' respectively.
@@ -202,11 +412,13 @@ class Encrypt(object):
 
         Returns
         -------
-        RSA.PublicKey
-            RSA.PublicKey object.
+        object
+            Public key object of the backend.
 
         '''
-        return rsa.PublicKey.load_pkcs1(public_key)
+        if not isinstance(public_key, bytes):
+            public_key = public_key.encode()
+        return self.backend.load_public_key(public_key)
         
     def load_keys(self, file):
         ''' Loads RSA public and private keys from 'file_public.pem' and 'file_private.pem'
@@ -222,9 +434,9 @@ class Encrypt(object):
 
         '''
         with open(file +'_private.pem', 'rb') as f:
-            self.private_RSA = rsa.PrivateKey.load_pkcs1(f.read())
+            self.private_RSA = self.backend.load_private_key(f.read())
         with open(file +'_public.pem', 'rb') as f:
-            self.public_RSA = rsa.PublicKey.load_pkcs1(f.read())
+            self.public_RSA = self.backend.load_public_key(f.read())
             
     def RSA_encrypt(self, message, key):
         ''' RSA encrypts using the PEM format public key provided.
@@ -245,7 +457,7 @@ class Encrypt(object):
         if not isinstance(message, bytes):
             # print(type(message))
             message = message.encode()
-        return rsa.encrypt(message, self.return_public_key_object(key))
+        return self.backend.encrypt(message, self.return_public_key_object(key))
     
     def RSA_decrypt(self, message):
         ''' RSA decrypts using self.private_key
@@ -264,7 +476,7 @@ class Encrypt(object):
         try:
             if not isinstance(message, bytes):
                 message = message.encode()
-            return rsa.decrypt(message, self.private_RSA)
+            return self.backend.decrypt(message, self.private_RSA)
         except:
             return None
         
@@ -284,7 +496,7 @@ class Encrypt(object):
         '''
         if not isinstance(message, bytes):
             message = message.encode()
-        return base64.b64encode(rsa.sign(message, self.private_RSA, 'SHA-256'))
+        return base64.b64encode(self.backend.sign(message, self.private_RSA))
     
     def RSA_verify(self, message, sign, *args):
         ''' Verifies the signature with the message.
@@ -310,11 +522,7 @@ class Encrypt(object):
         if len(args) == 1:
             key = self.return_public_key_object(args[0])
         try:
-            x = rsa.verify(message, sign, key)
-            if x == 'SHA-256':
-                return True
-            else:
-                return False
+            return self.backend.verify(message, sign, key)
         except Exception as e:
             print('Exception in Encrypt.RSA_verify',e)
             return False
@@ -352,6 +560,38 @@ class Encrypt(object):
         except Exception as e:
             print('Exception in Encrypt.encrypt', e)
     
+    def encrypt_many(self, message, keys):
+        ''' Encrypts the message once for several recipients : the message is AES encrypted with a single AES key,
+        and only the AES key is RSA encrypted with the PEM format public key of each recipient.
+
+        Parameters
+        ----------
+        message : str or bytes
+            message that is to be encrypted.
+        keys : dict
+            PEM format public keys (str or bytes) of the recipients, by recipient.
+
+        Returns
+        -------
+        encrypted_message : bytes
+            encrypted message.
+        encrypted_keys : dict
+            base 64 encoded encrypted AES key, by recipient.
+
+        '''
+        try:
+            AES_key = Random.new().read(30)
+            A = AESCipher(AES_key)
+            encrypted_message = A.encrypt(message)
+            encrypted_keys = dict()
+            for recipient, key in keys.items():
+                if not isinstance(key, bytes):
+                    key = key.encode()
+                encrypted_keys[recipient] = base64.b64encode(self.RSA_encrypt(AES_key, key))
+            return (encrypted_message, encrypted_keys)
+        except Exception as e:
+            print('Exception in Encrypt.encrypt_many', e)
+
     def decrypt(self, encrypted_message, encrypted_key):
         '''
 
@@ -377,4 +617,385 @@ class Encrypt(object):
         except Exception as e:
             print('Exception in Encrypt.decrypt',e)
             return None
-        
\ No newline at end of file
+        
+
+
+# The keys of the user in the worker processes of a ``CryptoPool``
+worker_encrypt = None
+
+
+def start_worker(backend, public_key, private_key):
+    global worker_encrypt
+    worker_encrypt = Encrypt(public_key, private_key, backend=backend)
+
+
+def worker_RSA_encrypt(message, key):
+    return worker_encrypt.RSA_encrypt(message, key)
+
+
+def worker_RSA_decrypt(message):
+    return worker_encrypt.RSA_decrypt(message)
+
+
+class CryptoPool(object):
+    '''Runs the encryption and decryption of batches on all the CPUs : the RSA operations in worker processes (the
+    ``rsa`` backend is pure Python, it holds the GIL) and the AES operations in threads (pycryptodome runs them
+    without the GIL). A batch of less than 2 operations is run in the caller.
+
+    Parameters
+    ----------
+    encrypt : Encrypt
+        The RSA keys of the user, the worker processes decrypt with its private key.
+    workers : int (optional)
+        The number of worker processes and of threads.
+
+    '''
+
+    def __init__(self, encrypt, workers=CRYPTO_WORKERS):
+        self.encrypt = encrypt
+        self.workers = workers
+        # Forked explicitly, like the ``keypool.KeyPool`` (the client module can not be re-imported), and right away :
+        # the worker processes are started before the threads of the caller
+        self.processes = concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('fork'), initializer=start_worker,
+            initargs=(encrypt.backend.name, encrypt.get_public_key(), encrypt.save_private_key()))
+        self.processes.submit(int).result()
+        self.threads = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def RSA_encrypt_many(self, message, keys):
+        ''' RSA encrypts a message with the PEM format public key of each recipient.
+
+        Parameters
+        ----------
+        message : bytes
+            message that is to be RSA encrypted.
+        keys : dict
+            PEM format public keys (bytes) of the recipients, by recipient.
+
+        Returns
+        -------
+        dict
+            Encrypted message, by recipient.
+
+        '''
+        recipients = list(keys)
+        if len(recipients) < 2:
+            return {recipient: self.encrypt.RSA_encrypt(message, keys[recipient]) for recipient in recipients}
+        encrypted = self.processes.map(worker_RSA_encrypt, itertools.repeat(message), [keys[r] for r in recipients],
+                                       chunksize=max(1, len(recipients) // (4 * self.workers)))
+        return dict(zip(recipients, encrypted))
+
+    def RSA_decrypt_many(self, messages):
+        ''' RSA decrypts messages with the private key of the user, returns the list of the decrypted messages (None
+        for those which can not be decrypted).
+        '''
+        if len(messages) < 2:
+            return [self.encrypt.RSA_decrypt(message) for message in messages]
+        return list(self.processes.map(worker_RSA_decrypt, messages))
+
+    def map(self, function, *iterables):
+        ''' Returns the list of the results of a function (doing AES operations) called on the items, in threads.
+        '''
+        items = list(zip(*iterables))
+        if len(items) < 2:
+            return [function(*item) for item in items]
+        return list(self.threads.map(function, *zip(*items)))
+
+    def close(self):
+        ''' Stops the worker processes and the threads.
+        '''
+        self.processes.shutdown()
+        self.threads.shutdown()
+
+
+class SessionKeys(object):
+    '''Session keys of a user with its peers, for direct messages.
+
+    The first message sent to a peer starts a session : a new AES key is RSA encrypted with the public key of the
+    peer and sent along with the message and the ID of the key. The following messages are only AES encrypted and
+    carry the key ID, until the key has been used for ``max_messages`` messages or is older than ``max_age``
+    seconds, then a new session starts. In a group, the user has one sending key shared with all the participants,
+    which is also replaced as soon as the participants change (the version of the group). The encrypted key is sent
+    again every ``resend`` messages (it is only RSA encrypted once), so that a peer which has missed the first
+    message of a session, or has dropped the key, can decrypt the following ones.
+
+    The keys received from the peers are kept by sender and key ID, so that a peer can not replace the key of another
+    one, and saved to ``file`` so that their messages can be decrypted after a restart, e.g. when they were stored
+    while the user was offline. The file is encrypted with a key of its own (AES), which is RSA encrypted with the
+    public key of the user : the private key is needed to read it, and it is RSA decrypted once, when it is loaded.
+
+    Parameters
+    ----------
+    encrypt : Encrypt
+        The RSA keys of the user.
+    file : str (optional)
+        The keys of the peers are saved to 'file_sessions.json' (and loaded from it).
+    max_messages : int (optional)
+        Number of messages sent with a key before a new one is used.
+    max_age : int (optional)
+        Age (in seconds) of a key after which a new one is used.
+    resend : int (optional)
+        Number of messages of a session after which its encrypted key is sent again.
+    pool : CryptoPool (optional)
+        Runs the RSA encryption of a new group key for all the participants, and the batches of ``decrypt_messages``,
+        on all the CPUs.
+
+    '''
+
+    def __init__(self, encrypt, file=None, max_messages=SESSION_MESSAGES, max_age=SESSION_AGE, resend=SESSION_RESEND,
+                 pool=None):
+        self.encrypt = encrypt
+        self.pool = pool
+        self.file = file
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.resend = resend
+        # peer (or ('group', group ID)) -> [key ID, AES key, messages sent, creation time, version of the group,
+        # encrypted key (or encrypted keys by participant)]
+        self.sending = dict()
+        # (sender, key ID) -> AES key, the oldest first
+        self.receiving = collections.OrderedDict()
+        # The AES key of the file and the same key RSA encrypted with the public key of the user, made when the file
+        # is first saved
+        self.file_key = None
+        self.wrapped_file_key = None
+        if file is not None:
+            self.load()
+
+    def encrypt_message(self, message, peer, key, binary=False):
+        ''' Encrypts a message for a peer with the current session key, starting a new session if needed.
+
+        Parameters
+        ----------
+        message : str or bytes
+            message that is to be encrypted.
+        peer : int or str
+            The peer the message is sent to.
+        key : str or bytes
+            PEM format public key of the peer.
+        binary : bool (optional)
+            If True the message is bytes (an attachment) and is encrypted to bytes with ``GCMCipher``.
+
+        Returns
+        -------
+        key_id : str
+            ID of the session key.
+        encrypted_message : bytes
+            encrypted message.
+        encrypted_key : bytes or None
+            base 64 encoded encrypted AES key if this message starts a session (or sends the key again), else None.
+
+        '''
+        session, new = self.session(peer)
+        if new:
+            if not isinstance(key, bytes):
+                key = key.encode()
+            session[5] = base64.b64encode(self.encrypt.RSA_encrypt(session[1], key))
+        cipher = GCMCipher(session[1]) if binary else AESCipher(session[1])
+        return (session[0], cipher.encrypt(message), self.shared_key(session))
+
+    def encrypt_group(self, message, group, keys, version, binary=False):
+        ''' Encrypts a message for the participants of a group with the sending key of the user in the group, a new
+        key is used (and shared with the participants) when the participants have changed.
+
+        Parameters
+        ----------
+        message : str or bytes
+            message that is to be encrypted.
+        group : int or str
+            The group the message is sent to.
+        keys : dict
+            PEM format public keys (str or bytes) of the other participants, by participant.
+        version : int
+            The version of the participant list of the group.
+        binary : bool (optional)
+            If True the message is bytes (an attachment) and is encrypted to bytes with ``GCMCipher``.
+
+        Returns
+        -------
+        key_id : str
+            ID of the sending key.
+        encrypted_message : bytes
+            encrypted message.
+        encrypted_keys : dict or None
+            base 64 encoded encrypted AES key, by participant, if the message uses a new key (or sends it again), else
+            None.
+
+        '''
+        session, new = self.session(('group', group), version)
+        if new:
+            keys = {recipient: key if isinstance(key, bytes) else key.encode() for recipient, key in keys.items()}
+            if self.pool is not None:
+                encrypted = self.pool.RSA_encrypt_many(session[1], keys)
+            else:
+                encrypted = {recipient: self.encrypt.RSA_encrypt(session[1], key) for recipient, key in keys.items()}
+            session[5] = {recipient: base64.b64encode(key) for recipient, key in encrypted.items()}
+        cipher = GCMCipher(session[1]) if binary else AESCipher(session[1])
+        return (session[0], cipher.encrypt(message), self.shared_key(session))
+
+    def session(self, peer, version=None):
+        ''' Returns the key used to send the next message to a peer (or a group), after counting the message.
+
+        Parameters
+        ----------
+        peer : int or str or tuple
+            The peer, ('group', group ID) for a group.
+        version : int (optional)
+            The version of the participant list of the group.
+
+        Returns
+        -------
+        session : list
+            key ID, AES key, messages sent, creation time, version of the group and encrypted key(s) (None for a new
+            key, set by the caller).
+        new : bool
+            True if the key is a new one, which has to be shared with the peer(s).
+
+        '''
+        session = self.sending.get(peer)
+        new = (session is None or session[2] >= self.max_messages or time.time() - session[3] >= self.max_age
+               or session[4] != version)
+        if new:
+            session = self.sending[peer] = [Random.new().read(8).hex(), Random.new().read(30), 0, time.time(), version,
+                                            None]
+        session[2] += 1
+        return (session, new)
+
+    def shared_key(self, session):
+        ''' Returns the encrypted key(s) of a session if the message just counted sends them : the first message of
+        the session and then one every ``resend`` messages. None otherwise.
+        '''
+        if (session[2] - 1) % self.resend == 0:
+            return session[5]
+        return None
+
+    def decrypt_message(self, sender, encrypted_message, key_id, encrypted_key=None, binary=False):
+        ''' Decrypts a message of a peer.
+
+        Parameters
+        ----------
+        sender : int or str
+            The peer who has sent the message.
+        encrypted_message : bytes or str
+            encrypted message.
+        key_id : str
+            ID of the session key.
+        encrypted_key : bytes or str (optional)
+            base 64 encoded encrypted AES key, sent with the first message of a session (and again from time to time).
+        binary : bool (optional)
+            If True the message is an attachment encrypted with ``GCMCipher``, decrypted to bytes.
+
+        Returns
+        -------
+        str or bytes or None
+            Decrypted message, None if the session key is unknown (or the attachment has been modified).
+
+        '''
+        try:
+            AES_key = self.receiving.get((str(sender), key_id))
+            if AES_key is None:
+                if encrypted_key is None:
+                    return None
+                AES_key = self.encrypt.RSA_decrypt(base64.b64decode(encrypted_key))
+                if AES_key is None:
+                    return None
+                self.receiving[(str(sender), key_id)] = AES_key
+                if len(self.receiving) > SESSION_KEYS:
+                    self.receiving.popitem(last=False)
+                self.save()
+        except Exception as e:
+            print('Exception in SessionKeys.decrypt_message', e)
+            return None
+        return self.decrypt_with(AES_key, encrypted_message, binary)
+
+    def decrypt_with(self, AES_key, encrypted_message, binary=False):
+        ''' Decrypts a message with its session key. It does not touch the keys of the peers, so it can run in several
+        threads at once.
+
+        Returns
+        -------
+        str or bytes or None
+            Decrypted message, None if the key is None (or the attachment has been modified).
+
+        '''
+        if AES_key is None:
+            return None
+        try:
+            if binary:
+                return GCMCipher(AES_key).decrypt(encrypted_message)
+            return AESCipher(AES_key).decrypt(encrypted_message)
+        except Exception as e:
+            print('Exception in SessionKeys.decrypt_with', e)
+            return None
+
+    def decrypt_messages(self, messages):
+        ''' Decrypts a batch of messages of peers, the new session keys (RSA) and then the messages (AES) on all the
+        CPUs if the keys have a pool.
+
+        Parameters
+        ----------
+        messages : list
+            (sender, encrypted message, key ID, encrypted key or None, binary) of each message, as for
+            ``decrypt_message``.
+
+        Returns
+        -------
+        list
+            The decrypted messages (None for those which can not be decrypted).
+
+        '''
+        if self.pool is None:
+            return [self.decrypt_message(*message) for message in messages]
+        new_keys = dict()
+        for sender, encrypted_message, key_id, encrypted_key, binary in messages:
+            if (str(sender), key_id) not in self.receiving and encrypted_key is not None:
+                new_keys.setdefault((str(sender), key_id), encrypted_key)
+        if new_keys:
+            decrypted = self.pool.RSA_decrypt_many([base64.b64decode(key) for key in new_keys.values()])
+            for received, AES_key in zip(new_keys, decrypted):
+                if AES_key is not None:
+                    self.receiving[received] = AES_key
+        # The keys are resolved here, before the oldest ones are dropped : the threads of the pool only do the AES
+        # decryption, they never change the keys (nor save them)
+        AES_keys = [self.receiving.get((str(message[0]), message[2])) for message in messages]
+        if new_keys:
+            while len(self.receiving) > SESSION_KEYS:
+                self.receiving.popitem(last=False)
+            self.save()
+        if not messages:
+            return []
+        return self.pool.map(self.decrypt_with, AES_keys, [message[1] for message in messages],
+                             [message[4] for message in messages])
+
+    def load(self):
+        ''' Loads the keys of the peers saved in 'file_sessions.json', if any. A file which can not be decrypted with
+        the private key of the user (or saved before the file was encrypted) is ignored.
+        '''
+        try:
+            with open(self.file + '_sessions.json') as f:
+                saved = json.load(f)
+            file_key = self.encrypt.RSA_decrypt(base64.b64decode(saved['key']))
+            if file_key is None:
+                return
+            keys = json.loads(GCMCipher(file_key).decrypt(base64.b64decode(saved['keys'])))
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self.file_key = file_key
+        self.wrapped_file_key = saved['key']
+        for sender, key_id, AES_key in keys:
+            self.receiving[(sender, key_id)] = base64.b64decode(AES_key)
+
+    def save(self):
+        ''' Saves the keys of the peers to 'file_sessions.json', encrypted (written to a temporary file first).
+        '''
+        if self.file is None:
+            return
+        if self.file_key is None:
+            self.file_key = Random.new().read(32)
+            self.wrapped_file_key = base64.b64encode(
+                self.encrypt.RSA_encrypt(self.file_key, self.encrypt.get_public_key())).decode()
+        keys = [[sender, key_id, base64.b64encode(AES_key).decode()] for (sender, key_id), AES_key in self.receiving.items()]
+        encrypted = GCMCipher(self.file_key).encrypt(json.dumps(keys).encode())
+        with open(self.file + '_sessions.json.tmp', 'w') as f:
+            json.dump({'key': self.wrapped_file_key, 'keys': base64.b64encode(encrypted).decode()}, f)
+        os.replace(self.file + '_sessions.json.tmp', self.file + '_sessions.json')
@@ -0,0 +1,477 @@
+'''This module implements the framing layer of the wire protocol shared by the client, the servers and the load balancer.
+
+TCP is a byte stream, so a single ``recv`` can return half a message or several messages glued together. Every
+message is therefore sent as a frame : a 4 byte big-endian length followed by that many bytes of payload (a JSON
+document). Each connection keeps a ``FrameDecoder`` which buffers partial frames across reads and returns every
+complete frame available after a read.
+
+The chat messages of the clients (which carry the encrypted text or image) are sent as envelopes instead : the
+payload starts with ``ENVELOPE``, followed by the 2 byte length of a small JSON routing header (``ROUTING_FIELDS``)
+and the header, the rest of the payload (the body) is the JSON message of the client. The servers route on the
+header only, the body is stored and forwarded as it was received, without being decoded or serialised again. The
+``dest`` of a group message may be a list of participants : its body is encrypted once and carries the key of each
+participant, and a server passes it on once per server with the participants of that server (see ``readdress``).
+
+An image is sent as a binary envelope (``binary`` in the routing header) : the body is the 4 byte length of the JSON
+message, the JSON message and the encrypted bytes of the image, which are never base64 encoded. A binary envelope
+can not be inserted in a JSON list, it is sent to the client as a frame of its own (see ``client_frames``).
+
+Attributes
+----------
+HEADER : struct.Struct
+    The length prefix of a frame (unsigned 32 bit, network byte order)
+
+MAX_FRAME : int
+    The max size of the payload of a single frame
+
+READ_SIZE : int
+    The number of bytes asked from the socket in a single read
+
+MAX_IOV : int
+    The max number of queued buffers handed to the kernel by a single ``sendmsg``
+
+ENVELOPE : bytes
+    The first byte of the payload of an envelope (a JSON payload starts with ``{``, ``[`` or ``"``)
+
+ROUTE : struct.Struct
+    The length prefix of the routing header of an envelope
+
+ROUTING_FIELDS : tuple
+    The fields of a message copied to the routing header of its envelope
+
+ATTACHMENT : struct.Struct
+    The length prefix of the JSON message in the body of a binary envelope
+'''
+
+import collections
+import itertools
+import json
+import select
+import struct
+
+HEADER = struct.Struct('!I')
+MAX_FRAME = 64 * 1048576
+READ_SIZE = 1048576
+MAX_IOV = 1024
+ENVELOPE = b'E'
+ROUTE = struct.Struct('!H')
+ROUTING_FIELDS = ('type', 'dest', 'from', 'group', 'isgroup', 'time')
+ATTACHMENT = struct.Struct('!I')
+
+
+class FrameError(Exception):
+    '''Raised when the peer sends a frame which can not be decoded (for example a length above ``MAX_FRAME``).
+    '''
+
+
+class Envelope(object):
+    '''A chat message received as an envelope. The fields of the routing header can be read like the keys of a dict,
+    the body is kept as a view on the received payload.
+
+    Parameters
+    ----------
+    frame : bytes
+        The payload of the frame (starting with ``ENVELOPE``).
+
+    '''
+
+    def __init__(self, frame):
+        self.frame = memoryview(frame)
+        (length,) = ROUTE.unpack_from(self.frame, len(ENVELOPE))
+        start = len(ENVELOPE) + ROUTE.size
+        self.header = json.loads(bytes(self.frame[start:start + length]))
+        self.body = self.frame[start + length:]
+
+    def __getitem__(self, field):
+        return self.header[field]
+
+    def __contains__(self, field):
+        return field in self.header
+
+    def get(self, field, default=None):
+        return self.header.get(field, default)
+
+    def attachment(self):
+        ''' Returns the JSON message and a view on the bytes of the attachment of a binary envelope.
+        '''
+        (length,) = ATTACHMENT.unpack_from(self.body)
+        start = ATTACHMENT.size
+        return (json.loads(bytes(self.body[start:start + length])), self.body[start + length:])
+
+    def __repr__(self):
+        return 'Envelope({0}, {1} bytes)'.format(self.header, len(self.body))
+
+
+def envelope(message, attachment=None):
+    ''' Builds the payload of an envelope out of a chat message (client side).
+
+    Parameters
+    ----------
+    message : dict
+        The message, its ``ROUTING_FIELDS`` are copied to the routing header.
+    attachment : bytes (optional)
+        Bytes sent after the message as they are, in a binary envelope.
+
+    Returns
+    -------
+    bytes
+        The payload, to be framed by ``encode`` or ``send_message``.
+
+    '''
+    header = {field: message[field] for field in ROUTING_FIELDS if field in message}
+    body = json.dumps(message).encode()
+    if attachment is not None:
+        header['binary'] = 1
+        body = ATTACHMENT.pack(len(body)) + body + attachment
+    header = json.dumps(header).encode()
+    return ENVELOPE + ROUTE.pack(len(header)) + header + body
+
+
+def readdress(message, dest):
+    ''' Returns a copy of an envelope with another ``dest`` in its routing header, the body is copied as it is.
+
+    Parameters
+    ----------
+    message : Envelope
+        The envelope.
+    dest : int or list
+        The new receiver(s).
+
+    Returns
+    -------
+    Envelope
+        The new envelope.
+
+    '''
+    header = json.dumps(dict(message.header, dest=dest)).encode()
+    return Envelope(ENVELOPE + ROUTE.pack(len(header)) + header + message.body)
+
+
+def decode(frame):
+    ''' Decodes the payload of a frame : an ``Envelope`` if it is one, else the JSON document.
+    '''
+    if frame[:len(ENVELOPE)] == ENVELOPE:
+        return Envelope(frame)
+    return json.loads(frame)
+
+
+def serialise(message):
+    ''' Returns the JSON text of a message (the body, as received, for an envelope), e.g. to store it. A binary
+    envelope is returned whole, as bytes.
+    '''
+    if isinstance(message, Envelope):
+        if message.get('binary'):
+            return bytes(message.frame)
+        return bytes(message.body).decode()
+    return json.dumps(message)
+
+
+def client_frames(messages):
+    ''' Splits the messages forwarded to a client into the messages of its frames : JSON lists of consecutive
+    messages, and each binary envelope on its own.
+
+    Parameters
+    ----------
+    messages : list
+        The messages (dicts, JSON strings or envelopes), in the order they are sent.
+
+    Returns
+    -------
+    list
+        The lists and binary envelopes to be framed.
+
+    '''
+    frames = []
+    for message in messages:
+        if isinstance(message, Envelope) and message.get('binary'):
+            frames.append(message)
+        elif frames and isinstance(frames[-1], list):
+            frames[-1].append(message)
+        else:
+            frames.append([message])
+    return frames
+
+
+def encode_parts(message):
+    ''' Builds a frame out of a message, as a list of buffers (the header first) so that the bodies of envelopes are
+    not copied.
+
+    Parameters
+    ----------
+    message : dict, list, str, bytes or Envelope
+        The message to be framed. dicts are serialised to JSON, str is utf-8 encoded. A list is sent as a JSON list,
+        its envelopes are inserted as their bodies. An envelope is sent as it was received.
+
+    Returns
+    -------
+    list
+        The buffers of the length prefixed frame.
+
+    '''
+    if isinstance(message, Envelope):
+        parts = [message.frame]
+    elif isinstance(message, list):
+        parts = [b'[']
+        for item in message:
+            if len(parts) > 1:
+                parts.append(b',')
+            parts.append(item.body if isinstance(item, Envelope) else json.dumps(item).encode())
+        parts.append(b']')
+    else:
+        if isinstance(message, dict):
+            message = json.dumps(message)
+        if isinstance(message, str):
+            message = message.encode()
+        parts = [message]
+    return [HEADER.pack(sum(len(part) for part in parts))] + parts
+
+
+def encode(message):
+    ''' Builds a frame out of a message.
+
+    Parameters
+    ----------
+    message : dict, list, str, bytes or Envelope
+        The message to be framed (see ``encode_parts``).
+
+    Returns
+    -------
+    bytes
+        The length prefixed frame.
+
+    '''
+    return b''.join(encode_parts(message))
+
+
+class FrameDecoder(object):
+    '''Incremental reassembly buffer of a single connection.
+
+    Parameters
+    ----------
+    max_frame : int (optional)
+        Frames announcing a payload larger than this raise ``FrameError``.
+
+    '''
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+        # Complete frames read by ``recv_message`` but not returned yet
+        self.backlog = []
+
+    def feed(self, data):
+        ''' Appends the bytes read from the socket and returns all the frames completed by them.
+
+        Parameters
+        ----------
+        data : bytes
+            Bytes read from the socket.
+
+        Returns
+        -------
+        list of bytes
+            Payloads of the complete frames, in the order they were sent. Incomplete data stays buffered.
+
+        '''
+        self.buffer += data
+        frames = []
+        start = 0
+        end = len(self.buffer)
+        while end - start >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, start)
+            if length > self.max_frame:
+                raise FrameError('Frame of {0} bytes is above the limit of {1} bytes'.format(length, self.max_frame))
+            if end - start - HEADER.size < length:
+                break
+            start += HEADER.size
+            frames.append(bytes(self.buffer[start:start + length]))
+            start += length
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def pending(self):
+        ''' Returns the number of buffered bytes that do not form a complete frame yet.
+        '''
+        return len(self.buffer)
+
+    def take_backlog(self):
+        ''' Returns (and forgets) the complete frames left over by ``recv_message``.
+        '''
+        frames, self.backlog = self.backlog, []
+        return frames
+
+
+def read_frames(sock, decoder, size=READ_SIZE):
+    ''' Reads once from a socket and returns the complete frames.
+
+    Parameters
+    ----------
+    sock : socket.socket
+        The socket to be read.
+    decoder : FrameDecoder
+        The reassembly buffer of this socket.
+    size : int (optional)
+        Max number of bytes to read.
+
+    Returns
+    -------
+    list of bytes
+        Payloads of the complete frames (may be empty if the read only contained part of a frame), preceded by
+        the frames left in the backlog of the decoder.
+
+    Raises
+    ------
+    ConnectionResetError
+        If the peer has closed the connection.
+
+    '''
+    frames = decoder.take_backlog()
+    try:
+        data = sock.recv(size)
+    except BlockingIOError:
+        return frames
+    if not data:
+        raise ConnectionResetError('Connection closed by peer')
+    return frames + decoder.feed(data)
+
+
+def read_messages(sock, decoder, size=READ_SIZE):
+    ''' Same as ``read_frames`` but JSON decodes each payload.
+    '''
+    return [json.loads(frame) for frame in read_frames(sock, decoder, size)]
+
+
+def recv_message(sock, decoder):
+    ''' Waits until one complete frame has arrived on the socket and returns it JSON decoded. Extra frames stay
+    buffered in the backlog of the decoder and are returned by the next calls (of this function or of
+    ``read_frames``).
+
+    Parameters
+    ----------
+    sock : socket.socket
+        The socket to be read (blocking or non-blocking).
+    decoder : FrameDecoder
+        The reassembly buffer of this socket.
+
+    Returns
+    -------
+    dict or list
+        The decoded message.
+
+    '''
+    while not decoder.backlog:
+        select.select([sock], [], [])
+        decoder.backlog = read_frames(sock, decoder)
+    return json.loads(decoder.backlog.pop(0))
+
+
+def send_message(sock, message):
+    ''' Frames the message and writes all of it to the socket, waiting for the socket to be writable if the
+    kernel buffer is full (the socket may be non-blocking).
+
+    Parameters
+    ----------
+    sock : socket.socket
+        The socket to be written.
+    message : dict, list, str, bytes or Envelope
+        The message to be sent.
+
+    Returns
+    -------
+    int
+        Number of bytes written (frame header included).
+
+    '''
+    return send_frames(sock, [message])
+
+
+def send_frames(sock, messages):
+    ''' Same as ``send_message`` for several messages, framed one after the other and written together.
+    '''
+    frame = memoryview(b''.join(encode(message) for message in messages))
+    total = len(frame)
+    while frame:
+        try:
+            sent = sock.send(frame)
+        except BlockingIOError:
+            select.select([], [sock], [])
+            continue
+        frame = frame[sent:]
+    return total
+
+
+class WriteQueue(object):
+    '''Outbound queue of a single connection.
+
+    Frames are queued by ``push`` and written by ``flush`` as far as the kernel accepts them. A partially written
+    buffer stays at the head of the queue and the next ``flush`` resumes from the first unsent byte, so frames are
+    never truncated or interleaved. Several queued frames are written with a single ``sendmsg``, and a frame made of
+    several buffers (see ``encode_parts``) is not copied into one.
+
+    '''
+
+    def __init__(self):
+        self.frames = collections.deque()
+        self.size = 0
+        # The queued messages with the size of their frames, and the number of bytes of the first one already written
+        self.messages = collections.deque()
+        self.written = 0
+
+    def push(self, message):
+        ''' Frames the message and appends it to the queue.
+
+        Parameters
+        ----------
+        message : dict, list, str, bytes or Envelope
+            The message to be sent.
+
+        '''
+        length = 0
+        for part in encode_parts(message):
+            self.frames.append(memoryview(part))
+            length += len(part)
+        self.size += length
+        self.messages.append((message, length))
+
+    def flush(self, sock):
+        ''' Writes the queued bytes until the queue is empty or the socket would block.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The (non-blocking) socket of the connection.
+
+        Returns
+        -------
+        bool
+            True if the queue has been emptied, False if bytes are still pending.
+
+        '''
+        while self.frames:
+            buffers = list(itertools.islice(self.frames, MAX_IOV))
+            try:
+                sent = sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            self.written += sent
+            while self.messages and self.written >= self.messages[0][1]:
+                self.written -= self.messages.popleft()[1]
+            while self.frames and sent >= len(self.frames[0]):
+                sent -= len(self.frames.popleft())
+            if sent:
+                self.frames[0] = self.frames[0][sent:]
+                return False
+        return True
+
+    def pending(self):
+        ''' Returns the number of bytes waiting to be written.
+        '''
+        return self.size
+
+    def unsent(self):
+        ''' Returns the messages whose frames have not been written completely, which the peer has not received, e.g.
+        to store them when the connection breaks.
+        '''
+        return [message for message, length in self.messages]
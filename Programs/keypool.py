@@ -0,0 +1,180 @@
+'''This module hands out RSA key pairs without making the caller wait for them to be generated : generating a key
+pair with the pure Python ``rsa`` backend takes about half a second, which the signup of a user (``Client.register``)
+and the start of the load balancer would otherwise spend before sending anything.
+
+A ``KeyPool`` generates the key pairs in background worker processes (forked, like the worker processes of the
+servers) and keeps up to ``size`` of them ready in a queue. A key pair can also be taken from a stash, a directory of
+key pairs generated beforehand (see ``fill_stash``) : each key pair of the stash is handed out once, to a single
+process, so that many clients started at once (e.g. by the test scripts) do not generate their keys at all. The keys of
+a stash are written in clear to the disk, it is only meant for the test scripts and the benchmarks.
+
+Attributes
+----------
+KEY_BITS : int
+    The size of the RSA keys
+
+KEY_POOL_SIZE : int
+    Default number of key pairs kept ready by a pool, from the ``KEY_POOL_SIZE`` environment variable (1 if it is not
+    set, 0 generates the keys in the caller)
+
+KEY_POOL_WORKERS : int
+    Default number of worker processes of a pool, from the ``KEY_POOL_WORKERS`` environment variable (1 if it is not
+    set)
+
+KEY_STASH : str or None
+    Default stash directory, from the ``KEY_STASH`` environment variable (no stash if it is not set)
+'''
+
+import multiprocessing
+import os
+
+import enc
+
+KEY_BITS = 1024
+KEY_POOL_SIZE = int(os.environ.get('KEY_POOL_SIZE', 1))
+KEY_POOL_WORKERS = int(os.environ.get('KEY_POOL_WORKERS', 1))
+KEY_STASH = os.environ.get('KEY_STASH')
+
+
+def generate(queue, backend, bits):
+    ''' Worker process of a pool : puts new key pairs (PEM format public and private keys) in the queue, waiting while
+    it is full.
+    '''
+    backend = enc.BACKENDS[backend]
+    while True:
+        public, private = backend.newkeys(bits)
+        queue.put((backend.save_public_key(public), backend.save_private_key(private)))
+
+
+class KeyPool(object):
+    '''Key pairs generated in the background, handed out as ``enc.Encrypt`` objects.
+
+    Parameters
+    ----------
+    size : int (optional)
+        The max number of key pairs kept ready, 0 to generate the keys in the caller (without worker processes).
+    workers : int (optional)
+        The number of worker processes generating the keys.
+    stash : str (optional)
+        A stash directory, its key pairs are handed out first.
+    backend : str (optional)
+        The name of the RSA backend (see ``enc.BACKENDS``), ``enc.CRYPTO_BACKEND`` by default.
+    bits : int (optional)
+        The size of the keys.
+
+    '''
+
+    def __init__(self, size=KEY_POOL_SIZE, workers=KEY_POOL_WORKERS, stash=KEY_STASH, backend=None, bits=KEY_BITS):
+        self.backend = backend or enc.CRYPTO_BACKEND
+        self.bits = bits
+        self.stash = stash
+        self.processes = []
+        if size > 0:
+            # Forked explicitly : the client module runs the client when it is imported, it can not be re-imported by
+            # a spawned process
+            context = multiprocessing.get_context('fork')
+            self.queue = context.Queue(size)
+            for i in range(max(workers, 1)):
+                process = context.Process(target=generate, args=(self.queue, self.backend, bits), daemon=True)
+                process.start()
+                self.processes.append(process)
+
+    def take(self):
+        ''' Returns an ``enc.Encrypt`` object with a key pair of the stash, else of the pool (waiting for the workers
+        if none is ready yet), else with a key pair generated now.
+        '''
+        keys = self.take_from_stash()
+        if keys is None and self.processes:
+            keys = self.queue.get()
+        if keys is None:
+            return enc.Encrypt(backend=self.backend)
+        return enc.Encrypt(*keys, backend=self.backend)
+
+    def take_from_stash(self):
+        ''' Returns the PEM format (public key, private key) of a key pair of the stash, and removes it from the
+        stash. None if there is no stash or it is empty.
+        '''
+        if self.stash is None:
+            return None
+        try:
+            names = sorted(os.listdir(self.stash))
+        except FileNotFoundError:
+            return None
+        claimed = '_private.pem.{0}'.format(os.getpid())
+        for name in names:
+            if not name.endswith('_private.pem'):
+                continue
+            path = os.path.join(self.stash, name[:-len('_private.pem')])
+            # The rename is atomic : if another process has claimed the key pair first it fails, and the next one is
+            # tried
+            try:
+                os.rename(path + '_private.pem', path + claimed)
+            except OSError:
+                continue
+            try:
+                with open(path + '_public.pem', 'rb') as f:
+                    public = f.read()
+                with open(path + claimed, 'rb') as f:
+                    private = f.read()
+            except OSError:
+                continue
+            finally:
+                for leftover in (path + '_public.pem', path + claimed):
+                    try:
+                        os.remove(leftover)
+                    except OSError:
+                        pass
+            return (public, private)
+        return None
+
+    def close(self):
+        ''' Stops the worker processes, the key pairs they have generated are dropped.
+        '''
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+
+def fill_stash(stash, count, backend=None, bits=KEY_BITS, workers=None):
+    ''' Generates key pairs into a stash directory, ``<pid>_<n>_public.pem`` and ``<pid>_<n>_private.pem`` for each
+    of them.
+
+    Parameters
+    ----------
+    stash : str
+        The stash directory, created if it does not exist.
+    count : int
+        The number of key pairs added to the stash.
+    backend : str (optional)
+        The name of the RSA backend, ``enc.CRYPTO_BACKEND`` by default.
+    bits : int (optional)
+        The size of the keys.
+    workers : int (optional)
+        The number of processes generating the keys, the number of CPUs by default.
+
+    '''
+    os.makedirs(stash, exist_ok=True)
+    if count <= 0:
+        return
+    pool = KeyPool(size=min(count, 64), workers=workers or os.cpu_count() or 1, stash=None, backend=backend, bits=bits)
+    try:
+        for n in range(count):
+            public, private = pool.queue.get()
+            # Named after the process, so that stashes filled at the same time do not overwrite each other
+            path = os.path.join(stash, '{0}_{1}'.format(os.getpid(), n))
+            # The private key is written last, a key pair is only handed out once both files are there
+            with open(path + '_public.pem', 'wb') as f:
+                f.write(public)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(private)
+            os.replace(path + '.tmp', path + '_private.pem')
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    # python3 keypool.py <STASH_DIRECTORY> <NUM_KEY_PAIRS>
+    import sys
+    fill_stash(sys.argv[1], int(sys.argv[2]))
@@ -1,5 +1,7 @@
 """This file is the code for the load balancer, where clients first connect to. The load balancer has two algorithms, one being a simple round robin method to choose between servers and the other being a method that finds out the load of each server, by checking the number of connections to each server and sending the client to the one with the least number.
 
+The servers report their load (connections, queued work and the lag of their event loop) on the control port `C_PORT`, several times a second, and the load balancer keeps it in memory (`loadreport.LoadView`) : choosing a server never queries the database.
+
 Attributes
 ----------
 L_IP : str
@@ -7,6 +9,9 @@ L_IP : str
 
 L_PORT : int
     The port of the load balancer
+
+C_PORT : int
+    The control port of the load balancer, the port after `L_PORT`, where the servers report their load
     
 START_PORT : int
     The starting port of all the servers, the servers will be connected to consecutive ports starting from the `START_PORT`
@@ -26,6 +31,7 @@ MAX_SIZE : int
 """
 
 import sys
+import os
 import socket
 import selectors
 import types
@@ -33,8 +39,11 @@ import json
 import random
 from itertools import cycle
 import select
-from database import *
+from keypool import KeyPool
 from enc import Encrypt
+import framing
+import loadreport
+import tickets
 
 MAX_SIZE = 1048576
 
@@ -46,6 +55,7 @@ PORT NUMBER OF THE LOADBALANCER IS 9000'''
 L_PORT  = int(sys.argv[1])
 START_PORT = int(sys.argv[2])
 NUM_SERVERS = int(sys.argv[3])
+C_PORT = L_PORT + 1
 L_IP = 'localhost'
 SERVER_POOL = []
 for i in range(NUM_SERVERS):
@@ -89,16 +99,31 @@ class loadbalancer(object):
         self.client_socket.bind((self.IP, self.PORT))
         self.client_socket.listen()
         self.sockets.append(self.client_socket)
+        # The servers connect to the control socket to report their load
+        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.control_socket.setblocking(False)
+        self.control_socket.bind((self.IP, C_PORT))
+        self.control_socket.listen()
+        self.sockets.append(self.control_socket)
+        # Reassembly buffers of the connections of the servers to the control socket
+        self.decoders = dict()
+        # The (server, worker) which reports its load on each of these connections
+        self.reporters = dict()
+        self.loads = loadreport.LoadView()
 
         # Initializes the algorithm it uses to handle client requests
         self.algorithm = algorithm
-        self.encrypt = Encrypt()
-        self.encrypt.save_keys('server_keys')
-
-        self.Database = CentralDatabase()
-
-        # Initializing the numclients table for tallying the number of clients connected to the respective servers
-        # self.Database.init_numclients(NUM_SERVERS)
+        # The key pair of the load balancer is kept in `server_keys_*.pem` (the servers check the tickets with its
+        # public key), it is only made the first time : taken from the stash (`KEY_STASH`) if there is one, else
+        # generated here
+        if os.path.exists('server_keys_private.pem'):
+            self.encrypt = Encrypt('server_keys')
+        else:
+            self.encrypt = KeyPool(size=0).take()
+            self.encrypt.save_keys('server_keys')
+        # The tickets of the servers are signed once and handed out to every client sent to them
+        self.tickets = tickets.TicketCache(self.encrypt)
+        self.tickets.warm([('127.0.0.1' if ip == 'localhost' else ip, port) for ip, port in SERVER_POOL])
         
     def handle(self):
         """This function handles the events regarding the load balancer through a selector, by handling the read and write events separately
@@ -110,10 +135,14 @@ class loadbalancer(object):
                 if sock == self.client_socket:
                     self.accept_connection()
                     break
+                elif sock == self.control_socket:
+                    self.accept_reporter()
+                else:
+                    self.read_reports(sock)
                 
           
     def accept_connection(self):
-        """This function accepts a connection from a client and then forwards it to a particular server (based on the algorithm) with a sign, to verify that it was in fact the load balancer that sent him to that server
+        """This function accepts a connection from a client and then forwards it to a particular server (based on the algorithm) with a ticket (a sign and its expiry), to verify that it was in fact the load balancer that sent him to that server
         """
         client_socket, client_addr = self.client_socket.accept()
         print ("client connected: %s <==> %s" % (client_addr, self.client_socket.getsockname()))
@@ -124,16 +153,65 @@ class loadbalancer(object):
             server_ip = '127.0.0.1'
         
         try:
-            sign = self.encrypt.RSA_sign(server_ip+str(server_port))
-            msg = {'server_ip': server_ip, 'server_port': server_port, 'sign' : sign.decode()}
+            ticket = self.tickets.get(server_ip, server_port)
+            msg = {'server_ip': server_ip, 'server_port': server_port, 'sign': ticket['sign'], 'expires': ticket['expires']}
             print("Server port and address sent to client: ", client_addr)
-            msg = json.dumps(msg)
-            client_socket.send(msg.encode())
+            framing.send_message(client_socket, msg)
             self.close_conn(client_socket)
         except:
             print("Exception occured....closing socket")
             self.close_conn(client_socket)
 
+    def accept_reporter(self):
+        """Accepts the connection of a server process to the control socket, the server reports its load on it
+        """
+        sock, addr = self.control_socket.accept()
+        sock.setblocking(False)
+        self.decoders[sock] = framing.FrameDecoder()
+        self.sockets.append(sock)
+
+    def read_reports(self, sock):
+        """Reads the load samples sent by a server process and stores the last one. The samples of the process are dropped when it disconnects
+
+        Parameters
+        ----------
+        sock : obj
+            The connection of the server process to the control socket
+        """
+        try:
+            frames = framing.read_frames(sock, self.decoders[sock], MAX_SIZE)
+        except (ConnectionError, framing.FrameError):
+            frames = None
+        if frames is None:
+            self.drop_reporter(sock)
+            return
+        for frame in frames:
+            try:
+                sample = framing.decode(frame)
+                self.reporters[sock] = (sample['server'], sample['worker'])
+                self.loads.update(sample)
+            except Exception as e:
+                # A malformed sample only drops the connection of the process which has sent it
+                print("Invalid load sample :", e)
+                self.drop_reporter(sock)
+                return
+
+    def drop_reporter(self, sock):
+        """Closes the connection of a server process to the control socket and forgets the samples of the process
+
+        Parameters
+        ----------
+        sock : obj
+            The connection of the server process to the control socket
+        """
+        self.sockets.remove(sock)
+        self.decoders.pop(sock)
+        reporter = self.reporters.pop(sock, None)
+        if reporter is not None:
+            self.loads.remove(*reporter)
+            print("Server {0} (worker {1}) stopped reporting its load".format(*reporter))
+        sock.close()
+
     def close_conn(self, sock):
         """This function closes the connection from the load balancer between the load balancer and the client
 
@@ -195,31 +273,22 @@ class loadbalancer(object):
 
     # Function to return the IP address and port number of next server
     def min_conn(self):
-        """Queries the database for the server with the least number of connections
+        """Picks the server with the least load reported, from memory. The servers whose event loop lags are only picked when all of them do, and round robin is used until a server has reported its load
 
         Returns
         -------
         tuple
             Returns a tuple of IP, PORT for the server to connect to, in this case, it is the one with the least number of connections
         """
-        server_id = self.Database.get_min_numclients()
-        for i in range(len(SERVER_POOL)):
-            if (SERVER_POOL[i][1] == server_id + START_PORT - 1):
-                return SERVER_POOL[i]
-        return SERVER_POOL[0]
+        address = self.loads.pick()
+        if address is None:
+            return self.round_robin(ITER)
+        return address
 
 
 if __name__ == '__main__':
     try:
         L = loadbalancer('localhost', L_PORT, 'minimum connect') # Making an object of the loadbalancer to run it
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
-        print(next(ITER))
         L.handle()
     except KeyboardInterrupt:
         print ("Ctrl C - Stopping load_balancer")
@@ -0,0 +1,250 @@
+'''This module implements the load reports the servers stream to the load balancer, and the view of the load of the
+servers the load balancer keeps, so that placing a client neither queries the database nor waits for the servers.
+
+Every process of every server keeps a connection to the control port of the load balancer (``LoadReporter``) and
+sends it a sample of its load every ``interval_ms`` milliseconds : its client connections, the work queued on it
+(database queries in flight and the frames held for them) and the lag of its event loop (how late the timer of the
+sample fired). A report is a single small frame : if the socket can not take it right away the sample is skipped, a
+server never waits for the load balancer. The connection is opened again by the next report if it breaks.
+
+The load balancer keeps the last sample of every process (``LoadView``), summed by server, in a heap ordered by load
+(with lazy deletion : an updated server pushes a new entry, the outdated ones are dropped when they reach the top).
+Picking a server is a look at the top of the heap. The clients sent to a server are counted in its load until
+every process of the server has sent a sample since (whichever process accepts a client, its connection is in the
+samples then), so that a burst of clients is spread between the servers instead of all going to the one which was
+the least loaded at the last report. The samples of a process are dropped when its connection closes.
+
+Attributes
+----------
+INTERVAL_MS : int
+    Default time (in milliseconds) between two samples of a server
+
+MAX_LAG_MS : int
+    Default lag of the event loop (in milliseconds) above which a server is overloaded : it only gets clients when
+    every server is
+'''
+
+import collections
+import errno
+import heapq
+import select
+import socket
+import time
+
+import framing
+
+INTERVAL_MS = 500
+MAX_LAG_MS = 100
+
+
+class LoadReporter(object):
+    '''The connection of a server process to the control port of the load balancer, and the timer of its samples.
+
+    Parameters
+    ----------
+    address : tuple
+        The IP address and the control port of the load balancer.
+    interval_ms : int (optional)
+        Time (in milliseconds) between two samples.
+
+    '''
+
+    def __init__(self, address, interval_ms=INTERVAL_MS):
+        self.address = address
+        self.interval = interval_ms / 1e3
+        self.deadline = time.monotonic() + self.interval
+        self.sock = None
+        self.connected = False
+        self.sent = 0
+        self.skipped = 0
+
+    def due(self, now=None):
+        ''' Returns the lag (in seconds) of the timer if a sample is due, and starts the next interval, else None.
+        '''
+        if now is None:
+            now = time.monotonic()
+        if now < self.deadline:
+            return None
+        lag = now - self.deadline
+        self.deadline = now + self.interval
+        return lag
+
+    def timeout(self, now=None):
+        ''' Returns the time (in seconds) until the next sample is due.
+        '''
+        if now is None:
+            now = time.monotonic()
+        return max(0, self.deadline - now)
+
+    def report(self, sample):
+        ''' Sends a sample to the load balancer, without waiting : the sample is skipped if the connection is not open
+        yet or can not take it right away.
+
+        Parameters
+        ----------
+        sample : dict
+            The load of the process.
+
+        Returns
+        -------
+        bool
+            True if the sample has been sent.
+
+        '''
+        if self.sock is None:
+            # The connection has until the next sample to be established
+            self.connect()
+        elif self.writable():
+            frame = framing.encode(sample)
+            try:
+                sent = self.sock.send(frame)
+            except OSError:
+                sent = 0
+            if sent == len(frame):
+                self.sent += 1
+                return True
+            # Part of a frame would leave the stream out of step, the connection is opened again instead
+            self.close()
+        self.skipped += 1
+        return False
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if sock.connect_ex(self.address) not in (0, errno.EINPROGRESS):
+            sock.close()
+            return
+        self.sock = sock
+        self.connected = False
+
+    def writable(self):
+        _, writable, _ = select.select([], [self.sock], [], 0)
+        if not self.connected:
+            # Not established within an interval, or refused
+            if not writable or self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.close()
+                return False
+            self.connected = True
+        return bool(writable)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+
+    def stats(self):
+        ''' Returns the number of samples sent and skipped.
+        '''
+        return {'sent': self.sent, 'skipped': self.skipped}
+
+
+class LoadView(object):
+    '''The last load reported by every process of every server, and the heap of the servers ordered by load.
+
+    Parameters
+    ----------
+    max_lag_ms : int (optional)
+        A server whose event loop lags more than this is overloaded.
+
+    '''
+
+    def __init__(self, max_lag_ms=MAX_LAG_MS):
+        self.max_lag = max_lag_ms
+        # server -> worker -> last sample
+        self.samples = dict()
+        # server -> (IP address, port) of the server
+        self.addresses = dict()
+        # server -> worker -> tick of its last sample
+        self.reported = dict()
+        # server -> ticks of the clients sent to it which are not in the samples of all its workers yet, oldest first
+        self.assigned = dict()
+        # Counts the samples and the picks, so that they can be ordered
+        self.tick = 0
+        # server -> version of its entry in the heap, the other entries of the server are outdated
+        self.versions = dict()
+        self.version = 0
+        self.heap = []
+        self.picks = 0
+
+    def update(self, sample):
+        ''' Stores the sample of a process of a server.
+
+        Parameters
+        ----------
+        sample : dict
+            The sample, as sent by ``LoadReporter.report`` (with the ``ip`` and ``port`` the clients connect to).
+
+        '''
+        server = sample['server']
+        self.tick += 1
+        self.samples.setdefault(server, dict())[sample['worker']] = sample
+        self.reported.setdefault(server, dict())[sample['worker']] = self.tick
+        self.addresses[server] = (sample['ip'], sample['port'])
+        self.assigned.setdefault(server, collections.deque())
+        self.expire(server)
+        self.push(server)
+
+    def expire(self, server):
+        ''' Stops counting the clients sent to a server before the oldest of the last samples of its workers.
+        '''
+        oldest = min(self.reported[server].values())
+        assigned = self.assigned[server]
+        while assigned and assigned[0] < oldest:
+            assigned.popleft()
+
+    def remove(self, server, worker):
+        ''' Drops the sample of a process whose connection has closed, and the server once it has no process left.
+        '''
+        workers = self.samples.get(server, dict())
+        workers.pop(worker, None)
+        self.reported.get(server, dict()).pop(worker, None)
+        if workers:
+            self.expire(server)
+            self.push(server)
+            return
+        self.samples.pop(server, None)
+        self.reported.pop(server, None)
+        self.addresses.pop(server, None)
+        self.assigned.pop(server, None)
+        self.versions.pop(server, None)
+
+    def load(self, server):
+        ''' Returns the sort key of a server : overloaded last, then the fewest connections and the shortest queue.
+        '''
+        workers = self.samples[server].values()
+        connections = len(self.assigned[server]) + sum(sample['connections'] for sample in workers)
+        queue = sum(sample['queue'] for sample in workers)
+        lag = max(sample['lag_ms'] for sample in workers)
+        return (lag > self.max_lag, connections, queue)
+
+    def push(self, server):
+        self.version += 1
+        self.versions[server] = self.version
+        heapq.heappush(self.heap, (self.load(server), self.version, server))
+        if len(self.heap) > 2 * len(self.versions) + 16:
+            # The outdated entries of the loaded servers do not reach the top, they are dropped here
+            self.heap = [entry for entry in self.heap if self.versions.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+
+    def pick(self):
+        ''' Returns the address of the least loaded server, counting a new client on it. None if no server has
+        reported its load.
+        '''
+        while self.heap:
+            load, version, server = self.heap[0]
+            if self.versions.get(server) != version:
+                heapq.heappop(self.heap)
+                continue
+            self.tick += 1
+            self.assigned[server].append(self.tick)
+            self.picks += 1
+            heapq.heappop(self.heap)
+            self.push(server)
+            return self.addresses[server]
+        return None
+
+    def stats(self):
+        ''' Returns the number of servers which report their load and the number of clients placed.
+        '''
+        return {'servers': len(self.addresses), 'picks': self.picks}
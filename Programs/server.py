@@ -13,19 +13,65 @@ ID : int
     
 N : int
     The number of servers that are to be created
+
+ENGINE : str
+    The event loop running the server, `selectors` (default) or `asyncio`. Optional fourth argument
+
+WORKERS : int
+    The number of processes running this server (default 1), they share the port of the server. Optional fifth argument, only with the `selectors` engine
     
 MAX_SIZE : int
     The max size limit for the message
 
+BATCH_BYTES, BATCH_MESSAGES, BATCH_LINGER_US : int
+    The thresholds at which a batch of messages for another server is sent : its size in bytes, its number of messages and the time (in microseconds) its first message has waited. Read from the environment variables of the same names, the defaults are in `batching`
+
+ROUTE_CACHE_SIZE : int
+    The max number of users whose server is cached (environment variable of the same name, the default is in `cache`)
+
+GROUP_CACHE_SIZE : int
+    The max number of groups whose participants are cached (environment variable of the same name, the default is in `cache`)
+
+KEY_CACHE_SIZE : int
+    The max number of public keys of users which are cached (environment variable of the same name, the default is in `cache`)
+
+DB_WORKERS : int
+    The number of threads running the database queries of the clients (environment variable of the same name, the default is in `dbexecutor`), 0 runs them on the event loop
+
+OFFLINE_ROWS, OFFLINE_LINGER_US : int
+    The thresholds at which the messages for offline users are written to the database : their number and the time (in microseconds) the first one has waited. Read from the environment variables of the same names, the defaults are in `writebehind`
+
+BALANCER_PORT : int
+    The port of the load balancer (environment variable of the same name, 9000 if it is not set), the load of the server is reported to the port after it
+
+LOAD_INTERVAL_MS : int
+    The time (in milliseconds) between two reports of the load of the server to the load balancer (environment variable of the same name, the default is in `loadreport`)
+
+INBOX_PAGE, INBOX_PAGE_BYTES : int
+    The max number of unread messages, and of bytes of text messages, sent to a user in one page of its inbox (environment variables of the same names)
+
 """
 import sys
+import os
 import socket
 import selectors
+import asyncio
+import concurrent.futures
 import types
+import collections
 import json
 import datetime
+import functools
+import time
 from database import *
 from enc import Encrypt
+import framing
+import batching
+import cache
+import dbexecutor
+import writebehind
+import loadreport
+import tickets
 import base64
 import hashlib
 
@@ -35,6 +81,8 @@ PORT = int(sys.argv[1])
 IP = '127.0.0.1'
 ID = int(sys.argv[2])
 N = int(sys.argv[3])
+ENGINE = sys.argv[4] if len(sys.argv) > 4 else 'selectors'
+WORKERS = int(sys.argv[5]) if len(sys.argv) > 5 else 1
 
 
 '''
@@ -45,10 +93,23 @@ N = int(sys.argv[3])
 '''
 
 MAX_SIZE = 1048576
+BATCH_BYTES = int(os.environ.get('BATCH_BYTES', batching.MAX_BYTES))
+BATCH_MESSAGES = int(os.environ.get('BATCH_MESSAGES', batching.MAX_MESSAGES))
+BATCH_LINGER_US = int(os.environ.get('BATCH_LINGER_US', batching.LINGER_US))
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', cache.SIZE))
+GROUP_CACHE_SIZE = int(os.environ.get('GROUP_CACHE_SIZE', cache.SIZE))
+KEY_CACHE_SIZE = int(os.environ.get('KEY_CACHE_SIZE', cache.SIZE))
+DB_WORKERS = int(os.environ.get('DB_WORKERS', dbexecutor.DB_WORKERS))
+OFFLINE_ROWS = int(os.environ.get('OFFLINE_ROWS', writebehind.MAX_ROWS))
+OFFLINE_LINGER_US = int(os.environ.get('OFFLINE_LINGER_US', writebehind.LINGER_US))
+BALANCER_PORT = int(os.environ.get('BALANCER_PORT', 9000))
+LOAD_INTERVAL_MS = int(os.environ.get('LOAD_INTERVAL_MS', loadreport.INTERVAL_MS))
+INBOX_PAGE = int(os.environ.get('INBOX_PAGE', 100))
+INBOX_PAGE_BYTES = int(os.environ.get('INBOX_PAGE_BYTES', MAX_SIZE // 2))
 
 class Server(object):
 
-    def __init__(self, IP, PORT, ID, N):
+    def __init__(self, IP, PORT, ID, N, workers=1):
         """This is the initialisation function, to set all the class variables of the class Server
 
         Parameters
@@ -61,34 +122,67 @@ class Server(object):
             The ID of the server
         N : int
             The ID of the server
+        workers : int (optional)
+            The number of processes running this server. The first one (worker 0) holds the connections to the other servers, the others are forked from it once all the servers are inter-connected
         """
         self.IP = IP
         self.PORT = PORT
         self.ID = ID
         self.N = N
+        self.workers = workers
+        # Index of this process among the workers of the server, 0 is the process which was started
+        self.worker = 0
+        # Sockets to the other workers (index -> socket), worker 0 has one per worker, the others only have worker 0
+        self.worker_links = dict()
+        # Users connected to the other workers (user -> index), only kept by worker 0
+        self.worker_users = dict()
         self.encrypt = Encrypt('server_keys')
         # self.context = ssl.create_default_context()
         self.client_sockets = dict()
+        # Reassembly buffers of the frames received on every client and server socket
+        self.decoders = dict()
+        # Outbound queues of every client and server socket
+        self.outboxes = dict()
         self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.bind_listener()
+        # A single selector watches the listening socket, the clients and the other servers
         self.selector = selectors.DefaultSelector()
-        self.server_selector = selectors.DefaultSelector()
         self.read = selectors.EVENT_READ
         self.write = selectors.EVENT_WRITE
         self.selector.register(self.listening_socket, self.read, data=None)
         self.server_sockets = {self.ID: self.listening_socket}
         self.server_sock = []
+        # Sockets connected to the other servers and to the other workers, as opposed to the clients
+        self.links = set()
+        # Messages waiting to be sent on the links
+        self.batcher = batching.Batcher(BATCH_BYTES, BATCH_MESSAGES, BATCH_LINGER_US)
+        # Messages for offline users waiting to be written to the database
+        self.offline = writebehind.WriteBehind(OFFLINE_ROWS, OFFLINE_LINGER_US)
+        # The server each user is connected to (-1 if offline), as read from the database
+        self.routes = cache.LRUCache(ROUTE_CACHE_SIZE)
+        # The participants (set of user IDs) of each group, as read from the database
+        self.groups = cache.LRUCache(GROUP_CACHE_SIZE)
+        # The public keys of the users, which never change once they have registered (so they are never invalidated)
+        self.public_keys = cache.LRUCache(KEY_CACHE_SIZE)
+        # Client sockets in the pending state (waiting for a database query), with the frames they have sent meanwhile
+        self.pending = dict()
+        # Client connections of this process, reported to the load balancer with the rest of its load
+        self.connections = 0
+        self.reporter = loadreport.LoadReporter((IP, BALANCER_PORT + 1), LOAD_INTERVAL_MS)
+        # The tickets of the load balancer already checked (signature, expiry), see `check_ticket`
+        self.tickets = cache.LRUCache(tickets.MEMO_SIZE)
         self.Database = CentralDatabase()
-        self.Database.init_numclients(N)
+        # The database is kept across restarts, the users left connected to this server by its previous run are offline
+        self.Database.reset_server(self.ID)
         self.connect_servers()
+        if self.workers > 1:
+            self.spawn_workers()
 
         # Later change to a database
         # self.user_pass = dict()
         # Creating the database object to access the common database
         self.handle_events()
 
-        # Initializing the numclients table for tallying the number of clients connected to the respective servers
-        
 
     def bind_listener(self, *args):
         """This binds the listening socket to the port and IP of the server, and sets the setblocking parameter to `False` 
@@ -96,6 +190,9 @@ class Server(object):
         if len(args) == 2 and isinstance(args[0], str) and isinstance(args[1], int):
             self.IP = args[0]
             self.PORT = args[1]
+        if self.workers > 1:
+            # The workers of the server each listen on the same port, the kernel spreads the connections between them
+            self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.listening_socket.bind((self.IP, self.PORT))
         self.listening_socket.listen()
         # self.listening_socket = self.context.wrap_socket(self.listening_socket, server_side=True)
@@ -104,6 +201,8 @@ class Server(object):
     def connect_servers(self):
         """This function establishes connections between each pair of servers
         """
+        # The exchange of the IDs has its own selector, the sockets join the main selector once it is over
+        handshake = selectors.DefaultSelector()
         for i in range(1, self.ID):
             if self.ID == 1:
                 break
@@ -112,9 +211,11 @@ class Server(object):
             sock.connect_ex((self.IP, port))
             sock.setblocking(False)
             self.server_sock.append(sock)
+            self.decoders[sock] = framing.FrameDecoder()
+            self.outboxes[sock] = framing.WriteQueue()
             # sock.send(str(self.ID).encode())
             data = types.SimpleNamespace(ID = i, server_name = self.ID, message = '', status = '')
-            self.server_selector.register(sock, self.read | self.write, data = data)
+            handshake.register(sock, self.read | self.write, data = data)
         while len(self.server_sock) < self.N-1:
             events = self.selector.select(timeout=None)
             for key, mask in events:
@@ -126,33 +227,814 @@ class Server(object):
                     # print(Id)
                     # self.server_sockets[Id] = conn
                     self.server_sock.append(conn)
+                    self.decoders[conn] = framing.FrameDecoder()
+                    self.outboxes[conn] = framing.WriteQueue()
                     data = types.SimpleNamespace(ID = Id, server_name = self.ID, message = '', status = '')
-                    self.server_selector.register(conn, self.read | self.write, data = data)
+                    handshake.register(conn, self.read | self.write, data = data)
         n = 0
         x = 0
         while x < self.N-1 or n < self.N-1:
-            events = self.server_selector.select(timeout=None)
+            events = handshake.select(timeout=None)
             for key, mask in events:
                 if mask & self.read:
                     sock = key.fileobj
                     d = key.data
-                    Id = int(sock.recv(1024).decode())
-                    self.server_sockets[Id] = sock
-                    data = types.SimpleNamespace(ID = Id, server_name = self.ID, message = '', status = d.status)
-                    self.server_selector.modify(sock, self.read | self.write, data = data)
-                    n += 1
+                    frames = framing.read_frames(sock, self.decoders[sock])
+                    if frames:
+                        Id = int(frames[0].decode())
+                        # Anything sent right after the ID is kept for server_messages
+                        self.decoders[sock].backlog = frames[1:]
+                        self.server_sockets[Id] = sock
+                        data = types.SimpleNamespace(ID = Id, server_name = self.ID, message = '', status = d.status)
+                        handshake.modify(sock, self.read | self.write, data = data)
+                        n += 1
                 if mask & self.write:
                     if key.data.status != 'none':
                         sock = key.fileobj
                         data = key.data
-                        sock.send(str(self.ID).encode())
+                        sock.send(framing.encode(str(self.ID)))
                         data = key.data
                         data = types.SimpleNamespace(ID = data.ID, server_name = self.ID, message = '', status = 'none')
-                        self.server_selector.modify(sock, self.read | self.write, data = data)
+                        handshake.modify(sock, self.read | self.write, data = data)
                         x += 1
+        # From now on the server sockets are only watched for writing while they have something to send
+        for sock in self.server_sock:
+            data = handshake.get_key(sock).data
+            handshake.unregister(sock)
+            self.selector.register(sock, self.read, data=data)
+            self.links.add(sock)
+        handshake.close()
         #print(self.server_sockets)
         print("All servers are inter-connected")
 
+    def spawn_workers(self):
+        """Forks the other worker processes of this server. Each worker is linked to worker 0 by a socket pair, and the messages for users of this server that are connected to another worker go through worker 0
+        """
+        # The connection to the database must not be shared with the forked processes
+        self.Database.close_connection()
+        for i in range(1, self.workers):
+            link, worker_link = socket.socketpair()
+            if os.fork() == 0:
+                link.close()
+                self.become_worker(i, worker_link)
+                break
+            worker_link.close()
+            self.add_worker_link(i, link)
+        self.Database = CentralDatabase(reset=False)
+        print("Worker {0} of server {1} is running".format(self.worker, self.ID))
+
+    def become_worker(self, index, link):
+        """Sets up a forked worker process : it gets its own selectors and its own listening socket on the port of the server. It is only connected to worker 0, which forwards its messages for the other servers
+
+        Parameters
+        ----------
+        index : int
+            The index of the worker
+        link : obj
+            The socket connected to worker 0
+        """
+        # The selector and sockets inherited from worker 0 are its own, they are closed (not unregistered) here
+        for sock in list(self.worker_links.values()) + self.server_sock:
+            sock.close()
+        self.selector.close()
+        self.listening_socket.close()
+        self.worker = index
+        self.worker_links = dict()
+        self.server_sock = []
+        self.links = set()
+        self.decoders = dict()
+        self.outboxes = dict()
+        self.selector = selectors.DefaultSelector()
+        self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind_listener()
+        self.selector.register(self.listening_socket, self.read, data=None)
+        self.add_worker_link(0, link)
+        # Messages for the other servers go through worker 0
+        self.server_sockets = {self.ID: self.listening_socket}
+        for i in range(1, self.N + 1):
+            if i != self.ID:
+                self.server_sockets[i] = link
+
+    def add_worker_link(self, index, link):
+        """Registers the socket connecting this worker to another worker of the server. It is handled like the sockets connecting the servers
+
+        Parameters
+        ----------
+        index : int
+            The index of the other worker
+        link : obj
+            The socket connected to it
+        """
+        link.setblocking(False)
+        self.worker_links[index] = link
+        self.decoders[link] = framing.FrameDecoder()
+        self.outboxes[link] = framing.WriteQueue()
+        data = types.SimpleNamespace(ID = self.ID, server_name = self.ID, message = '', status = 'none')
+        self.selector.register(link, self.read, data=data)
+        self.links.add(link)
+
+    def add_client(self, user, sock):
+        """Records the socket of a user who has logged in or registered, and tells worker 0 about it
+
+        Parameters
+        ----------
+        user : int
+            The user ID
+        sock : obj
+            The socket of the user
+        """
+        self.client_sockets[user] = sock
+        if self.worker != 0 and 0 in self.worker_links:
+            self.queue_for_link(self.worker_links[0], {'type': 'worker', 'event': 'online', 'user': user, 'worker': self.worker})
+
+    def remove_client(self, user):
+        """Forgets the socket of a user who has disconnected, and tells worker 0 about it
+
+        Parameters
+        ----------
+        user : int
+            The user ID
+        """
+        self.client_sockets.pop(user)
+        if self.worker != 0 and 0 in self.worker_links:
+            self.queue_for_link(self.worker_links[0], {'type': 'worker', 'event': 'offline', 'user': user, 'worker': self.worker})
+
+    def deliver_local(self, user, msg):
+        """Queues a message for a user connected to this server. If the user is connected to another worker process of this server, the message is sent to that worker (through worker 0)
+
+        Parameters
+        ----------
+        user : int
+            The user ID of the receiver
+        msg : dict
+            The message
+
+        Raises
+        ------
+        KeyError
+            If the user is not connected to this server
+        """
+        if user not in self.client_sockets and self.workers > 1:
+            if self.worker == 0:
+                self.queue_for_link(self.worker_links[self.worker_users[user]], msg)
+            else:
+                self.queue_for_link(self.worker_links[0], msg)
+            return
+        sock = self.client_sockets[user]
+        data_n = self.get_key(sock).data
+        if data_n.message == '':
+            data_n.message = []
+        data_n.message.append(msg)
+        data_n.status = 'rm'
+        print(data_n)
+        self.set_state(sock, data_n)
+
+    def queue_for_server(self, server_id, msg):
+        """Queues a message for a user connected to another server, it is sent with the next batch to that server. If the link to that server has been lost, the message is stored in the database as if the user was offline
+
+        Parameters
+        ----------
+        server_id : int
+            The ID of the server of the receiver
+        msg : dict
+            The message
+        """
+        sock = self.server_sockets.get(server_id)
+        if sock is None:
+            self.store(msg)
+            return
+        self.queue_for_link(sock, msg)
+
+    def queue_for_link(self, sock, msg):
+        """Appends a message to the next batch sent on a socket connected to another server (or to another worker)
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+        msg : dict
+            The message
+        """
+        frames = self.batcher.add(sock, msg)
+        if frames is not None:
+            self.send_batch(sock, frames)
+
+    def send_batch(self, sock, frames):
+        """Sends a batch of messages to another server (or to another worker) with a single write
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+        frames : list
+            The payloads of the frames of the batch, one per message
+        """
+        outbox = self.outboxes[sock]
+        for frame in frames:
+            outbox.push(frame)
+        try:
+            outbox.flush(sock)
+        except OSError as e:
+            self.drop_link(sock, e)
+            return
+        self.set_server_state(sock, self.get_server_key(sock).data)
+
+    def drop_link(self, sock, error=None):
+        """Cleans up after a link to another server (or to another worker) which has broken : the socket is closed and forgotten, and the messages still batched or queued for it are stored in the database. From then on, the users of that server (or worker) are handled as offline users, until they log in again
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+        error : Exception (optional)
+            The reason the link has broken
+        """
+        servers = [Id for Id, link in self.server_sockets.items() if link is sock]
+        workers = [index for index, link in self.worker_links.items() if link is sock]
+        print("Lost the connection to servers", servers, "and workers", workers, ":", error)
+        self.close_link(sock)
+        self.links.discard(sock)
+        self.decoders.pop(sock, None)
+        outbox = self.outboxes.pop(sock, None)
+        if sock in self.server_sock:
+            self.server_sock.remove(sock)
+        for Id in servers:
+            del self.server_sockets[Id]
+        for index in workers:
+            del self.worker_links[index]
+            for user in [user for user, worker in self.worker_users.items() if worker == index]:
+                del self.worker_users[user]
+        # The frames queued but not completely written, then the ones still waiting in the batch
+        unsent = outbox.unsent() if outbox is not None else []
+        for frame in unsent + self.batcher.discard(sock):
+            try:
+                self.store(framing.decode(frame))
+            except Exception as e:
+                print('Exception in drop_link', e)
+
+    def close_link(self, sock):
+        """Stops watching a socket connected to another server (or to another worker) and closes it
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+        """
+        self.selector.unregister(sock)
+        sock.close()
+
+    def flush_batches(self):
+        """Sends the batches which have waited long enough (all of them with the default linger time of 0), and writes the messages for offline users if they have waited long enough
+        """
+        for sock, frames in self.batcher.due():
+            self.send_batch(sock, frames)
+        self.write_offline(self.offline.due())
+
+    def next_timeout(self):
+        """Returns the time (in seconds) until the next batch, for another server or for the database, is due. None if nothing is waiting (the report of the load has its own timer, see `report_load`)
+        """
+        delays = [delay for delay in (self.batcher.timeout(), self.offline.timeout()) if delay is not None]
+        return min(delays) if delays else None
+
+    def report_load(self):
+        """Sends a sample of the load of this process to the load balancer, if one is due : its client connections, the queries it is waiting for with the frames held for them, and the lag of its event loop (how late this is called)
+        """
+        lag = self.reporter.due()
+        if lag is None:
+            return
+        queue = self.db_executor.pending() + sum(len(frames) for frames in self.pending.values())
+        self.reporter.report({'type': 'load', 'server': self.ID, 'worker': self.worker, 'ip': self.IP, 'port': self.PORT,
+                              'connections': self.connections, 'queue': queue, 'lag_ms': lag * 1000})
+
+    def store_offline(self, table, row):
+        """Stores a message for an offline user : it is appended to the write-behind buffer, and written to the database with the next batch
+
+        Parameters
+        ----------
+        table : str
+            `messages` for a direct message, `groupmessages` for a group message
+        row : tuple
+            The arguments of `CentralDatabase.insert_message` or `CentralDatabase.insert_group_message`, the receiver second
+        """
+        if not writebehind.valid_row(table, row):
+            # A single bad row would make the insert of the whole batch fail
+            print("Not storing an invalid message :", row)
+            return
+        tables = self.offline.add(table, row)
+        if tables is not None:
+            self.write_offline(tables)
+
+    def write_offline(self, tables):
+        """Writes batches of messages for offline users to the database. The rows are split by the database lane of their receiver, so that they are written before the unread messages of the receiver are read, with one insert (and one commit) per lane and table
+
+        Parameters
+        ----------
+        tables : dict
+            The rows by table, as returned by the write-behind buffer
+        """
+        for table, rows in tables.items():
+            insert = self.Database.insert_messages if table == 'messages' else self.Database.insert_group_messages
+            lanes = collections.OrderedDict()
+            for row in rows:
+                lanes.setdefault(self.db_executor.lane(row[1]), []).append(row)
+            for batch in lanes.values():
+                self.query(insert, (batch,), key=batch[0][1])
+
+    def locate(self, users, callback, fresh=False):
+        """Finds the servers some users are connected to, and calls `callback(servers)` with them. It is called right away if the users are all in the routing cache, else the missing ones are read on a database thread and it is called once they have been (the event loop does not wait for the database)
+
+        Parameters
+        ----------
+        users : list
+            The user IDs
+        callback : callable
+            Called with the server of each user (user -> ID of the server, -1 if the user is offline, -2 if the user has not registered)
+        fresh : bool (optional)
+            If True the database is queried anyway (and the cache updated)
+        """
+        servers = dict()
+        missing = []
+        for user in users:
+            server_id = None if fresh else self.routes.get(user)
+            if server_id is None:
+                missing.append(user)
+            else:
+                servers[user] = server_id
+        if not missing:
+            callback(servers)
+            return
+        self.query(self.Database.check_servers, (missing,), functools.partial(self.located, servers, missing, callback),
+                   key=missing[0])
+
+    def located(self, servers, missing, callback, found, error):
+        """Callback of the query of `locate` : the servers read from the database are cached, and passed to the callback of `locate` with the ones which were cached
+
+        Parameters
+        ----------
+        servers : dict
+            The servers of the users found in the routing cache
+        missing : list
+            The users whose server has been read from the database
+        callback : callable
+            The callback of `locate`
+        found : dict
+            The result of `CentralDatabase.check_servers`
+        error : Exception
+            The exception raised by the query, None if it has succeeded (the users are then not routed)
+        """
+        if error is not None:
+            return
+        for user in missing:
+            server_id = found.get(user, -2)
+            # A user who has not registered yet is not cached, registering does not invalidate anything
+            if server_id != -2:
+                self.routes.put(user, server_id)
+            servers[user] = server_id
+        callback(servers)
+
+    def set_location(self, user, server_id):
+        """Records in the database the server a user is now connected to (-1 when going offline), and tells the other servers to drop it from their routing cache
+
+        Parameters
+        ----------
+        user : int
+            The user ID
+        server_id : int
+            The ID of the server, -1 if the user is going offline
+        """
+        self.routes.put(user, server_id)
+        # The other servers read the database again once they have dropped their entry, they are told once it is written
+        self.query(self.Database.change_server, (user, server_id),
+                   lambda result, error: self.broadcast({'type': 'route', 'user': user}), key=user)
+
+    def membership(self, group_id, callback, sock=None):
+        """Finds the participants of a group and the version of the list, and calls `callback(entry)` with them. It is called right away if the group is in the group cache, else the group is read on a database thread and it is called once it has been
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+        callback : callable
+            Called with the set of the user IDs of the participants (the admin included) and the version of the list. The set is the cached set itself, it must not be modified
+        sock : obj (optional)
+            A client socket which waits in the pending state until the callback has run
+        """
+        entry = self.groups.get(group_id)
+        if entry is not None:
+            callback(entry)
+            return
+        self.query(self.Database.group_members, (group_id,), functools.partial(self.members_fetched, group_id, callback),
+                   sock, key=group_id)
+
+    def members_fetched(self, group_id, callback, result, error):
+        """Callback of `CentralDatabase.group_members` for `membership`, the group is cached and passed to the callback of `membership`
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+        callback : callable
+            The callback of `membership`
+        result : tuple
+            The participants of the group and the version of the list
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        participants, version = result
+        entry = (set(participants), version)
+        self.groups.put(group_id, entry)
+        callback(entry)
+
+    def update_members(self, group_id, participants, version, keys, added=None, removed=None):
+        """Handles a change of the participants of a group, which has just been written to the database and read again (with its new version, see `change_group`) : the group is cached, the other servers are told to drop it from their group cache, and the new participant list (with the public key of the added participant) is pushed to the online participants, so that the key caches of their clients stay up to date without asking for it
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+        participants : list
+            The participants of the group, as read again
+        version : int
+            The version of the list
+        keys : dict
+            The public key of the added participant (empty if none was added)
+        added : int (optional)
+            The user ID of the participant who has been added
+        removed : int (optional)
+            The user ID of the participant who has been removed
+        """
+        # Read again rather than patched, the version of the database is the one the clients compare to
+        self.groups.put(group_id, (set(participants), version))
+        for user_id, key in keys.items():
+            self.public_keys.put(user_id, key)
+        self.broadcast({'type': 'group', 'group': group_id})
+        msg = {'type': 'keys', 'from': 'server', 'message': keys, 'group': group_id, 'version': version,
+               'members': sorted(participants), 'isgroup': 1, 'push': 1, 'response': 0}
+        self.notify(set(participants) | {removed} - {None}, msg)
+
+    def notify(self, users, msg, servers=None):
+        """Sends a message of the server to users who are online (on this server or on another one), offline users are skipped. Every user gets a copy of the message addressed to it
+
+        Parameters
+        ----------
+        users : set
+            The user IDs
+        msg : dict
+            The message
+        servers : dict (optional)
+            The servers of the users, as found by `locate` (which calls this again with them)
+        """
+        if servers is None:
+            self.locate(list(users), functools.partial(self.notify, users, msg))
+            return
+        for user, dest_server in servers.items():
+            try:
+                if dest_server == self.ID:
+                    self.deliver_local(user, dict(msg, dest=user))
+                elif dest_server > 0:
+                    self.queue_for_server(dest_server, dict(msg, dest=user))
+            except Exception as e:
+                print('Exception in notify', e)
+
+    def invalidate(self, msg, source=None):
+        """Drops the cache entry named by an invalidation received from another server (`route` for the server of a user, `group` for the participants of a group), and passes it on : to the other workers of this server, and from a worker to the other servers
+
+        Parameters
+        ----------
+        msg : dict
+            The invalidation
+        source : obj (optional)
+            The link the invalidation was received on
+        """
+        if msg['type'] == 'route':
+            self.routes.invalidate(msg['user'])
+        else:
+            self.groups.invalidate(msg['group'])
+        if source in self.worker_links.values():
+            self.broadcast(msg, source)
+        else:
+            for link in self.worker_links.values():
+                self.queue_for_link(link, msg)
+
+    def broadcast(self, msg, source=None):
+        """Sends a cache invalidation to the other servers and to the other workers of this server
+
+        Parameters
+        ----------
+        msg : dict
+            The invalidation
+        source : obj (optional)
+            The link the invalidation was received on, it is not sent back
+        """
+        # A worker other than worker 0 reaches everybody through worker 0, the set only keeps its link once
+        links = set(sock for Id, sock in self.server_sockets.items() if Id != self.ID)
+        links.update(self.worker_links.values())
+        links.discard(source)
+        for link in links:
+            self.queue_for_link(link, msg)
+
+    def store_or_forward(self, msg, fresh=False, servers=None):
+        """Routes a message for a user who is not connected to this server (any more) : it is sent to the server of the user, or stored in the database if the user is offline
+
+        Parameters
+        ----------
+        msg : dict or framing.Envelope
+            The message
+        fresh : bool (optional)
+            If True the server of the user is read from the database, not from the routing cache
+        servers : dict (optional)
+            The server of the user, as found by `locate` (which calls this again with it)
+        """
+        dest = msg['dest']
+        if servers is None:
+            self.locate([dest], functools.partial(self.store_or_forward, msg, False), fresh)
+            return
+        dest_server = servers[dest]
+        if dest_server > 0 and dest_server != self.ID:
+            self.queue_for_server(dest_server, msg)
+        else:
+            self.store(msg)
+
+    def store(self, msg):
+        """Stores a message in the database for its receivers, who can not be reached : they are offline, or connected to a server whose link has been lost. They get it at their next login
+
+        Parameters
+        ----------
+        msg : dict or framing.Envelope
+            The message, its `dest` is a user ID or a list of them
+        """
+        if msg['type'] in ('keys', 'route', 'group', 'worker'):
+            # A key update for a user who has gone offline is not stored, the client syncs its keys at login. The
+            # invalidations are only meant for the servers
+            return
+        receivers = msg['dest'] if isinstance(msg['dest'], list) else [msg['dest']]
+        for user in receivers:
+            if msg['isgroup'] == 1:
+                self.store_offline('groupmessages', (msg['from'], user, msg['time'], msg['group'], framing.serialise(msg)))
+            else:
+                self.store_offline('messages', (msg['from'], user, msg['time'], framing.serialise(msg)))
+
+    def fan_out(self, msg, receivers, fresh=False, servers=None):
+        """Routes a group message addressed to several participants (an envelope whose `dest` is a list). It is delivered to the participants connected to this server, stored for the offline ones, and sent once to every other server (or worker) with the list of the participants it serves
+
+        Parameters
+        ----------
+        msg : framing.Envelope
+            The message
+        receivers : list
+            The user IDs of the receivers
+        fresh : bool (optional)
+            If True the servers of the receivers are read from the database, not from the routing cache
+        servers : dict (optional)
+            The servers of the receivers, as found by `locate` (which calls this again with them for the receivers which are not connected to this server)
+        """
+        links = dict()
+        remote = []
+        for user in receivers:
+            try:
+                if user in self.client_sockets:
+                    self.deliver_local(user, msg)
+                    continue
+                if user in self.worker_users:
+                    link = self.worker_links[self.worker_users[user]]
+                elif servers is None:
+                    remote.append(user)
+                    continue
+                else:
+                    dest_server = servers[user]
+                    if dest_server > 0 and dest_server != self.ID and dest_server in self.server_sockets:
+                        link = self.server_sockets[dest_server]
+                    elif dest_server == self.ID and self.worker != 0 and 0 in self.worker_links:
+                        # Connected to another worker, worker 0 knows which one
+                        link = self.worker_links[0]
+                    elif dest_server == -2:
+                        print("User ", user, "has not registered")
+                        continue
+                    else:
+                        # Offline, or connected to a server whose link has been lost
+                        self.store_offline('groupmessages', (msg['from'], user, msg['time'], msg['group'], framing.serialise(msg)))
+                        continue
+                links.setdefault(link, []).append(user)
+            except Exception as e:
+                print('Exception in fan_out', e)
+        for link, users in links.items():
+            self.queue_for_link(link, msg if users == msg['dest'] else framing.readdress(msg, users))
+        if remote:
+            self.locate(remote, functools.partial(self.fan_out, msg, remote, False), fresh)
+
+    def route_worker_message(self, RD, source=None):
+        """Handles a batch received from another worker of this server : users connecting to or disconnecting from that worker, and messages to be routed
+
+        Parameters
+        ----------
+        RD : list
+            The decoded batch
+        source : obj (optional)
+            The socket the batch was received on
+        """
+        for msg in RD:
+            if isinstance(msg, str) or isinstance(msg, bytes):
+                msg = json.loads(msg)
+            # The envelopes of the clients are routed on their header, like the other messages
+            if msg['type'] == 'worker':
+                if msg['event'] == 'online':
+                    self.worker_users[msg['user']] = msg['worker']
+                elif self.worker_users.get(msg['user']) == msg['worker']:
+                    self.worker_users.pop(msg['user'])
+                continue
+            if msg['type'] in ('route', 'group'):
+                self.invalidate(msg, source)
+                continue
+            dest = msg['dest']
+            if isinstance(dest, list):
+                self.fan_out(msg, dest)
+                continue
+            try:
+                if dest in self.client_sockets or dest in self.worker_users:
+                    self.deliver_local(dest, msg)
+                elif self.worker != 0:
+                    # The user has left this worker in the meantime, worker 0 knows where it is now
+                    self.queue_for_link(self.worker_links[0], msg)
+                else:
+                    self.store_or_forward(msg)
+            except Exception as e:
+                print('Exception in route_worker_message', e)
+
+    def get_key(self, sock):
+        """Returns the selector key (socket and state) of a client socket
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+
+        Returns
+        -------
+        obj
+            An object with the socket as `fileobj` and its state as `data`
+        """
+        return self.selector.get_key(sock)
+
+    def get_server_key(self, sock):
+        """Same as `get_key`, for the sockets connecting this server to the other servers
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+
+        Returns
+        -------
+        obj
+            An object with the socket as `fileobj` and its state as `data`
+        """
+        return self.selector.get_key(sock)
+
+    def close_client(self, sock):
+        """Stops watching a client socket and closes it
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        """
+        self.selector.unregister(sock)
+        self.decoders.pop(sock, None)
+        self.outboxes.pop(sock, None)
+        self.pending.pop(sock, None)
+        sock.close()
+
+    def set_state(self, sock, data):
+        """Stores the new state of a client socket in the selector. The socket is watched for writing only while a reply or messages are waiting to be sent, so that an idle server does not wake up
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        data : obj
+            The new state of the socket
+        """
+        events = self.read
+        # A socket in the pending state is written to once its query is done (see `resume`)
+        if sock not in self.pending and (data.status in ('reply', 'rm', 'close') or self.outboxes[sock].pending()):
+            events |= self.write
+        self.selector.modify(sock, events, data=data)
+
+    def set_server_state(self, sock, data):
+        """Same as `set_state`, for the sockets connecting this server to the other servers
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the other server
+        data : obj
+            The new state of the socket
+        """
+        events = self.read
+        if self.outboxes[sock].pending():
+            events |= self.write
+        self.selector.modify(sock, events, data=data)
+
+    def send(self, sock, message):
+        """Queues a frame on a socket and writes as much of the queue as the socket accepts right now
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client or of the other server
+        message : dict, list, str or bytes
+            The message to be sent
+
+        Returns
+        -------
+        bool
+            `True` if everything queued on the socket has been written. A broken connection is reported by the next flush of the socket
+        """
+        return self.send_frames(sock, [message])
+
+    def send_frames(self, sock, messages):
+        """Same as `send` for several messages, one frame each, written together
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client or of the other server
+        messages : list
+            The messages to be sent
+
+        Returns
+        -------
+        bool
+            `True` if everything queued on the socket has been written
+        """
+        outbox = self.outboxes[sock]
+        for message in messages:
+            outbox.push(message)
+        try:
+            return outbox.flush(sock)
+        except OSError:
+            return False
+
+    def query(self, function, args=(), callback=None, sock=None, key=None, prefetched=False):
+        """Runs a database query on a thread of the database executor, the event loop goes on serving the other sockets. `callback(result, error)` is run by the event loop once the query is done
+
+        Parameters
+        ----------
+        function : callable
+            The query, usually a method of `self.Database`. It runs on another thread, it must not use the state of the server
+        args : tuple (optional)
+            The arguments of the query
+        callback : callable (optional)
+            Called with the result of the query, and the exception it has raised (None if it has succeeded)
+        sock : obj (optional)
+            A client socket which waits for the query in the pending state : the frames it sends in the meantime are held, and nothing is written to it, until the callback has run
+        key : obj (optional)
+            The queries with the same key (e.g. the user they are about) run in the order they were submitted
+        prefetched : bool (optional)
+            If True the first frame held by the socket has been looked up by the query (see `prefetch`)
+        """
+        if sock is not None:
+            self.pending.setdefault(sock, [])
+            callback = functools.partial(self.resume, sock, callback, prefetched)
+        self.db_executor.submit(function, args, callback, key)
+
+    def resume(self, sock, callback, prefetched, result, error):
+        """Runs the callback of the query a client socket was waiting for, then handles the frames it has sent in the meantime, in order
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        callback : callable
+            The callback of the query
+        prefetched : bool
+            If True the first held frame has been looked up by the query
+        result : obj
+            The result of the query
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        held = self.pending.pop(sock, None)
+        if held is None:
+            # The socket has been closed in the meantime
+            return
+        if callback is not None:
+            try:
+                callback(result, error)
+            except Exception as e:
+                # The frames held meanwhile are still handled
+                print('Exception in the callback of a database query', e)
+        try:
+            key = self.get_key(sock)
+        except (KeyError, ValueError):
+            return
+        # What has been queued for the client while it was pending
+        self.set_state(sock, key.data)
+        if held:
+            self.handle_frames(sock, held, prefetched)
+
     def register_client(self, key, details):
         """This function takes care of the registration of the client (for the first time only, after that it is authentication)
 
@@ -164,54 +1046,61 @@ class Server(object):
             Is a JSON object which has the information about the message sent by the client to the server, namely, the user and the encrypted password
         """
         sock = key.fileobj
-        data = key.data
         try:
-            if (not self.Database.check_user(details['user'])):
-                # Commenting out the following line because no need to use dictionary - using database instead
-                # self.user_pass[details['user']] = details['password']
-
-                # Need to put the appropriate server ID as the third parameter
-                pasw = details['password']
-                if not isinstance(pasw, bytes):
-                    pasw = pasw.encode()
-                pasw = base64.b64encode(hashlib.sha256(pasw).digest()).decode()
-            
-                output = self.Database.insert_newuser(
-                    details['user'], pasw , self.ID, details['public_key'])
-                if (output == True):
-                    print("User Registered successfully!!")
-                else:
-                    print("User registration unsuccessful")
-
-                msg = {'type': 'server reply',
-                    'server_message': 'Registered and Connected', 'response': 0}
-                self.client_sockets[details['user']] = sock
-
-                # Commenting out the following line because no need to use dictionary - using database instead
-                # self.user_pass[details['user']] = details['password']
-                msg = json.dumps(msg)
-                data = types.SimpleNamespace(addr=data.addr, status='reply', response=0,
-                                            user=details['user'], server_name=self.ID, message=msg)
-                self.selector.modify(sock, self.read | self.write, data=data)
-            else:
-                msg = {'type': 'server reply',
-                    'server_message': 'User already present! Choose different username', 'response': 1}
-                msg = json.dumps(msg)
-                data = types.SimpleNamespace(addr=data.addr, status='reply', response=1,
-                                            user=details['user'], server_name=self.ID, message=msg)
-                self.selector.modify(sock, self.read | self.write, data=data)
+            # Commenting out the following line because no need to use dictionary - using database instead
+            # self.user_pass[details['user']] = details['password']
+            pasw = details['password']
+            if not isinstance(pasw, bytes):
+                pasw = pasw.encode()
+            pasw = base64.b64encode(hashlib.sha256(pasw).digest()).decode()
+            # Nothing is inserted if the user is already present, the connection waits for the answer
+            self.query(self.Database.insert_newuser, (details['user'], pasw, self.ID, details['public_key']),
+                       functools.partial(self.registered, sock, details), sock, key=details['user'])
         except Exception as e:
             print("Exception in register client ", e)
 
-    def authenticate_client(self, key, mask):
+    def registered(self, sock, details, output, error):
+        """Callback of the insertion of a new user : the user is connected, or the registration is rejected
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        details : dict
+            The sign up frame sent by the client
+        output : bool
+            The result of `CentralDatabase.insert_newuser`, False if the user was already present
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        data = self.get_key(sock).data
+        if (output == True):
+            self.routes.put(details['user'], self.ID)
+            self.public_keys.put(details['user'], details['public_key'])
+            print("User Registered successfully!!")
+            msg = {'type': 'server reply',
+                'server_message': 'Registered and Connected', 'response': 0}
+            self.add_client(details['user'], sock)
+        elif error is not None:
+            print("User registration unsuccessful", error)
+            msg = {'type': 'server reply',
+                'server_message': 'User registration unsuccessful', 'response': 1}
+        else:
+            msg = {'type': 'server reply',
+                'server_message': 'User already present! Choose different username', 'response': 1}
+        data = types.SimpleNamespace(addr=data.addr, status='reply', response=msg['response'],
+                                     user=details['user'], server_name=self.ID, message=json.dumps(msg))
+        self.set_state(sock, data)
+
+    def authenticate_client(self, key, recv_data):
         """This function authenticates the client if it has already been registered, with it's password and ID
 
         Parameters
         ----------
         key : obj
             Contains information about the socket between the client and the server, and also the data that will be communicated through that socket
-        mask : obj
-            Gives information about what type of operation must be performed, whether it is a read operation or a write operation
+        recv_data : dict
+            The (decoded) login or sign up frame sent by the client
 
         Raises
         ------
@@ -220,14 +1109,11 @@ class Server(object):
         """
         sock = key.fileobj
         data = key.data
-        recv_data = json.loads(sock.recv(MAX_SIZE))
         try:
             if(recv_data['user']=='close'):
-                self.Database.update_numclients(self.ID, -1)
-                self.selector.unregister(sock)
-                # Updates the num clients table 
+                self.connections -= 1
+                self.close_client(sock)
                 print('Deregistered before registering')
-                sock.close()
                 return
                 
             user = recv_data['user']
@@ -235,55 +1121,77 @@ class Server(object):
             if not isinstance(pasw, bytes):
                 pasw = pasw.encode()
             pasw = base64.b64encode(hashlib.sha256(pasw).digest()).decode()
-            sign = recv_data['sign']
-            M = self.IP + str(self.PORT)
-            if not self.encrypt.RSA_verify(M, sign):
-                self.selector.unregister(sock)
+            if not self.check_ticket(recv_data['sign'], recv_data.get('expires')):
                 print('Malicious attempt..., Closing socket')
-                sock.close()
+                self.connections -= 1
+                self.close_client(sock)
                 return
-            # To throw an error if the user, password do not match the records in database
-            if (not self.Database.check_cred(user, pasw)):
-                raise KeyError
-
-            # If the message is for logging into the account
-            if self.Database.check_cred(user, pasw) and recv_data['type'] == 'login':
-                self.client_sockets[user] = sock
-                self.Database.change_server(user, self.ID)
-                msg = {'type': 'server reply',
-                       'server_message': 'Succesful Login!', 'response': 0}
-                msg = json.dumps(msg)
-                data = types.SimpleNamespace(addr=data.addr, status='reply', response=0,
-                                             user=user, server_name=self.ID, message=msg)
-                self.selector.modify(sock, self.read | self.write, data=data)
-
+            # If the message is for logging into the account, the connection waits for the credentials to be checked
+            if recv_data['type'] == 'login':
+                self.query(self.Database.check_cred, (user, pasw), functools.partial(self.logged_in, sock, user),
+                           sock, key=user)
             # If the message is for registering a new user
             elif recv_data['type'] == 'new':
                 self.register_client(key, recv_data)
-            # (Redundant) If the user, password is not present in the database
-            elif recv_data['type'] == 'login':
-                msg = {'type': 'server reply',
-                       'server_message': 'Invalid Login! Authentication failed.', 'response': 1}
-                msg = json.dumps(msg)
-                data = types.SimpleNamespace(addr=data.addr, status='reply', response=1,
-                                             user=user, server_name=self.ID, message=msg)
-                self.selector.modify(sock, self.read | self.write, data=data)
         except Exception as e:
-            # If the message is for registering a new user
-            if recv_data['type'] == 'new':
-                self.register_client(key, recv_data)
+            print("Exception occured in authenticate client", e)
             # If the user, password is not present in the database
-            elif recv_data['type'] == 'login':
-                print("Exception occured in authenticate client", e)
-                msg = {'type': 'server reply',
-                       'server_message': 'Invalid Login! Authentication failed.', 'response': 1}
-                msg = json.dumps(msg)
-                data = types.SimpleNamespace(addr=data.addr, status='reply', response=1,
-                                             user=user, server_name=self.ID, message=msg)
-                self.selector.modify(sock, self.read | self.write, data=data)
+            if recv_data['type'] == 'login':
+                self.logged_in(sock, recv_data['user'], False, e)
+
+    def check_ticket(self, sign, expires):
+        """Checks the ticket given to a client by the load balancer : it has not expired, and it is signed by the load balancer for this server. The signature of a ticket is only verified the first time it is seen, every client sent to this server carries the same ticket until the load balancer renews it
+
+        Parameters
+        ----------
+        sign : str
+            The signature of the ticket
+        expires : int
+            The time the ticket expires at (seconds since the epoch)
+
+        Returns
+        -------
+        bool
+            `True` if the ticket is valid
+        """
+        if not isinstance(expires, int) or expires <= time.time():
+            return False
+        if self.tickets.get((sign, expires)):
+            return True
+        if not self.encrypt.RSA_verify(tickets.ticket_message(self.IP, self.PORT, expires), sign):
+            return False
+        self.tickets.put((sign, expires), True)
+        return True
+
+    def logged_in(self, sock, user, valid, error):
+        """Callback of the check of the credentials of a login : the user is logged in, or the login is rejected
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        user : int
+            The user ID
+        valid : bool
+            The result of `CentralDatabase.check_cred`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        data = self.get_key(sock).data
+        if valid:
+            self.add_client(user, sock)
+            self.set_location(user, self.ID)
+            msg = {'type': 'server reply',
+                   'server_message': 'Succesful Login!', 'response': 0}
+        else:
+            msg = {'type': 'server reply',
+                   'server_message': 'Invalid Login! Authentication failed.', 'response': 1}
+        data = types.SimpleNamespace(addr=data.addr, status='reply', response=msg['response'],
+                                     user=user, server_name=self.ID, message=json.dumps(msg))
+        self.set_state(sock, data)
 
     def accept_wrapper(self, sock):
-        """This function accepts the initial condition from the client, before it is authenticated by the server. It also calls the function to update the numclients table, which gives us an idea on the load of the servers
+        """This function accepts the initial condition from the client, before it is authenticated by the server. It also counts the connection in the load reported to the load balancer
 
         Parameters
         ----------
@@ -291,85 +1199,141 @@ class Server(object):
             The socket used for communication between client and server, before authentication
         """
         conn, addr = sock.accept()
-         # Updates the num clients table
-        self.Database.update_numclients(self.ID , 1)
+        self.connections += 1
         print(f"Accepted connection from {addr}")
         # Code to send pending messages to the user
         conn.setblocking(False)
+        self.decoders[conn] = framing.FrameDecoder()
+        self.outboxes[conn] = framing.WriteQueue()
         data = types.SimpleNamespace(addr=addr, status='auth', response=0,
                                      user='', server_name=self.ID, message='')
-        self.selector.register(conn, self.read | self.write, data=data)
+        self.selector.register(conn, self.read, data=data)
 
-    def server_messages(self):
+    def service_link(self, key, mask):
         """This function is used to send messages between servers, since all the servers are connected to each other. This is essential to be able to send messages between two clients who are not connected to the same server
+
+        Parameters
+        ----------
+        key : obj
+            The selector key of the socket connected to the other server (or to another worker)
+        mask : obj
+            The events the socket is ready for
         """
-        events = self.server_selector.select(timeout=None)
-        for key, mask in events:
-            if mask & self.read:
-                sock = key.fileobj
-                serverID = key.data
-                message = sock.recv(MAX_SIZE)
-                if str(message) != '':
-                    print("Server Message : ", message)
-                RD = json.loads(message)
-
-                for recv_data in RD:
-                    try:
-                        if isinstance(recv_data, str) or isinstance(recv_data, bytes):
-                            recv_data = json.loads(recv_data)
-                    except Exception as e:
-                        print('Exception in server_messages [1]', e)
-                    if recv_data['dest'] in self.client_sockets.keys():
-                        sock = self.client_sockets[recv_data['dest']]
-                        KEY = self.selector.get_key(sock)
-                        data_n = KEY.data
-                        print(recv_data)
-                        msg = recv_data
-                        # if (recv_data['isgroup'] == 0):
-                        #     msg = {'type': 'msg', 'dest': recv_data['dest'], 'from': recv_data['from'],
-                        #        'message': recv_data['message'], 'time': recv_data['time'], 'isgroup': recv_data['isgroup'], 'response': 0, 'key' : recv_data['key']}
-                        # else:
-                        #     msg = {'type': 'msg', 'dest': recv_data['dest'], 'from': recv_data['from'], 'group': recv_data['group'],
-                        #        'message': recv_data['message'], 'time': recv_data['time'], 'isgroup': recv_data['isgroup'], 'response': 0, 'key' : recv_data['key']}
-                        if data_n.message == '':
-                            data_n.message = []
-                        data_n.message.append(msg)
-                        data_n.status = 'rm'
-                        self.selector.modify(
-                            sock, self.read | self.write, data=data_n)
-                    else:
-                        # store in database
-                        a = 1
-            elif mask & self.write and key.data.status == 'msg':
-                sock = key.fileobj
-                data = key.data
-                sock.send(json.dumps(data.message).encode())
-                data_n = data
-                data_n.status = 'none'
-                data_n.message = ''
-                self.server_selector.modify(
-                    sock, self.read | self.write, data=data_n)
+        sock = key.fileobj
+        if mask & self.read:
+            try:
+                frames = framing.read_frames(sock, self.decoders[sock], MAX_SIZE)
+            except (ConnectionError, framing.FrameError) as e:
+                self.drop_link(sock, e)
+                return
+            for message in frames:
+                print("Server Message : ", message)
+                # A frame is either a single message (an envelope or a JSON object) or a JSON list of messages
+                RD = framing.decode(message)
+                if not isinstance(RD, list):
+                    RD = [RD]
+                if sock in self.worker_links.values():
+                    self.route_worker_message(RD, sock)
+                else:
+                    self.route_server_message(RD)
+        if mask & self.write:
+            # The batches are queued by `send_batch`, what is left here is the end of a partial write
+            try:
+                self.outboxes[sock].flush(sock)
+            except OSError as e:
+                self.drop_link(sock, e)
+                return
+            self.set_server_state(sock, key.data)
+
+    def route_server_message(self, RD):
+        """Delivers a batch of messages received from another server to the clients connected to this server
+
+        Parameters
+        ----------
+        RD : list
+            The decoded batch, each element is a message (dict, JSON string or envelope)
+        """
+        for recv_data in RD:
+            try:
+                if isinstance(recv_data, str) or isinstance(recv_data, bytes):
+                    recv_data = json.loads(recv_data)
+            except Exception as e:
+                print('Exception in server_messages [1]', e)
+            if recv_data['type'] in ('route', 'group'):
+                # A user has logged in or out on the other server, or a group has changed there : the next lookup reads
+                # the database again
+                self.invalidate(recv_data)
+                continue
+            if isinstance(recv_data['dest'], list):
+                # The participants of a group message served by this server, the ones who have moved are looked up again
+                self.fan_out(recv_data, recv_data['dest'], fresh=True)
+                continue
+            if recv_data['dest'] in self.client_sockets.keys() or recv_data['dest'] in self.worker_users:
+                print(recv_data)
+                msg = recv_data
+                # if (recv_data['isgroup'] == 0):
+                #     msg = {'type': 'msg', 'dest': recv_data['dest'], 'from': recv_data['from'],
+                #        'message': recv_data['message'], 'time': recv_data['time'], 'isgroup': recv_data['isgroup'], 'response': 0, 'key' : recv_data['key']}
+                # else:
+                #     msg = {'type': 'msg', 'dest': recv_data['dest'], 'from': recv_data['from'], 'group': recv_data['group'],
+                #        'message': recv_data['message'], 'time': recv_data['time'], 'isgroup': recv_data['isgroup'], 'response': 0, 'key' : recv_data['key']}
+                self.deliver_local(recv_data['dest'], msg)
+            else:
+                # The user has moved since the other server looked it up (its cache was not invalidated yet),
+                # the database is read again so that the message does not bounce between stale caches
+                try:
+                    self.store_or_forward(recv_data, fresh=True)
+                except Exception as e:
+                    print('Exception in route_server_message', e)
 
     def handle_events(self):
         """This is the function that handles the different events that can occur. It first reads from the selector, and then depending on the event, it decides to receive or send messages.
+
+        The listening socket, the clients and the other servers share one selector. Every ready socket is serviced once per round (a single read of at most `MAX_SIZE` bytes, a single flush), so a busy server link does not hold back the clients, nor the other way round.
         """
+        self.db_executor = dbexecutor.DBExecutor(DB_WORKERS)
+        # The database threads wake the loop up through the executor when a query is done
+        self.selector.register(self.db_executor, self.read, data=None)
         try:
             while True:
-                self.server_messages()
-                events = self.selector.select(timeout=None)
+                # Sockets are only watched for writing while they have something to send, an idle server sleeps here
+                # unless a batch for another server is waiting for its linger time
+                timeout = min(delay for delay in (self.next_timeout(), self.reporter.timeout()) if delay is not None)
+                events = self.selector.select(timeout=timeout)
                 for key, mask in events:
-                    if key.data is None:
+                    if key.fileobj is self.db_executor:
+                        self.db_executor.run_callbacks()
+                    elif key.data is None:
                         self.accept_wrapper(key.fileobj)
+                    elif key.fileobj in self.links:
+                        self.service_link(key, mask)
                     elif mask & self.read:
                         self.service_connection(key, mask)
                     elif mask & self.write and key.data.status == 'reply':
                         self.reply(key)
                     elif mask & self.write and key.data.status == 'rm':
                         self.forward(key)
+                    elif mask & self.write:
+                        self.flush(key)
+                # The messages routed to the other servers during this round leave together
+                self.flush_batches()
+                self.report_load()
 
         except KeyboardInterrupt:
             print("Caught keyboard interrupt, exiting")
         finally:
+            print("Batches sent to the other servers :", self.batcher.stats())
+            print("Routing cache :", self.routes.stats())
+            print("Group cache :", self.groups.stats())
+            print("Key cache :", self.public_keys.stats())
+            print("Checked tickets :", self.tickets.stats())
+            # The messages for offline users still buffered are written before the database threads stop
+            self.write_offline(self.offline.take())
+            print("Offline messages written :", self.offline.stats())
+            print("Database queries :", self.db_executor.stats())
+            print("Load reports :", self.reporter.stats())
+            self.reporter.close()
+            self.db_executor.close()
             self.selector.close()
 
     def reply(self, key):
@@ -384,43 +1348,152 @@ class Server(object):
         sock = key.fileobj
         data = key.data
         print(data.message)
-        sock.send(data.message.encode())
+        self.send(sock, data.message)
         data_message = json.loads(data.message)
         if (type(data_message) == dict and data_message['server_message'] == 'Succesful Login!'):
             print("The user is {0}".format(int(data.user)))
-            unread_messages = self.Database.show_message(int(data.user))
-            unread_group_messages = self.Database.show_group_message(int(data.user))
-            print("Querying from tables inside the reply function")
-            if (unread_messages or unread_group_messages):
-                print("Sending unsent messages")
-                lst_unread = []
-                for message in unread_messages:
-                    #msg_unread = {'type': 'msg', 'from': message[0], 'message': message[3], 'time': message[2], 'isgroup': 0, 'response': 0}
-                    # sock.send(json.dumps(msg_unread).encode())
-                    msg_unread = message[3]
-                    lst_unread.append(msg_unread)
-                for message in unread_group_messages:
-                    #msg_unread = {'type': 'msg', 'from': message[0], 'group': message[1], 'message': message[3], 'time': message[2], 'isgroup': 1, 'response': 0}
-                    msg_unread = message[3]
-                    lst_unread.append(msg_unread)
-            
-                data = types.SimpleNamespace(addr=data.addr, status='rm', response=0,
-                                             user=data.user, server_name=self.ID, message=lst_unread)
-                self.selector.modify(sock, self.read | self.write, data=data)
-            else:
-                data = types.SimpleNamespace(addr=data.addr, status='msg', response=0,
-                                             user=data.user, server_name=self.ID, message='')
-                self.selector.modify(sock, self.read | self.write, data=data)
+            data = types.SimpleNamespace(addr=data.addr, status='msg', response=0,
+                                         user=data.user, server_name=self.ID, message='')
+            self.set_state(sock, data)
+            # Only the number of unread messages is read at login, the client then fetches them page by page (see
+            # `inbox`). It is read on a database thread after the messages stored for the user before (the buffered
+            # ones are written first)
+            self.write_offline(self.offline.take())
+            self.query(self.Database.inbox_counts, (int(data.user),), functools.partial(self.send_inbox_counts, sock), sock,
+                       key=int(data.user))
         elif data.response == 1:
-            self.selector.unregister(sock)
-            sock.close()
-            # Updates the num clients table 
-            self.Database.update_numclients(self.ID, -1)
-            print('Deregistered')
+            # The socket is closed by `flush` once the rejection has been written completely
+            data.status = 'close'
+            self.flush(key)
         else:
             data = types.SimpleNamespace(addr=data.addr, status='msg', response=0,
                                          user=data.user, server_name=self.ID, message='')
-            self.selector.modify(sock, self.read | self.write, data=data)
+            self.set_state(sock, data)
+
+    def send_inbox_counts(self, sock, counts, error):
+        """Callback of `inbox_counts` : the numbers of unread messages are sent to the user, before the messages received for the user in the meantime. The client fetches the messages themselves with `inbox` requests
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        counts : dict
+            The result of `inbox_counts`
+        error : Exception
+            The exception raised by the query, None if it has succeeded (the client is then told to fetch the first
+            page anyway)
+        """
+        if error is not None:
+            print("Could not count the unread messages :", error)
+            msg = {'type': 'inbox', 'from': 'server', 'error': str(error), 'ack': [], 'after': 0, 'more': True,
+                   'isgroup': 0, 'response': 0}
+            self.queue_for_client(sock, [msg])
+            return
+        unread = sum(counts['direct'].values()) + sum(counts['groups'].values())
+        msg = {'type': 'inbox', 'from': 'server', 'unread': unread, 'direct': counts['direct'], 'groups': counts['groups'],
+               'ack': [], 'after': 0, 'more': unread > 0, 'isgroup': 0, 'response': 0}
+        self.queue_for_client(sock, [msg])
+
+    def inbox(self, key, details):
+        """Handles an inbox request of a client : the messages of the previous page which the client acknowledges are deleted, then the next page is read. Both run on the database lane of the user
+
+        Parameters
+        ----------
+        key : obj
+            Contains information about the socket between the client and the server
+        details : dict
+            The request, `ack` lists the IDs of the messages received by the client, `after` is the ID after which the next page starts (None if the client wants no more messages)
+        """
+        user = int(key.data.user)
+        ack = details.get('ack', [])
+        after = details.get('after')
+        self.query(self.inbox_page, (user, ack, after, INBOX_PAGE),
+                   functools.partial(self.send_inbox_page, key.fileobj, ack, after), key.fileobj, key=user)
+
+    def inbox_page(self, user, ack, after, limit):
+        """Deletes the acknowledged messages of a user and reads the next page of its inbox. Runs on a database thread
+
+        Parameters
+        ----------
+        user : int
+            The user ID
+        ack : list
+            The IDs of the messages to be deleted
+        after : int
+            The page starts after the message with this ID, None to read no page
+        limit : int
+            The max number of messages of the page
+
+        Returns
+        -------
+        list or None
+            The ID and the message of each message of the page, None if no page was asked for
+        """
+        if ack:
+            self.Database.ack_inbox(user, ack)
+        if after is None:
+            return None
+        return self.Database.inbox_page(user, after, limit)
+
+    def send_inbox_page(self, sock, ack, after, page, error):
+        """Callback of `inbox_page` : the messages of the page are sent to the user, followed by the IDs the client acknowledges once it has handled them, and the ID the next page starts after. The page is cut at `INBOX_PAGE_BYTES` of text messages (the images are sent as frames of their own) so that it fits in the frame of the client, the messages left out are the first of the next page
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        ack : list
+            The IDs the client has acknowledged
+        after : int
+            The ID the page starts after, None if no page was asked for
+        page : list
+            The result of `inbox_page`
+        error : Exception
+            The exception raised by the query, None if it has succeeded (the messages are then left in the database and
+            the client is sent back its request so that it tries again)
+        """
+        if error is not None:
+            print("Could not read the inbox :", error)
+            msg = {'type': 'inbox', 'from': 'server', 'error': str(error), 'ack': ack, 'after': after,
+                   'more': after is not None, 'isgroup': 0, 'response': 0}
+            self.queue_for_client(sock, [msg])
+            return
+        if page is None:
+            return
+        messages = []
+        ids = []
+        size = 0
+        for msg_id, message in page:
+            if isinstance(message, bytes):
+                # A binary envelope, stored as it was received
+                message = framing.decode(message)
+            else:
+                size += len(message)
+                if ids and size > INBOX_PAGE_BYTES:
+                    break
+            messages.append(message)
+            ids.append(msg_id)
+        more = len(ids) < len(page) or len(page) == INBOX_PAGE
+        msg = {'type': 'inbox', 'from': 'server', 'ack': ids, 'after': ids[-1] if ids else None, 'more': more,
+               'isgroup': 0, 'response': 0}
+        self.queue_for_client(sock, messages + [msg])
+
+    def queue_for_client(self, sock, messages):
+        """Sends messages to a client before the messages received for it in the meantime
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        messages : list
+            The messages
+        """
+        data = self.get_key(sock).data
+        if data.message == '':
+            data.message = []
+        data.message = messages + data.message
+        data.status = 'rm'
+        self.set_state(sock, data)
 
     def forward(self, key):
         """This function forwards the messages that have been generated with both a read and write status to the client directly, and then updates the socket back to an empty message
@@ -432,12 +1505,37 @@ class Server(object):
         """
         sock = key.fileobj
         data = key.data
-        msg = json.dumps(data.message)
+        # The envelopes among the messages are sent as their bodies, without being decoded, and the binary ones (images)
+        # as frames of their own
+        msg = data.message
         print("Forwarding message :", msg)
-        sock.send(msg.encode())
+        self.send_frames(sock, framing.client_frames(msg))
         data.status = 'msg'
         data.message = ''
-        self.selector.modify(sock, self.read | self.write, data=data)
+        self.set_state(sock, data)
+
+    def flush(self, key):
+        """Writes the bytes still queued on a client socket. Once the queue is empty the socket is no longer watched for writing, or closed if it was waiting for that to close
+
+        Parameters
+        ----------
+        key : obj
+            Contains information about the socket between the client and the server, and also the data that will be communicated through that socket.
+        """
+        sock = key.fileobj
+        data = key.data
+        try:
+            done = self.outboxes[sock].flush(sock)
+        except OSError as e:
+            print("Connection lost :", e)
+            self.drop_connection(sock)
+            return
+        if done and data.status == 'close':
+            self.close_client(sock)
+            self.connections -= 1
+            print('Deregistered')
+        else:
+            self.set_state(sock, data)
 
     def create_group(self, key, details):
         """Create a group with the list of participants and the admin of the group to be formed
@@ -457,8 +1555,31 @@ class Server(object):
         participants.insert(0, data.user)
         print("Here before creation of group")
         print("New participants (with admin) :", participants)
-        group_id = self.Database.create_group(data.user, participants)
+        # The connection waits for the group to be created
+        self.query(self.Database.create_group, (data.user, participants),
+                   functools.partial(self.group_created, sock, participants), sock, key=data.user)
+
+    def group_created(self, sock, participants, group_id, error):
+        """Callback of the creation of a group : the admin is told the ID of the group, and the other participants that they have been added to it
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the admin
+        participants : list
+            The participants of the group, the admin first
+        group_id : int
+            The result of `CentralDatabase.create_group`, -1 if a participant is not registered
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        data = self.get_key(sock).data
         print("Group ID: ", group_id)
+        if group_id != -1:
+            # A new group ID, no other server can have it cached
+            self.groups.put(group_id, (set(participants), 0))
         try:
             if (group_id == -1):  # Send message to client later
                 print("List of Participants not valid")
@@ -475,58 +1596,45 @@ class Server(object):
                 data.status = 'rm'
                 print(data)
                 participants.remove(data.user)
-                self.selector.modify(sock, self.read | self.write, data=data)
-                for part_id in participants:
-                    dest_server = self.Database.check_server(part_id)
-                    if (dest_server == -2):
-                        print("User ", part_id,
-                            "has not registered time 1")
-                    elif dest_server == -1:
-                        msg = {'type': 'msg', 'from': 'server', 'group': group_id, 'dest': part_id,
-                        'message': "You have been added to group {1} by {0}".format(data.user, group_id), 'time': str(datetime.datetime.now()), 'isgroup': 1, 'response': 0}
-                        self.Database.insert_group_message(
-                            data.user, part_id, str(datetime.datetime.now()), group_id, json.dumps(msg))
-                        print("Entered the message for user ",
-                            part_id, "stored in database")
-                        self.Database.displayallgroupmessage()
-                    elif dest_server == self.ID:
-                        msg = {'type': 'msg', 'from': 'server', 'group': group_id, 'dest': part_id,
-                            'message': "You have been added to group {1} by {0}".format(data.user, group_id), 'time': str(datetime.datetime.now()), 'isgroup': 1, 'response': 0}
-                        # data_send = types.SimpleNamespace(addr=data.addr, status = 'msg', response = 1,
-                        #                              user = data.user, server_name = self.ID, message = '')
-                        sock = self.client_sockets[part_id]
-                        key = self.selector.get_key(sock)
-                        data_n = key.data
-                        if data_n.message == '':
-                            data_n.message = []
-                        data_n.message.append(msg)
-                        if data_n.response == 1:
-                            ################################################### REQUIRES CLARIFICATION (WHAT TO "HANDLE LATER"?)#####################################################
-                            # handle later
-                            a = 1
-                        data_n.status = 'rm'
-                        print(data_n)
-                        self.selector.modify(
-                            sock, self.read | self.write, data=data_n)
-                    elif dest_server > 0:
-                        msg = {'type': 'msg', 'from': 'server', 'group': group_id, 'dest': part_id,
-                            'message': "You have been added to group {1} by {0}".format(data.user, group_id), 'time': str(datetime.datetime.now()), 'isgroup': 1, 'response': 0}
-                        sock = self.server_sockets[dest_server]
-                        key = self.server_selector.get_key(sock)
-                        data_n = key.data
-                        if data_n.message == '':
-                            data_n.message = []
-                        data_n.message.append(msg)
-                        data_n.status = 'msg'
-                        print(data_n)
-                        self.server_selector.modify(
-                            sock, self.read | self.write, data=data_n)
+                self.set_state(sock, data)
+                self.locate(participants, functools.partial(self.announce_group, data.user, group_id))
 
         except Exception as e:
             print('Some exception occured', e)
 
+    def announce_group(self, admin_id, group_id, servers):
+        """Tells the participants of a new group that they have been added to it, once their servers have been found by `locate`
+
+        Parameters
+        ----------
+        admin_id : int
+            The user ID of the admin of the group
+        group_id : int
+            The group ID
+        servers : dict
+            The server of each participant (the admin left out)
+        """
+        for part_id, dest_server in servers.items():
+            msg = {'type': 'msg', 'from': 'server', 'group': group_id, 'dest': part_id,
+                   'message': "You have been added to group {1} by {0}".format(admin_id, group_id), 'time': str(datetime.datetime.now()), 'isgroup': 1, 'response': 0}
+            try:
+                if (dest_server == -2):
+                    print("User ", part_id,
+                        "has not registered time 1")
+                elif dest_server == -1:
+                    self.store_offline('groupmessages',
+                        (admin_id, part_id, str(datetime.datetime.now()), group_id, json.dumps(msg)))
+                    print("Entered the message for user ",
+                        part_id, "stored in database")
+                elif dest_server == self.ID:
+                    self.deliver_local(part_id, msg)
+                elif dest_server > 0:
+                    self.queue_for_server(dest_server, msg)
+            except Exception as e:
+                print('Some exception occured', e)
+
 
-    def group_chat(self, key, details):
+    def group_chat(self, key, details, entry=None, servers=None):
         """This function is responsible for sending group chat messages between two clients, by handling messages between servers and also between clients and servers
 
         Parameters
@@ -535,35 +1643,45 @@ class Server(object):
             Contains information about the socket between the client and the server, and also the data that will be communicated through that socket
         details : dict
             A JSON object which contains the encrypted message to be sent to members of the group
+        entry : tuple (optional)
+            The participants of the group and the version of the list, as found by `membership` (which calls this again with them)
+        servers : dict (optional)
+            The server of the receiver, as found by `locate` (which calls this again with it)
         """
         sock = key.fileobj
         data = key.data
-        # get a list of users from the database for the given group id except the admin
-        participants = self.Database.group_participants(details['group'])
+        if entry is None:
+            # the participants of the group, from the group cache (or from the database, without waiting for it)
+            self.membership(details['group'], functools.partial(self.group_chat, key, details))
+            return
+        participants = entry[0]
         print("Participants: ",participants)
         if not details['from'] in participants:
             print("Sender not part of the group. Not sending the message.")
             return
-        # Removing the sender from the participants list
-        try:
-            participants.remove(details['from'])
-        except:
-            a = 1
             # send to the respective server
+        if isinstance(details['dest'], list):
+            # A single message for all the participants, the body is encrypted once and carries the key of each of them
+            self.fan_out(details, [part_id for part_id in details['dest'] if part_id in participants])
+            return
         part_id = details['dest']
+        if not part_id in participants:
+            print("Receiver not part of the group. Not sending the message.")
+            return
         try:
             print("Participant ID: ", part_id)
-            dest_server = self.Database.check_server(part_id)
+            if servers is None:
+                self.locate([part_id], functools.partial(self.group_chat, key, details, entry))
+                return
+            dest_server = servers[part_id]
             if dest_server == -2:
                 print("User ", part_id,
                     "has not registered time 1")
             elif dest_server == -1:
-                self.Database.insert_group_message(
-                    data.user, part_id, details['time'], details['group'], json.dumps(details))
-                print("The message is : ",  details['message'])
+                self.store_offline('groupmessages',
+                    (data.user, part_id, details['time'], details['group'], framing.serialise(details)))
                 print("Entered the message for user ",
                     part_id, "stored in database")
-                self.Database.displayallgroupmessage()
             elif dest_server == self.ID:
                 print("Same destination server")
                 # msg = {'type': 'msg', 'from': data.user, 'group': details['group'],
@@ -571,35 +1689,13 @@ class Server(object):
                 msg = details
                 # data_send = types.SimpleNamespace(addr=data.addr, status = 'msg', response = 1,
                 #                              user = data.user, server_name = self.ID, message = '')
-                sock = self.client_sockets[part_id]
-                key = self.selector.get_key(sock)
-                data_n = key.data
-                if data_n.message == '':
-                    data_n.message = []
-                data_n.message.append(msg)
-                if data_n.response == 1:
-                    ################################################### REQUIRES CLARIFICATION (WHAT TO "HANDLE LATER"?)#####################################################
-                    # handle later
-                    a = 1
-                data_n.status = 'rm'
-                print(data_n)
-                self.selector.modify(
-                    sock, self.read | self.write, data=data_n)
+                self.deliver_local(part_id, msg)
             elif dest_server > 0:
                 print("Different destination server")
                 # msg = {'type': 'msg', 'dest': part_id, 'from': data.user, 'group': details['group'],
                 #     'message': details['message'], 'time': details['time'], 'isgroup': 1, 'response': 0}
                 msg = details
-                sock = self.server_sockets[dest_server]
-                key = self.server_selector.get_key(sock)
-                data_n = key.data
-                if data_n.message == '':
-                    data_n.message = []
-                data_n.message.append(msg)
-                data_n.status = 'msg'
-                print(data_n)
-                self.server_selector.modify(
-                    sock, self.read | self.write, data=data_n)
+                self.queue_for_server(dest_server, msg)
         except Exception as e:
             print("Some exception occurred inside group_chat function: ", e)
     
@@ -617,7 +1713,31 @@ class Server(object):
         key : obj
             Contains information about the socket between the client and the server, and also the data that will be communicated through that socket. In this case, we use it to forward a confirmation message about the addition into the group
         """
-        check = self.Database.add_participant(part_id, admin_id, group_id)
+        # The connection waits for the group to be changed
+        self.query(self.change_group, (part_id, admin_id, group_id, True),
+                   functools.partial(self.added_to_group, key.fileobj, part_id, admin_id, group_id), key.fileobj, key=admin_id)
+
+    def added_to_group(self, sock, part_id, admin_id, group_id, result, error):
+        """Callback of `change_group` for `add_to_group`
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the admin
+        part_id : int
+            The ID of the participant to be added
+        admin_id : int
+            The ID of the person who is adding the participant
+        group_id : int
+            The ID of the group
+        result : tuple
+            The result of `change_group`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        check, group = result
         if check == -1:
             print("The user {0} isn't an admin of the group {1}".format(admin_id, group_id))
         elif check == -2:
@@ -627,10 +1747,11 @@ class Server(object):
         elif check == -4:
             print("The user {0} does not exist".format(part_id))
         elif check == 1:
+            self.update_members(group_id, *group, added=part_id)
             time = str(datetime.datetime.now())
             msg = {'type': 'msg', 'time': time, 'group': group_id, 'from': admin_id,  
                                         'message': "{0} has been added to the group".format(part_id), 'isgroup': 1, 'response': 0}
-            self.group_chat(key,msg)
+            self.group_chat(self.get_key(sock),msg)
 
 
     def remove_from_group(self, part_id, admin_id, group_id, key):
@@ -647,7 +1768,31 @@ class Server(object):
         key : obj
             Contains information about the socket between the client and the server, and also the data that will be communicated through that socket. In this case, we use it to forward a confirmation message about the removal from the group
         """
-        check = self.Database.del_participant(part_id, admin_id, group_id)
+        # The connection waits for the group to be changed
+        self.query(self.change_group, (part_id, admin_id, group_id, False),
+                   functools.partial(self.removed_from_group, key.fileobj, part_id, admin_id, group_id), key.fileobj, key=admin_id)
+
+    def removed_from_group(self, sock, part_id, admin_id, group_id, result, error):
+        """Callback of `change_group` for `remove_from_group`
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the admin
+        part_id : int
+            The ID of the participant to be removed
+        admin_id : int
+            The ID of the person who is removing the participant
+        group_id : int
+            The ID of the group
+        result : tuple
+            The result of `change_group`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        check, group = result
         if (check == -1):
             print("The user {0} isn't an admin of the group {1}".format(admin_id, group_id))
         elif check == -2:
@@ -655,63 +1800,246 @@ class Server(object):
         elif check == -3:
             print("The group {0} does not exist".format(group_id))
         elif check == 1:
+            self.update_members(group_id, *group, removed=part_id)
             time = str(datetime.datetime.now())
             msg = {'type': 'msg', 'time': time, 'group': group_id, 'from': admin_id,  
                                         'message': "{0} has been removed from the group".format(part_id), 'isgroup': 1, 'response': 0}
-            self.group_chat(key,msg)
-            
-    def get_keys(self, details):
-        """Get a dictionary containing a single key value pair of the user and his public key
+            self.group_chat(self.get_key(sock),msg)
+
+    def change_group(self, part_id, admin_id, group_id, add):
+        """Adds a participant to a group or removes one from it, then reads the group again with the public key of the added participant, so that the change is handled with a single round trip to the database. Runs on a database thread
 
         Parameters
         ----------
-        details : dict
-            The message attribute of this dict contains the user id of the user
+        part_id : int
+            The ID of the participant
+        admin_id : int
+            The ID of the person changing the group
+        group_id : int
+            The ID of the group
+        add : bool
+            True to add the participant, False to remove it
 
         Returns
         -------
-        dict
-            dict with a single key value pair of the user and his public key
+        tuple
+            The result of `CentralDatabase.add_participant` or `CentralDatabase.del_participant`, and if it is 1 the participants of the group, the version of the list and the public key of the added participant (None otherwise)
+        """
+        if add:
+            check = self.Database.add_participant(part_id, admin_id, group_id)
+        else:
+            check = self.Database.del_participant(part_id, admin_id, group_id)
+        if check != 1:
+            return check, None
+        participants, version = self.Database.group_members(group_id)
+        keys = self.Database.fetch_keys([part_id]) if add else {}
+        return check, (participants, version, keys)
+
+    def get_keys(self, sock, details, keys=None):
+        """Sends a client the public key of a user, from the key cache. The key is read on a database thread if it is not cached, the client waits in the pending state
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        details : dict
+            The message attribute of this dict contains the user id of the user
+        keys : dict (optional)
+            The keys found by `keys_of` (which calls this again with them)
         """
-        if details['isgroup'] == 0:
-            key = self.Database.fetch_key(details['message'])
-            return {details['message'] : key}
-        
-    def get_group_keys(self, details, user_id):
-        """Get a dictionary containing key value pairs of all members of a group and their public keys 
+        if details['isgroup'] != 0:
+            return
+        if keys is None:
+            self.keys_of([details['message']], functools.partial(self.get_keys, sock, details), sock)
+            return
+        self.send_keys(sock, {'type': 'keys', 'from': 'server', 'message': {details['message']: keys[details['message']]},
+                              'isgroup': details['isgroup'], 'response': 0})
+
+    def get_group_keys(self, sock, details, user_id, entry=None, keys=None):
+        """Sends the reply to a request for the keys of a group. The client sends the version of the participant list it has cached and the participants whose keys it already has : if the version is the current one nothing is sent, else the current list is sent with the keys the client is missing only. The group and the keys which are not cached are read on a database thread, the client waits in the pending state
 
         Parameters
         ----------
+        sock : obj
+            The socket of the client
         details : dict
-            The message attribute of this dict contains the group id of the group
+            The message attribute of this dict contains the group id of the group, `version` and `known` are the cached version and participants of the client (both optional)
         user_id : int
             The user id to be excluded from the dict (he's querying for the other keys)
+        entry : tuple (optional)
+            The participants of the group and the version of the list, as found by `membership` (which calls this again with them)
+        keys : dict (optional)
+            The keys found by `keys_of` (which calls this again with them)
 
-        Returns
-        -------
-        dict
-            dict with key value pairs of the participants of the group and their public keys (except the one of the user_id)
+        The message of the reply is -1 if the user is not a participant of the group, else a dict with key value pairs of the participants and their public keys (except the ones the client has and the one of the user_id)
+        """
+        group_id = details['message']
+        if entry is None:
+            self.membership(group_id, functools.partial(self.get_group_keys, sock, details, user_id), sock)
+            return
+        participants, version = entry
+        msg = {'type': 'keys', 'from': 'server', 'message': -1, 'group': group_id, 'isgroup': 1, 'response': 0}
+        if user_id not in participants:
+            self.send_keys(sock, msg)
+            return
+        msg['version'] = version
+        known = set(details.get('known', []))
+        known.add(user_id)
+        if details.get('version') == version and participants <= known:
+            msg['message'] = {}
+            self.send_keys(sock, msg)
+            return
+        msg['members'] = sorted(participants)
+        if keys is None:
+            self.keys_of(list(participants - known), functools.partial(self.get_group_keys, sock, details, user_id, entry), sock)
+            return
+        msg['message'] = keys
+        self.send_keys(sock, msg)
+
+    def sync_keys(self, sock, details, user_id, current=None, keys=None):
+        """Sends the reply to the key sync sent by a client at login : for every group of the user whose version is not the one cached by the client, the current participant list, and the keys of all these participants which the client does not have yet, with one query for the groups and one for the keys which are not cached. The queries run on a database thread, the client waits in the pending state
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        details : dict
+            `groups` maps the group IDs cached by the client to their version, `known` is the list of the users whose keys the client has
+        user_id : int
+            The user ID of the client
+        current : dict (optional)
+            The groups of the user, as read by `CentralDatabase.user_groups` (`groups_read` calls this again with them)
+        keys : dict (optional)
+            The keys found by `keys_of` (which calls this again with them)
+
+        In the reply, `groups` maps the changed groups to their version and participants, `left` lists the cached groups the user is not a participant of any more and the message holds the missing keys
+        """
+        if current is None:
+            self.query(self.Database.user_groups, (user_id,), functools.partial(self.groups_read, sock, details, user_id),
+                       sock, key=user_id)
+            return
+        cached = {int(group_id): version for group_id, version in details.get('groups', {}).items()}
+        groups = dict()
+        needed = set()
+        for group_id, (participants, version) in current.items():
+            self.groups.put(group_id, (set(participants), version))
+            if cached.get(group_id) != version:
+                groups[group_id] = {'version': version, 'members': sorted(participants)}
+                needed.update(participants)
+        left = [group_id for group_id in cached if group_id not in current]
+        needed -= set(details.get('known', []))
+        needed.discard(user_id)
+        if keys is None:
+            self.keys_of(list(needed), functools.partial(self.sync_keys, sock, details, user_id, current), sock)
+            return
+        self.send_keys(sock, {'type': 'keys', 'from': 'server', 'message': keys, 'groups': groups,
+                              'left': left, 'isgroup': 1, 'sync': 1, 'response': 0})
+
+    def groups_read(self, sock, details, user_id, current, error):
+        """Callback of `CentralDatabase.user_groups` for `sync_keys`
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        details : dict
+            The key sync sent by the client
+        user_id : int
+            The user ID of the client
+        current : dict
+            The result of `CentralDatabase.user_groups`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is None:
+            self.sync_keys(sock, details, user_id, current)
+
+    def send_keys(self, sock, msg):
+        """Queues the reply to a request for keys for the client
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        msg : dict
+            The reply
+        """
+        print("The keys are : ", msg['message'])
+        data_n = self.get_key(sock).data
+        if data_n.message == '':
+            data_n.message = []
+        data_n.message.append(msg)
+        data_n.status = 'rm'
+        self.set_state(sock, data_n)
+
+    def keys_of(self, user_ids, callback, sock=None):
+        """Finds the public keys of several users, and calls `callback(keys)` with them. It is called right away if the keys are all in the key cache, else the missing ones are fetched with a single query on a database thread and it is called once they have been
+
+        Parameters
+        ----------
+        user_ids : list
+            The user IDs
+        callback : callable
+            Called with a dict with key value pairs of the users and their public keys (the users who are not registered are left out)
+        sock : obj (optional)
+            A client socket which waits in the pending state until the callback has run
+        """
+        keys = dict()
+        missing = []
+        for user_id in user_ids:
+            key = self.public_keys.get(user_id)
+            if key is None:
+                missing.append(user_id)
+            else:
+                keys[user_id] = key
+        if not missing:
+            callback(keys)
+            return
+        self.query(self.Database.fetch_keys, (missing,), functools.partial(self.keys_fetched, keys, callback), sock)
+
+    def keys_fetched(self, keys, callback, fetched, error):
+        """Callback of `CentralDatabase.fetch_keys` for `keys_of` : the keys are cached, and passed to the callback of `keys_of` with the ones which were cached
+
+        Parameters
+        ----------
+        keys : dict
+            The keys found in the key cache
+        callback : callable
+            The callback of `keys_of`
+        fetched : dict
+            The result of `CentralDatabase.fetch_keys`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
         """
-        if details['isgroup'] == 1:
-            dict1 = self.Database.fetch_group_keys(details['message'], user_id)
-            return dict1
+        if error is not None:
+            return
+        for user_id, key in fetched.items():
+            self.public_keys.put(user_id, key)
+            keys[user_id] = key
+        callback(keys)
     
-    def message(self, key):
+    def message(self, key, recv_data, servers=None):
         """This is a function to accept a message from a client, and then handle the following events appropriately, like which server to redirect the message to, etc. It also calls the group chat functions
 
         Parameters
         ----------
         key : obj
             Contains information about the socket between the client and the server, and also the data that will be communicated through that socket.
+        recv_data : dict or list
+            The (decoded) frame sent by the client
+        servers : dict (optional)
+            The server of the receiver of a direct message, as found by `locate` (which calls this again with it)
         """
         sock = key.fileobj
         data = key.data
-        recv_data = json.loads(sock.recv(MAX_SIZE))
         print("List of online clients with their sockets : ", self.client_sockets)
         print("INSIDE MESSAGE")
         try:
             print("Data received : ", recv_data)
-            if (isinstance(recv_data,list)):
+            if isinstance(recv_data, framing.Envelope) and recv_data['isgroup'] == 1:
+                # A group message sent as an envelope (one per receiver), the direct messages go to the last branch
+                self.group_chat(key, recv_data)
+            elif (isinstance(recv_data,list)):
                 for msg in recv_data:
                     if isinstance(msg,str) or isinstance(msg,bytes):
                         msg = json.loads(msg)
@@ -729,19 +2057,15 @@ class Server(object):
                         self.group_chat(key, msg)
                         print("Group chat funct done")
             elif recv_data['type'] == 'keys':
-                if recv_data['isgroup'] == 0:
-                    keys = self.get_keys(recv_data)
+                # The reply is sent by `send_keys`, once what is not cached has been read from the database
+                if recv_data['message'] == 'sync':
+                    self.sync_keys(sock, recv_data, data.user)
+                elif recv_data['isgroup'] == 0:
+                    self.get_keys(sock, recv_data)
                 else:
-                    keys = self.get_group_keys(recv_data, data.user)
-                print("The keys are : ", keys)
-                msg = {'type': 'keys', 'from' :'server', 'message' : keys, 
-                      'isgroup' : recv_data['isgroup'], 'response' : 0}
-                data_n = data
-                if data_n.message == '':
-                    data_n.message = []
-                data_n.message.append(msg)
-                data_n.status = 'rm'
-                self.selector.modify(sock, self.read | self.write, data = data_n)
+                    self.get_group_keys(sock, recv_data, data.user)
+            elif recv_data['type'] == 'inbox':
+                self.inbox(key, recv_data)
             elif recv_data['isgroup'] == 1 and recv_data['message'] == 'add_to_group':
                 print(recv_data)
                 self.add_to_group(recv_data['dest'], data.user, recv_data['group'],key)
@@ -757,63 +2081,49 @@ class Server(object):
                     pending_messages = data.message
                     for msg1 in pending_messages:
                         print("Entered the for loop inside close function")
-                        self.Database.insert_message(
-                            msg1['from'], data.user, msg1['time'], json.dumps(msg1))
+                        if msg1.get('from') == 'server' or msg1['type'] in ('inbox', 'keys'):
+                            # The replies of the server are not stored, the client asks for them again at login
+                            continue
+                        if msg1['isgroup'] == 1:
+                            self.store_offline('groupmessages',
+                                (msg1['from'], data.user, msg1['time'], msg1['group'], framing.serialise(msg1)))
+                        else:
+                            self.store_offline('messages',
+                                (msg1['from'], data.user, msg1['time'], framing.serialise(msg1)))
                         print("Entered the message for user ",
                                 data.user, "stored in database")
-                        self.Database.displayallmessage()
 
                     ########################################### CLARIFICATION REQUIRED - pending_messages is empty ###########################################################
                     print("Pending Messages")
                     # print(pending_messages)
-                    self.Database.change_server(data.user, -1)
-                    self.Database.update_numclients(self.ID, -1)
-                    self.client_sockets.pop(data.user)
-                    self.selector.unregister(sock)
-                    # Updates the num clients table 
+                    self.set_location(data.user, -1)
+                    self.connections -= 1
+                    self.remove_client(data.user)
+                    self.close_client(sock)
                     print('Deregistered ' + str(data.user))
-                    sock.close()
                 else:
-                    dest_server = self.Database.check_server(recv_data['dest'])
+                    if servers is None:
+                        # Usually cached by `prefetch`, unless it has been dropped from the cache since
+                        self.locate([recv_data['dest']], functools.partial(self.message, key, recv_data))
+                        return
+                    dest_server = servers[recv_data['dest']]
                     if (dest_server == -2):
                         print("User ", recv_data['dest'],
                                 "has not registered time 1")
                     elif dest_server == -1:
-                        self.Database.insert_message(
-                            data.user, recv_data['dest'], recv_data['time'], json.dumps(recv_data))
+                        self.store_offline('messages',
+                            (data.user, recv_data['dest'], recv_data['time'], framing.serialise(recv_data)))
                         print("Entered the message for user ",
                                 recv_data['dest'], "stored in database")
-                        self.Database.displayallmessage()
                     elif dest_server == self.ID:
                         msg = recv_data
                         # data_send = types.SimpleNamespace(addr=data.addr, status = 'msg', response = 1,
                         #                              user = data.user, server_name = self.ID, message = '')
-                        sock = self.client_sockets[recv_data['dest']]
-                        key = self.selector.get_key(sock)
-                        data_n = key.data
-                        if data_n.message == '':
-                            data_n.message = []
-                        data_n.message.append(msg)
-                        if data_n.response == 1:
-                            ################################################### REQUIRES CLARIFICATION (WHAT TO "HANDLE LATER"?)#####################################################
-                            # handle later
-                            a = 1
-                        data_n.status = 'rm'
-                        print(data_n)
-                        self.selector.modify(
-                            sock, self.read | self.write, data=data_n)
+                        self.deliver_local(recv_data['dest'], msg)
                     elif dest_server > 0:
                         msg = recv_data
                         print("Destination server:",dest_server)
-                        sock = self.server_sockets[dest_server]
-                        key = self.server_selector.get_key(sock)
-                        data_n = key.data
-                        if data_n.message == '':
-                            data_n.message = []
-                        data_n.message.append(msg)
-                        data_n.status = 'msg'
-                        self.server_selector.modify(
-                            sock, self.read | self.write, data=data_n)
+                        self.queue_for_server(dest_server, msg)
 
         except Exception as e:
             print('Some exception occured', e)
@@ -828,13 +2138,447 @@ class Server(object):
         mask : obj
             Contains information about the operation to be performed, whether it is to receive data or to send data
         """
+        sock = key.fileobj
+        try:
+            frames = framing.read_frames(sock, self.decoders[sock], MAX_SIZE)
+        except (ConnectionError, framing.FrameError) as e:
+            print("Connection lost :", e)
+            self.drop_connection(sock)
+            return
+        self.handle_frames(sock, frames)
+
+    def handle_frames(self, sock, frames, prefetched=False):
+        """Handles the frames received from a client, depending on the state of the client (authentication or messages). While the client is in the pending state (waiting for a database query) its frames are held, and handled once the query is done
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        frames : list
+            The payloads of the frames, in the order they were received
+        prefetched : bool (optional)
+            If True what is needed to route the first frame has just been read from the database (see `prefetch`)
+        """
+        # A single read can carry several frames, the state of the socket is looked up again before each one
+        # because handling a frame may replace its data or close it
+        for i, frame in enumerate(frames):
+            if sock in self.pending:
+                self.pending[sock].extend(frames[i:])
+                return
+            try:
+                key = self.get_key(sock)
+            except (KeyError, ValueError):
+                return
+            try:
+                recv_data = framing.decode(frame)
+                if key.data.status == 'auth':       # authenticate user
+                    self.authenticate_client(key, recv_data)
+                elif key.data.status in ('msg', 'img', 'rm'):
+                    # 'rm' only means messages are waiting to be forwarded to this client, it can still send
+                    lookup = None if prefetched and i == 0 else self.lookups(recv_data)
+                    if lookup is not None:
+                        self.prefetch(sock, frames[i:], lookup)
+                        return
+                    self.message(key, recv_data)
+            except:
+                continue
+
+    def lookups(self, recv_data):
+        """Returns the database query needed to route a message of a client from the caches only : the server of the receiver of a direct message, or the participants of a group and the servers of the receivers of a group message
+
+        Parameters
+        ----------
+        recv_data : dict, list or framing.Envelope
+            The (decoded) frame sent by the client
+
+        Returns
+        -------
+        tuple or None
+            The function running the query, its arguments and the callback storing its result in the caches. None if everything is cached, or if the frame is not a message to be routed
+        """
+        try:
+            if isinstance(recv_data, list) or recv_data['type'] == 'keys':
+                return None
+            if recv_data['isgroup'] == 1:
+                if not isinstance(recv_data, framing.Envelope) and recv_data['message'] in ('add_to_group', 'remove_from_group', 'create_group'):
+                    return None
+                group_id = recv_data['group']
+                if group_id not in self.groups:
+                    return (self.fetch_group_routes, (group_id,), functools.partial(self.group_fetched, group_id))
+                receivers = recv_data['dest'] if isinstance(recv_data['dest'], list) else [recv_data['dest']]
+            elif recv_data['dest'] == 'server':
+                return None
+            else:
+                receivers = [recv_data['dest']]
+        except (KeyError, TypeError):
+            return None
+        missing = [user for user in receivers
+                   if user not in self.routes and user not in self.client_sockets and user not in self.worker_users]
+        if not missing:
+            return None
+        return (self.Database.check_servers, (missing,), self.routes_fetched)
+
+    def prefetch(self, sock, frames, lookup):
+        """Puts a client in the pending state while what is needed to route its next frame is read from the database. The frame (and the ones after it) is routed once the caches have been filled
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        frames : list
+            The frames not handled yet, the first one is the one looked up
+        lookup : tuple
+            The query, as returned by `lookups`
+        """
+        function, args, store = lookup
+        self.pending[sock] = list(frames)
+        self.query(function, args, store, sock, prefetched=True)
+
+    def fetch_group_routes(self, group_id):
+        """Reads the participants of a group and the servers they are connected to. Runs on a database thread
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+
+        Returns
+        -------
+        tuple
+            The participants, the version of the list and the servers of the registered participants (user -> server)
+        """
+        participants, version = self.Database.group_members(group_id)
+        return participants, version, self.Database.check_servers(participants)
+
+    def group_fetched(self, group_id, result, error):
+        """Callback of `fetch_group_routes`, stores its result in the group and routing caches
+
+        Parameters
+        ----------
+        group_id : int
+            The group ID
+        result : tuple
+            The result of `fetch_group_routes`
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        participants, version, servers = result
+        self.groups.put(group_id, (set(participants), version))
+        self.routes_fetched(servers, None)
+
+    def routes_fetched(self, servers, error):
+        """Callback of `CentralDatabase.check_servers`, stores its result in the routing cache
+
+        Parameters
+        ----------
+        servers : dict
+            The servers of the users (user -> server)
+        error : Exception
+            The exception raised by the query, None if it has succeeded
+        """
+        if error is not None:
+            return
+        for user, server_id in servers.items():
+            self.routes.put(user, server_id)
+
+    def drop_connection(self, sock):
+        """Cleans up after a client socket which was closed without the close message (the client crashed or the connection broke)
+
+        Parameters
+        ----------
+        sock : obj
+            The socket of the client
+        """
+        data = self.get_key(sock).data
+        self.close_client(sock)
+        if data.user != '' and self.client_sockets.get(data.user) is sock:
+            self.remove_client(data.user)
+            self.set_location(data.user, -1)
+        self.connections -= 1
+        print('Dropped connection ' + str(data.addr))
+
+
+
+class ClientConnection(asyncio.Protocol):
+    """A client connected to the asyncio engine. It takes the place of the client socket of the selectors engine : it is what `client_sockets` maps the users to, and it carries the state (`data`) that the selectors engine keeps in the selector
+    """
+
+    def __init__(self, server):
+        """Initialises the connection
+
+        Parameters
+        ----------
+        server : AsyncServer
+            The server which accepted the connection
+        """
+        self.server = server
+        self.transport = None
+        self.decoder = framing.FrameDecoder()
+        self.data = None
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.data = types.SimpleNamespace(addr=transport.get_extra_info('peername'), status='auth', response=0,
+                                          user='', server_name=self.server.ID, message='')
+        self.server.dispatch(self.server.accept_connection, self)
+
+    def data_received(self, data):
         try:
-            if key.data.status == 'auth':       # authenticate user
-                self.authenticate_client(key, mask)
-            elif key.data.status == 'msg' or key.data.status == 'img':
-                self.message(key)
-        except:
+            frames = self.decoder.feed(data)
+        except framing.FrameError as e:
+            print("Connection lost :", e)
+            self.transport.close()
             return
+        if frames:
+            self.server.dispatch(self.server.handle_frames, self, frames)
+
+    def connection_lost(self, exc):
+        self.server.dispatch(self.server.connection_lost, self)
+
+    def write(self, frame):
+        """Writes a frame, unless the connection has been closed in the meantime. Runs on the event loop
+
+        Parameters
+        ----------
+        frame : bytes
+            The frame to be written
+        """
+        if not self.transport.is_closing():
+            self.transport.write(frame)
+
+
+class PeerConnection(asyncio.Protocol):
+    """A connection to another server in the asyncio engine, it takes the place of the server socket of the selectors engine
+    """
+
+    def __init__(self, server, data, decoder):
+        """Initialises the connection
+
+        Parameters
+        ----------
+        server : AsyncServer
+            This server
+        data : obj
+            The state of the link, as set up by `connect_servers`
+        decoder : FrameDecoder
+            The reassembly buffer used during `connect_servers` (it may already hold frames)
+        """
+        self.server = server
+        self.data = data
+        self.decoder = decoder
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        frames = self.decoder.take_backlog()
+        if frames:
+            self.server.dispatch(self.server.route_server_frames, frames)
+
+    def data_received(self, data):
+        frames = self.decoder.feed(data)
+        if frames:
+            self.server.dispatch(self.server.route_server_frames, frames)
+
+    def connection_lost(self, exc):
+        self.server.dispatch(self.server.drop_link, self, exc)
+
+    def write(self, frame):
+        if not self.transport.is_closing():
+            self.transport.write(frame)
+
+
+class AsyncServer(Server):
+    """The server running on asyncio instead of the selectors loop. The sockets are read and written by the asyncio event loop, while the routing (`authenticate_client`, `register_client`, `message`, `group_chat`, `create_group`, ...) is the same code as the selectors engine, run on a separate dispatcher thread so that the event loop never waits for the database. The queries of the database executor run on its threads as in the selectors engine, their callbacks on the dispatcher
+    """
+
+    def get_key(self, conn):
+        if conn.closed:
+            raise KeyError(conn)
+        return types.SimpleNamespace(fileobj=conn, data=conn.data)
+
+    def get_server_key(self, conn):
+        return types.SimpleNamespace(fileobj=conn, data=conn.data)
+
+    def set_state(self, conn, data):
+        conn.data = data
+        if data.status in ('reply', 'rm') and conn not in self.pending:
+            self.dirty[conn] = None
+
+    def set_server_state(self, conn, data):
+        conn.data = data
+
+    def send(self, conn, message):
+        self.loop.call_soon_threadsafe(conn.write, framing.encode(message))
+        return True
+
+    def send_frames(self, conn, messages):
+        self.loop.call_soon_threadsafe(conn.write, b''.join(framing.encode(message) for message in messages))
+        return True
+
+    def send_batch(self, conn, frames):
+        # A broken connection is reported by `PeerConnection.connection_lost`
+        self.send_frames(conn, frames)
+
+    def close_link(self, conn):
+        self.loop.call_soon_threadsafe(conn.transport.close)
+
+    def flush(self, key):
+        # asyncio transports buffer the partial writes themselves, only a pending close has to be handled
+        if key.data.status == 'close':
+            self.close_client(key.fileobj)
+            self.connections -= 1
+            print('Deregistered')
+
+    def close_client(self, conn):
+        conn.closed = True
+        self.pending.pop(conn, None)
+        # Closing the transport lets it write what it still buffers first
+        self.loop.call_soon_threadsafe(conn.transport.close)
+
+    def dispatch(self, function, *args):
+        """Runs a routing function on the dispatcher thread, followed by the replies and forwards it has scheduled. Called from the event loop
+
+        Parameters
+        ----------
+        function : callable
+            The function to be run
+        *args :
+            Arguments of the function
+        """
+        self.loop.run_in_executor(self.dispatcher, self.run_dispatched, function, args)
+
+    def run_dispatched(self, function, args):
+        try:
+            function(*args)
+            self.service_writes()
+            self.flush_batches()
+            self.schedule_batches()
+        except Exception as e:
+            print('Exception in the dispatcher', e)
+
+    def schedule_batches(self):
+        """Wakes the dispatcher up when the next batch for another server is due, if no other event does it before
+        """
+        delay = self.next_timeout()
+        if delay is not None and not self.batch_timer:
+            self.batch_timer = True
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.dispatch, self.batch_timer_expired)
+
+    def batch_timer_expired(self):
+        # The due batches are sent by `run_dispatched` right after this
+        self.batch_timer = False
+
+    def load_timer_expired(self):
+        """Reports the load of the server and sets the timer of the next report. The lag reported is how late the dispatcher runs this
+        """
+        self.report_load()
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.reporter.timeout(), self.dispatch, self.load_timer_expired)
+
+    def service_writes(self):
+        """Sends what the routing functions have scheduled for the clients : replies and forwarded messages
+        """
+        while self.dirty:
+            conn, _ = self.dirty.popitem(last=False)
+            if conn.closed:
+                continue
+            key = self.get_key(conn)
+            if key.data.status == 'reply':
+                self.reply(key)
+            elif key.data.status == 'rm':
+                self.forward(key)
+
+    def accept_connection(self, conn):
+        """Counterpart of `accept_wrapper` for a connection accepted by asyncio
+
+        Parameters
+        ----------
+        conn : ClientConnection
+            The new connection
+        """
+        self.connections += 1
+        print(f"Accepted connection from {conn.data.addr}")
+
+    def connection_lost(self, conn):
+        """Called when a client connection has been closed, by us or by the client
+
+        Parameters
+        ----------
+        conn : ClientConnection
+            The closed connection
+        """
+        if not conn.closed:
+            print("Connection lost :", conn.data.addr)
+            self.drop_connection(conn)
+
+    def route_server_frames(self, frames):
+        """Decodes the frames received from another server and delivers their messages
+
+        Parameters
+        ----------
+        frames : list
+            The payloads of the frames
+        """
+        for message in frames:
+            print("Server Message : ", message)
+            RD = framing.decode(message)
+            self.route_server_message(RD if isinstance(RD, list) else [RD])
+
+    def handle_events(self):
+        """Runs the asyncio event loop. The server sockets set up by `connect_servers` and the listening socket are handed over to asyncio
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # A single thread keeps the routing functions serialised, as they are in the selectors engine
+        self.dispatcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # The callbacks of the database queries are run by the dispatcher too
+        self.db_executor = dbexecutor.DBExecutor(DB_WORKERS, post=lambda *args: self.loop.call_soon_threadsafe(self.dispatch, *args))
+        # Connections with replies or messages to be sent, in the order they were scheduled
+        self.dirty = collections.OrderedDict()
+        self.batch_timer = False
+        try:
+            self.loop.run_until_complete(self.start_serving())
+            self.loop.call_later(self.reporter.timeout(), self.dispatch, self.load_timer_expired)
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
+        finally:
+            print("Batches sent to the other servers :", self.batcher.stats())
+            print("Routing cache :", self.routes.stats())
+            print("Group cache :", self.groups.stats())
+            print("Key cache :", self.public_keys.stats())
+            print("Checked tickets :", self.tickets.stats())
+            self.dispatcher.submit(self.write_offline, self.offline.take()).result()
+            print("Offline messages written :", self.offline.stats())
+            print("Database queries :", self.db_executor.stats())
+            print("Load reports :", self.reporter.stats())
+            self.reporter.close()
+            self.db_executor.close()
+            self.dispatcher.shutdown(wait=False)
+            self.loop.close()
+
+    async def start_serving(self):
+        for Id, sock in list(self.server_sockets.items()):
+            if Id == self.ID:
+                continue
+            data = self.selector.get_key(sock).data
+            self.selector.unregister(sock)
+            self.links.discard(sock)
+            self.outboxes.pop(sock, None)
+            decoder = self.decoders.pop(sock)
+            transport, conn = await self.loop.connect_accepted_socket(
+                lambda data=data, decoder=decoder: PeerConnection(self, data, decoder), sock=sock)
+            self.server_sockets[Id] = conn
+        self.selector.unregister(self.listening_socket)
+        self.listener = await self.loop.create_server(lambda: ClientConnection(self), sock=self.listening_socket)
+        print("Serving with the asyncio engine")
 
 
-S = Server(IP, PORT, ID, N)
\ No newline at end of file
+if ENGINE == 'asyncio':
+    if WORKERS > 1:
+        sys.exit('Multiple workers are only supported by the selectors engine')
+    S = AsyncServer(IP, PORT, ID, N)
+else:
+    S = Server(IP, PORT, ID, N, WORKERS)
\ No newline at end of file
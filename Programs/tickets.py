@@ -0,0 +1,142 @@
+'''This module implements the tickets the load balancer gives to the clients it sends to a server : the signature, by
+the load balancer, of the address of the server and of the time the ticket expires. The server checks the ticket
+when the client logs in or registers, so that only the clients placed by the load balancer are accepted.
+
+The ticket of a server is the same for every client sent to it, so the load balancer signs it once (``TicketCache``)
+instead of once per client : the tickets of all the servers are signed at start, and a ticket is signed again on a
+background thread once it has less than a quarter of its lifetime left, while the current one is still handed out.
+Placing a client costs a dict lookup, not an RSA signature. The server remembers the tickets it has checked (see
+``server.Server.check_ticket``), so it verifies each ticket once, not once per login.
+
+Attributes
+----------
+TICKET_TTL : int
+    Lifetime of a ticket (in seconds), from the ``TICKET_TTL`` environment variable (an hour if it is not set)
+
+MEMO_SIZE : int
+    Max number of tickets a server remembers as checked (a few per server and per lifetime are in use at a time)
+'''
+
+import concurrent.futures
+import os
+import threading
+import time
+
+TICKET_TTL = int(os.environ.get('TICKET_TTL', 3600))
+MEMO_SIZE = 64
+
+
+def ticket_message(ip, port, expires):
+    ''' Returns the message signed by a ticket.
+
+    Parameters
+    ----------
+    ip : str
+        The IP address of the server.
+    port : int
+        The port of the server.
+    expires : int
+        The time the ticket expires at (seconds since the epoch).
+
+    Returns
+    -------
+    str
+        The message.
+
+    '''
+    return '{0}{1}@{2}'.format(ip, port, expires)
+
+
+def issue(encrypt, ip, port, ttl=TICKET_TTL):
+    ''' Signs a new ticket for a server.
+
+    Parameters
+    ----------
+    encrypt : enc.Encrypt
+        The keys of the load balancer.
+    ip : str
+        The IP address of the server.
+    port : int
+        The port of the server.
+    ttl : int (optional)
+        The lifetime of the ticket (in seconds).
+
+    Returns
+    -------
+    dict
+        The ticket : the signature (``sign``) and the time it expires at (``expires``), sent to the client as they are.
+
+    '''
+    expires = int(time.time()) + ttl
+    return {'sign': encrypt.RSA_sign(ticket_message(ip, port, expires)).decode(), 'expires': expires}
+
+
+class TicketCache(object):
+    '''The current ticket of every server, kept by the load balancer.
+
+    Parameters
+    ----------
+    encrypt : enc.Encrypt
+        The keys of the load balancer.
+    ttl : int (optional)
+        The lifetime of a ticket (in seconds).
+
+    '''
+
+    def __init__(self, encrypt, ttl=TICKET_TTL):
+        self.encrypt = encrypt
+        self.ttl = ttl
+        # (IP address, port) -> ticket
+        self.tickets = dict()
+        # Servers whose ticket is being signed again by the background thread
+        self.renewing = set()
+        self.lock = threading.Lock()
+        self.signer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='ticket')
+        self.hits = 0
+        self.signed = 0
+
+    def warm(self, addresses):
+        ''' Signs the tickets of the servers before the first client arrives.
+        '''
+        for ip, port in addresses:
+            self.sign(ip, port)
+
+    def get(self, ip, port):
+        ''' Returns the ticket of a server. It is only signed here if the server has none or it has expired, a ticket
+        close to its expiry is signed again in the background.
+        '''
+        ticket = self.tickets.get((ip, port))
+        now = time.time()
+        if ticket is None or ticket['expires'] <= now:
+            return self.sign(ip, port)
+        self.hits += 1
+        if ticket['expires'] - now < self.ttl / 4:
+            with self.lock:
+                if (ip, port) in self.renewing:
+                    return ticket
+                self.renewing.add((ip, port))
+            self.signer.submit(self.renew, ip, port)
+        return ticket
+
+    def sign(self, ip, port):
+        ticket = issue(self.encrypt, ip, port, self.ttl)
+        with self.lock:
+            self.tickets[(ip, port)] = ticket
+            self.signed += 1
+        return ticket
+
+    def renew(self, ip, port):
+        # On the background thread
+        try:
+            self.sign(ip, port)
+        finally:
+            with self.lock:
+                self.renewing.discard((ip, port))
+
+    def stats(self):
+        ''' Returns the number of clients given a ticket which was already signed, and the number of signatures.
+        '''
+        return {'hits': self.hits, 'signed': self.signed}
+
+    def close(self):
+        self.signer.shutdown(wait=False)
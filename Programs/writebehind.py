@@ -0,0 +1,136 @@
+'''This module implements the write-behind buffer of the messages a server stores for offline users.
+
+Instead of one insert (and one commit) per message, the messages to be stored are appended to the buffer and written
+together : the rows of a table go to the database in a single multi-row insert, committed once (see
+``database.CentralDatabase.insert_messages``). The buffer is written as soon as it holds ``max_rows`` rows, or once
+its oldest row has waited ``linger_us`` microseconds. With the default linger of 0 it is written at the end of the
+round of the event loop in which it was started, so a group message for many offline participants costs a handful
+of commits instead of one per participant.
+
+The rows still in the buffer are lost if the server crashes, at most ``linger_us`` worth of messages. How much is lost
+if the database crashes is set by ``database.DB_SYNC_COMMIT``.
+
+Attributes
+----------
+MAX_ROWS : int
+    Default number of rows at which the buffer is written right away
+
+LINGER_US : int
+    Default time (in microseconds) a row may wait for more rows
+'''
+
+import collections
+import time
+
+MAX_ROWS = 1000
+LINGER_US = 0
+
+
+def valid_row(table, row):
+    ''' Checks a row before it joins a batch : the IDs must be integers, the time a string and the message a string or
+    bytes, as a single row the database rejects makes the insert of its whole batch fail.
+
+    Parameters
+    ----------
+    table : str
+        The table of the row, ``messages`` or ``groupmessages``.
+    row : tuple
+        The row, the arguments of ``insert_message`` or ``insert_group_message``.
+
+    Returns
+    -------
+    bool
+        True if the row can be inserted.
+
+    '''
+    if len(row) != (5 if table == 'groupmessages' else 4):
+        return False
+    ids = (row[0], row[1], row[3]) if table == 'groupmessages' else (row[0], row[1])
+    return (all(isinstance(i, int) and not isinstance(i, bool) for i in ids) and isinstance(row[2], str)
+            and isinstance(row[-1], (str, bytes)))
+
+
+class WriteBehind(object):
+    '''The rows waiting to be written, by table, with the counters of the written batches.
+
+    Parameters
+    ----------
+    max_rows : int (optional)
+        The buffer is written right away once it holds this number of rows.
+    linger_us : int (optional)
+        Time (in microseconds) a row may wait for more rows.
+
+    '''
+
+    def __init__(self, max_rows=MAX_ROWS, linger_us=LINGER_US):
+        self.max_rows = max_rows
+        self.linger = linger_us / 1e6
+        # table -> rows, in the order they were added
+        self.tables = collections.OrderedDict()
+        self.count = 0
+        self.deadline = None
+        self.batches = 0
+        self.rows = 0
+        self.largest = 0
+
+    def add(self, table, row):
+        ''' Appends a row to the buffer.
+
+        Parameters
+        ----------
+        table : str
+            The table of the row, ``messages`` or ``groupmessages``.
+        row : tuple
+            The row, the arguments of ``insert_message`` or ``insert_group_message``.
+
+        Returns
+        -------
+        dict or None
+            The rows of each table if the buffer is full and has to be written now, else None.
+
+        '''
+        if self.count == 0:
+            self.deadline = time.monotonic() + self.linger
+        self.tables.setdefault(table, []).append(row)
+        self.count += 1
+        if self.count >= self.max_rows:
+            return self.take()
+        return None
+
+    def take(self):
+        ''' Empties the buffer and returns its rows by table, counting them in the statistics.
+        '''
+        tables = self.tables
+        if self.count:
+            self.batches += 1
+            self.rows += self.count
+            self.largest = max(self.largest, self.count)
+        self.tables = collections.OrderedDict()
+        self.count = 0
+        self.deadline = None
+        return tables
+
+    def due(self, now=None):
+        ''' Returns the rows by table if the linger time of the buffer is over, else an empty dict.
+        '''
+        if self.count == 0:
+            return {}
+        if now is None:
+            now = time.monotonic()
+        if self.deadline > now:
+            return {}
+        return self.take()
+
+    def timeout(self, now=None):
+        ''' Returns the time (in seconds) until the buffer is due, None if it is empty.
+        '''
+        if self.count == 0:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0, self.deadline - now)
+
+    def stats(self):
+        ''' Returns the number of batches and rows written, and the number of rows of the largest batch.
+        '''
+        return {'batches': self.batches, 'rows': self.rows, 'largest': self.largest}
@@ -0,0 +1,50 @@
+import sys
+import time
+import os
+
+sys.path.insert(0, os.getcwd())
+import enc
+
+# Microbenchmark of the RSA backends of enc.Encrypt.
+# Run it from the Programs directory as "python3 ../Testing/bench_crypto.py [<SECONDS_PER_OPERATION>] [<BACKEND> ...]"
+# e.g. "python3 ../Testing/bench_crypto.py 2 rsa pycryptodome"
+# For every backend, each operation is repeated for the given time and the number of operations per second is printed :
+# the sign of the load balancer and its check by the server at login (RSA_sign, RSA_verify), and the encryption and
+# decryption of a message (encrypt, decrypt, one RSA encryption of the AES key each).
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+BACKENDS = sys.argv[2:] or list(enc.BACKENDS)
+MESSAGE = 'x' * 64
+SIGNED = '127.0.0.1' + '8000'
+
+
+def ops_per_second(operation):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        operation()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= SECONDS:
+            return count / elapsed
+
+
+results = []
+for backend in BACKENDS:
+    sender = enc.Encrypt(backend=backend)
+    receiver = enc.Encrypt(backend=backend)
+    public_key = receiver.get_public_key()
+    sign = sender.RSA_sign(SIGNED)
+    encrypted_key, encrypted_message, key = sender.encrypt(MESSAGE, public_key)
+    assert sender.RSA_verify(SIGNED, sign)
+    assert receiver.decrypt(encrypted_message, encrypted_key) == MESSAGE
+    results.append((backend,
+                    ops_per_second(lambda: sender.RSA_sign(SIGNED)),
+                    ops_per_second(lambda: sender.RSA_verify(SIGNED, sign)),
+                    ops_per_second(lambda: sender.encrypt(MESSAGE, public_key)),
+                    ops_per_second(lambda: receiver.decrypt(encrypted_message, encrypted_key))))
+    print(results[-1])
+
+print()
+print('{0:>14} {1:>12} {2:>12} {3:>12} {4:>12}'.format('backend', 'RSA_sign/s', 'RSA_verify/s', 'encrypt/s', 'decrypt/s'))
+for row in results:
+    print('{0:>14} {1:>12.1f} {2:>12.1f} {3:>12.1f} {4:>12.1f}'.format(*row))
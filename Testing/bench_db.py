@@ -0,0 +1,107 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.getcwd())
+import psycopg2
+import database
+
+# Benchmark of the queries run on every message, in queries per second.
+# Run it from the Programs directory (it needs the fastchat database, whose tables are dropped) as
+# "python3 ../Testing/bench_db.py <NUM_QUERIES> [<THREADS> ...]"
+# e.g. "python3 ../Testing/bench_db.py 10000 1 4 16"
+# Each query is run NUM_QUERIES times, split between THREADS threads :
+#   before : one connection shared by all the threads, the values formatted into the query text (what
+#            CentralDatabase did), every query is parsed and planned again
+#   after : the methods of CentralDatabase, on a pool of DB_POOL_SIZE connections with the prepared statements
+NUM_QUERIES = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+THREADS = [int(x) for x in sys.argv[2:]] or [1, 4]
+NUM_USERS = 1000
+TIME = '2022-11-25 10:00:00'
+MESSAGE = '{"type": "msg", "msg": "' + 'x' * 200 + '"}'
+
+
+class Before(object):
+    # The queries of CentralDatabase before the connection pool, on a single connection
+    def __init__(self):
+        self.conn = psycopg2.connect(database.DB_DSN)
+        self.lock = threading.Lock()
+
+    def check_server(self, user_id):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('''SELECT SERVER_ID FROM users WHERE USER_ID = {0};'''.format(user_id))
+            a = cur.fetchall()
+            return -2 if a == [] else a[0][0]
+
+    def fetch_key(self, user_id):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('''SELECT PUBLIC_KEY FROM users WHERE USER_ID = {0};'''.format(user_id))
+            return cur.fetchall()[0][0]
+
+    def group_participants(self, group_id):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('''SELECT PARTICIPANTS FROM groups WHERE GROUP_ID = {0}'''.format(group_id))
+            return cur.fetchall()[0][0]
+
+    def insert_message(self, sender_id, receiver_id, datetime, message):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute('''SELECT USER_ID FROM users WHERE USER_ID = ''' + str(receiver_id) + ''';''')
+            if cur.fetchall() == []:
+                return False
+            cur.execute('''INSERT INTO messages (SENDER_ID,RECEIVER_ID,TIME,MESSAGE)
+            VALUES ({0},{1},'{2}','{3}');'''.format(sender_id, receiver_id, datetime, message))
+            self.conn.commit()
+            return True
+
+
+QUERIES = {
+    'check_server': lambda db, i: db.check_server(i % NUM_USERS + 1),
+    'fetch_key': lambda db, i: db.fetch_key(i % NUM_USERS + 1),
+    'group_participants': lambda db, i: db.group_participants(1),
+    'insert_message': lambda db, i: db.insert_message(1, i % NUM_USERS + 1, TIME, MESSAGE),
+}
+
+
+def run(db, query, threads):
+    def worker(first):
+        for i in range(first, NUM_QUERIES, threads):
+            QUERIES[query](db, i)
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return NUM_QUERIES / (time.perf_counter() - start)
+
+
+after = database.CentralDatabase(reset=True)
+for user in range(1, NUM_USERS + 1):
+    after.insert_newuser(user, str(user), -1, 'key of {0}'.format(user))
+after.create_group(1, list(range(1, 11)))
+before = Before()
+
+results = []
+for threads in THREADS:
+    for query in QUERIES:
+        row = [query, threads]
+        for db in (before, after):
+            row.append(run(db, query, threads))
+            # The messages are deleted so that both runs insert into the same table
+            with before.lock:
+                before.conn.cursor().execute('''DELETE FROM messages;''')
+                before.conn.commit()
+        results.append(row)
+        print(row)
+before.conn.close()
+after.close_connection()
+
+print()
+print('{0:>20} {1:>8} {2:>14} {3:>14} {4:>8}'.format('query', 'threads', 'before q/s', 'after q/s', 'speedup'))
+for query, threads, old, new in results:
+    print('{0:>20} {1:>8} {2:>14.0f} {3:>14.0f} {4:>7.2f}x'.format(query, threads, old, new, new / old))
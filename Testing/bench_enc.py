@@ -0,0 +1,108 @@
+import sys
+import time
+import os
+
+sys.path.insert(0, os.getcwd())
+from enc import Encrypt, SessionKeys, CryptoPool
+
+# Benchmark of the encryption of direct messages : a fresh RSA encrypted AES key per message (Encrypt.encrypt) against
+# session keys (SessionKeys, the AES key is only RSA encrypted once per session).
+# Run it from the Programs directory as
+# "python3 ../Testing/bench_enc.py <NUM_MESSAGES> <MESSAGE_SIZE> [<MESSAGE_SIZE> ...]"
+# e.g. "python3 ../Testing/bench_enc.py 1000 64 4096 65536"
+# Every message is encrypted by the sender and decrypted by the receiver, the time of both is counted.
+# Group messages are then compared for GROUP_SIZES participants : the AES key of every message encrypted for each
+# participant (Encrypt.encrypt_many) against the sending key of the sender (SessionKeys.encrypt_group), the time of
+# the sender only is counted (each participant decrypts once either way).
+# Last, a backlog of NUM_MSGS messages (e.g. received at login), each from a new session, is decrypted as a batch in
+# the receiver (SessionKeys.decrypt_messages) without and with a CryptoPool of CRYPTO_WORKERS processes (the number of
+# CPUs if the environment variable is not set).
+NUM_MSGS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+SIZES = [int(x) for x in sys.argv[2:]] or [64, 4096]
+GROUP_SIZES = [2, 10, 50]
+CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', os.cpu_count() or 1))
+
+sender = Encrypt()
+receiver = Encrypt()
+RECEIVER_KEY = receiver.get_public_key()
+
+
+def per_message(message):
+    start = time.perf_counter()
+    for i in range(NUM_MSGS):
+        key, enc_message, public = sender.encrypt(message, RECEIVER_KEY)
+        assert receiver.decrypt(enc_message, key) == message
+    return NUM_MSGS / (time.perf_counter() - start)
+
+
+def session(message):
+    sending = SessionKeys(sender)
+    receiving = SessionKeys(receiver)
+    start = time.perf_counter()
+    for i in range(NUM_MSGS):
+        key_id, enc_message, key = sending.encrypt_message(message, 2, RECEIVER_KEY)
+        assert receiving.decrypt_message(1, enc_message, key_id, key) == message
+    return NUM_MSGS / (time.perf_counter() - start)
+
+
+results = []
+for size in SIZES:
+    message = 'x' * size
+    results.append((size, per_message(message), session(message)))
+    print(results[-1])
+
+print()
+print('{0:>10} {1:>18} {2:>18} {3:>8}'.format('size', 'per message msgs/s', 'session msgs/s', 'gain'))
+for size, old, new in results:
+    print('{0:>10} {1:>18.1f} {2:>18.1f} {3:>7.1f}x'.format(size, old, new, new / old))
+
+
+def group_per_message(message, keys):
+    start = time.perf_counter()
+    for i in range(NUM_MSGS):
+        sender.encrypt_many(message, keys)
+    return NUM_MSGS / (time.perf_counter() - start)
+
+
+def group_sender_key(message, keys):
+    sending = SessionKeys(sender)
+    start = time.perf_counter()
+    for i in range(NUM_MSGS):
+        sending.encrypt_group(message, 1, keys, 0)
+    return NUM_MSGS / (time.perf_counter() - start)
+
+
+group_results = []
+message = 'x' * SIZES[0]
+for group_size in GROUP_SIZES:
+    # The same public key for every participant, the cost of an RSA encryption does not depend on the key
+    keys = {str(i): RECEIVER_KEY for i in range(group_size)}
+    group_results.append((group_size, group_per_message(message, keys), group_sender_key(message, keys)))
+    print(group_results[-1])
+
+print()
+print('{0:>12} {1:>18} {2:>18} {3:>8}'.format('participants', 'per message msgs/s', 'sender key msgs/s', 'gain'))
+for group_size, old, new in group_results:
+    print('{0:>12} {1:>18.1f} {2:>18.1f} {3:>7.1f}x'.format(group_size, old, new, new / old))
+
+
+def batch_decrypt(messages, pool):
+    receiving = SessionKeys(receiver, pool=pool)
+    start = time.perf_counter()
+    decrypted = receiving.decrypt_messages(messages)
+    elapsed = time.perf_counter() - start
+    assert decrypted == [message] * len(messages)
+    return len(messages) / elapsed
+
+
+# Every message starts a session (its key is RSA encrypted), as if they came from NUM_MSGS different senders
+messages = []
+for i in range(NUM_MSGS):
+    key_id, enc_message, key = SessionKeys(sender).encrypt_message(message, 2, RECEIVER_KEY)
+    messages.append((i, enc_message, key_id, key, False))
+pool = CryptoPool(receiver, workers=CRYPTO_WORKERS)
+serial, pooled = batch_decrypt(messages, None), batch_decrypt(messages, pool)
+pool.close()
+print()
+print('{0:>8} {1:>18} {2:>18} {3:>8}'.format('workers', 'serial msgs/s', 'pool msgs/s', 'gain'))
+print('{0:>8} {1:>18.1f} {2:>18.1f} {3:>7.1f}x'.format(CRYPTO_WORKERS, serial, pooled, pooled / serial))
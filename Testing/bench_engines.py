@@ -0,0 +1,145 @@
+import asyncio
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+import os
+
+sys.path.insert(0, os.getcwd())
+import framing
+from enc import Encrypt
+import tickets
+
+# Side by side benchmark of the two server engines (selectors and asyncio).
+# Run it from the Programs directory (it spawns server.py and needs the fastchat database) as
+# "python3 ../Testing/bench_engines.py <PORT> <NUM_MESSAGES_PER_CLIENT> <NUM_CLIENTS> [<NUM_CLIENTS> ...]"
+# e.g. "python3 ../Testing/bench_engines.py 8010 5 1000 5000 10000"
+# For every engine and every number of clients, a single server is started, all the clients sign up
+# concurrently and then every client sends direct messages to random other clients.
+# Every run uses the next port, so that a run does not wait for the port of the previous one to be freed.
+PORT = int(sys.argv[1])
+NUM_MSGS = int(sys.argv[2])
+CLIENT_COUNTS = [int(x) for x in sys.argv[3:]] or [1000]
+ENGINES = ['selectors', 'asyncio']
+IP = '127.0.0.1'
+
+# Each connection uses a file descriptor on both sides
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# The server verifies the ticket of the load balancer, so the benchmark signs its ticket with the same keys
+if not os.path.exists('server_keys_private.pem'):
+    Encrypt().save_keys('server_keys')
+ENCRYPT = Encrypt('server_keys')
+PUBLIC_KEY = ENCRYPT.get_public_key().decode()
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class BenchClient(object):
+
+    def __init__(self, user, num_clients, port, ticket):
+        self.user = user
+        self.port = port
+        self.ticket = ticket
+        self.num_clients = num_clients
+        self.decoder = framing.FrameDecoder()
+        self.latencies = []
+
+    async def recv(self):
+        while not self.decoder.backlog:
+            data = await self.reader.read(framing.READ_SIZE)
+            if not data:
+                raise ConnectionResetError
+            self.decoder.backlog = self.decoder.feed(data)
+        return json.loads(self.decoder.backlog.pop(0))
+
+    async def signup(self):
+        self.reader, self.writer = await asyncio.open_connection(IP, self.port)
+        start = time.perf_counter()
+        msg = {'type': 'new', 'user': self.user, 'password': str(self.user), 'sign': self.ticket['sign'],
+               'expires': self.ticket['expires'], 'public_key': PUBLIC_KEY}
+        self.writer.write(framing.encode(msg))
+        await self.recv()
+        return time.perf_counter() - start
+
+    async def receive(self, expected):
+        while len(self.latencies) < expected:
+            for msg in await self.recv():
+                if isinstance(msg, str):
+                    msg = json.loads(msg)
+                self.latencies.append(time.time() - float(msg['time']))
+
+    async def send(self):
+        for i in range(NUM_MSGS):
+            dest = random.randint(1, self.num_clients)
+            while dest == self.user:
+                dest = random.randint(1, self.num_clients)
+            msg = {'type': 'msg', 'time': str(time.time()), 'dest': dest, 'from': self.user,
+                   'message': 'x' * 64, 'isgroup': 0, 'response': 0, 'key': 'x' * 172}
+            self.writer.write(framing.encode(framing.envelope(msg)))
+            await self.writer.drain()
+            await asyncio.sleep(0)
+
+
+async def run_clients(num_clients, port):
+    ticket = tickets.issue(ENCRYPT, IP, port)
+    clients = [BenchClient(i + 1, num_clients, port, ticket) for i in range(num_clients)]
+    signups = await asyncio.gather(*[c.signup() for c in clients])
+    # Every message is received by exactly one client, count them to know when to stop
+    random.seed(num_clients)
+    expected = dict()
+    state = random.getstate()
+    for c in clients:
+        for i in range(NUM_MSGS):
+            dest = random.randint(1, num_clients)
+            while dest == c.user:
+                dest = random.randint(1, num_clients)
+            expected[dest] = expected.get(dest, 0) + 1
+    random.setstate(state)
+    start = time.perf_counter()
+    receivers = [asyncio.ensure_future(c.receive(expected.get(c.user, 0))) for c in clients]
+    for c in clients:
+        await c.send()
+    try:
+        await asyncio.wait_for(asyncio.gather(*receivers), timeout=300)
+    except asyncio.TimeoutError:
+        print('Timed out, some messages were not delivered')
+    elapsed = time.perf_counter() - start
+    latencies = [l for c in clients for l in c.latencies]
+    for c in clients:
+        c.writer.close()
+    return signups, latencies, elapsed
+
+
+results = []
+port = PORT
+for num_clients in CLIENT_COUNTS:
+    for engine in ENGINES:
+        server = subprocess.Popen(['python3', 'server.py', str(port), '1', '1', engine],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  env=dict(os.environ, DB_RESET='1'))
+        time.sleep(2)
+        try:
+            signups, latencies, elapsed = asyncio.run(run_clients(num_clients, port))
+        finally:
+            server.terminate()
+            server.wait()
+            port += 1
+        results.append((engine, num_clients, percentile(signups, 50) * 1000, percentile(signups, 99) * 1000,
+                        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                        len(latencies) / elapsed))
+        print(results[-1])
+
+print()
+print('{0:>10} {1:>8} {2:>14} {3:>14} {4:>12} {5:>12} {6:>10}'.format(
+    'engine', 'clients', 'signup p50 ms', 'signup p99 ms', 'msg p50 ms', 'msg p99 ms', 'msgs/s'))
+for row in results:
+    print('{0:>10} {1:>8} {2:>14.2f} {3:>14.2f} {4:>12.2f} {5:>12.2f} {6:>10.1f}'.format(*row))
@@ -0,0 +1,124 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+import framing
+from enc import Encrypt
+import keypool
+import tickets
+
+# Benchmark of the signup latency when many users register at once, depending on where their key pairs come from.
+# Run it from the Programs directory (it spawns server.py and needs the fastchat database) as
+# "python3 ../Testing/bench_signup.py <PORT> <NUM_CLIENTS> [<THINK_TIME>]"
+# e.g. "python3 ../Testing/bench_signup.py 8010 1000 5"
+# All the clients register at the same time, the latency of a client is the time from that moment to the reply of the
+# server, key generation included :
+#   inline : the key pair is generated when registering (what Client.register did), on all the CPUs
+#   pool : the key pairs are generated by a keypool.KeyPool started THINK_TIME seconds earlier (while the users type)
+#   stash : the key pairs are taken from a stash filled beforehand (the time to fill it is printed, not counted)
+PORT = int(sys.argv[1])
+NUM_CLIENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+THINK_TIME = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+MODES = ['inline', 'pool', 'stash']
+IP = '127.0.0.1'
+WORKERS = os.cpu_count() or 1
+
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# The server verifies the ticket of the load balancer, so the benchmark signs its ticket with the same keys
+if not os.path.exists('server_keys_private.pem'):
+    Encrypt().save_keys('server_keys')
+ENCRYPT = Encrypt('server_keys')
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def new_public_key():
+    return Encrypt().get_public_key()
+
+
+async def signup(user, port, ticket, get_key, start):
+    loop = asyncio.get_running_loop()
+    public_key = await loop.run_in_executor(None, get_key)
+    keyed = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(IP, port)
+    msg = {'type': 'new', 'user': user, 'password': str(user), 'sign': ticket['sign'], 'expires': ticket['expires'],
+           'public_key': public_key.decode()}
+    writer.write(framing.encode(msg))
+    decoder = framing.FrameDecoder()
+    while not decoder.backlog:
+        data = await reader.read(framing.READ_SIZE)
+        if not data:
+            raise ConnectionResetError
+        decoder.backlog = decoder.feed(data)
+    json.loads(decoder.backlog.pop(0))
+    writer.close()
+    return keyed, time.perf_counter() - start
+
+
+async def run_clients(mode, port):
+    ticket = tickets.issue(ENCRYPT, IP, port)
+    loop = asyncio.get_running_loop()
+    # Enough threads for every client to wait for its key pair at the same time
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(NUM_CLIENTS))
+    pool = None
+    if mode == 'inline':
+        processes = concurrent.futures.ProcessPoolExecutor(WORKERS)
+        get_key = lambda: processes.submit(new_public_key).result()
+    elif mode == 'pool':
+        pool = keypool.KeyPool(size=NUM_CLIENTS, workers=WORKERS, stash=None)
+        await asyncio.sleep(THINK_TIME)
+        get_key = lambda: pool.take().get_public_key()
+    else:
+        stash = tempfile.mkdtemp()
+        filled = time.perf_counter()
+        keypool.fill_stash(stash, NUM_CLIENTS, workers=WORKERS)
+        print('Filled the stash in {0:.1f} s'.format(time.perf_counter() - filled))
+        pool = keypool.KeyPool(size=0, stash=stash)
+        get_key = lambda: pool.take().get_public_key()
+    start = time.perf_counter()
+    try:
+        times = await asyncio.gather(*[signup(i + 1, port, ticket, get_key, start) for i in range(NUM_CLIENTS)])
+    finally:
+        if mode == 'inline':
+            processes.shutdown()
+        else:
+            pool.close()
+    return [t[0] for t in times], [t[1] for t in times], time.perf_counter() - start
+
+
+results = []
+port = PORT
+for mode in MODES:
+    server = subprocess.Popen(['python3', 'server.py', str(port), '1', '1'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              env=dict(os.environ, DB_RESET='1'))
+    time.sleep(2)
+    try:
+        keyed, signups, elapsed = asyncio.run(run_clients(mode, port))
+    finally:
+        server.terminate()
+        server.wait()
+        port += 1
+    results.append((mode, NUM_CLIENTS, percentile(keyed, 50) * 1000, percentile(keyed, 99) * 1000,
+                    percentile(signups, 50) * 1000, percentile(signups, 99) * 1000, elapsed))
+    print(results[-1])
+
+print()
+print('{0:>8} {1:>8} {2:>12} {3:>12} {4:>14} {5:>14} {6:>10}'.format(
+    'keys', 'clients', 'key p50 ms', 'key p99 ms', 'signup p50 ms', 'signup p99 ms', 'total s'))
+for row in results:
+    print('{0:>8} {1:>8} {2:>12.2f} {3:>12.2f} {4:>14.2f} {5:>14.2f} {6:>10.2f}'.format(*row))
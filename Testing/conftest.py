@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The unit tests import the modules of the Programs directory, wherever pytest is run from
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Programs'))
@@ -0,0 +1,66 @@
+import unittest
+
+import batching
+import framing
+
+# Unit tests of the batches of the messages forwarded to the other servers (batching.Batcher).
+
+
+class BatcherTest(unittest.TestCase):
+
+    def test_sent_at_max_bytes(self):
+        batcher = batching.Batcher(max_bytes=100, max_messages=1000, linger_us=10 ** 6)
+        self.assertIsNone(batcher.add('link', b'x' * 48))
+        frames = batcher.add('link', b'y' * 48)
+        self.assertEqual(frames, [b'x' * 48, b'y' * 48])
+        self.assertEqual(batcher.reasons['bytes'], 1)
+        self.assertEqual(batcher.bytes, 96 + 2 * framing.HEADER.size)
+        self.assertEqual(batcher.batches, {})
+
+    def test_sent_at_max_messages(self):
+        batcher = batching.Batcher(max_bytes=10 ** 6, max_messages=3, linger_us=10 ** 6)
+        self.assertIsNone(batcher.add('link', {'type': 'msg'}))
+        self.assertIsNone(batcher.add('link', 'text'))
+        frames = batcher.add('link', b'bytes')
+        self.assertEqual(frames, [b'{"type": "msg"}', b'text', b'bytes'])
+        self.assertEqual(batcher.stats()['reasons'], {'messages': 1})
+        self.assertEqual(batcher.stats()['histogram'], {4: 1})
+
+    def test_due_after_linger(self):
+        batcher = batching.Batcher(linger_us=1000)
+        batcher.add('link', b'message')
+        start = batcher.batches['link'].deadline - 0.001
+        self.assertEqual(batcher.due(start), [])
+        self.assertAlmostEqual(batcher.timeout(start), 0.001)
+        self.assertEqual(batcher.due(start + 0.001), [('link', [b'message'])])
+        self.assertEqual(batcher.reasons['linger'], 1)
+        self.assertIsNone(batcher.timeout())
+
+    def test_due_oldest_first(self):
+        batcher = batching.Batcher(linger_us=1000)
+        for link in ('a', 'b', 'c'):
+            batcher.add(link, link.encode())
+        # A message added to an older batch does not move it behind the newer ones
+        batcher.add('a', b'again')
+        now = batcher.batches['c'].deadline
+        self.assertEqual(batcher.due(now), [('a', [b'a', b'again']), ('b', [b'b']), ('c', [b'c'])])
+
+    def test_due_stops_at_first_waiting_batch(self):
+        batcher = batching.Batcher(linger_us=1000)
+        batcher.add('a', b'a')
+        deadline = batcher.batches['a'].deadline
+        batcher.batches['b'] = batching.Batch(deadline + 1)
+        batcher.batches['b'].parts.append(b'b')
+        self.assertEqual(batcher.due(deadline), [('a', [b'a'])])
+        self.assertEqual(list(batcher.batches), ['b'])
+
+    def test_discard_returns_unsent(self):
+        batcher = batching.Batcher(linger_us=1000)
+        batcher.add('link', b'lost')
+        self.assertEqual(batcher.discard('link'), [b'lost'])
+        self.assertEqual(batcher.discard('link'), [])
+        self.assertEqual(batcher.stats()['batches'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import cache
+
+# Unit tests of the routing, group and key caches of the servers (cache.LRUCache).
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_dropped_first(self):
+        lru = cache.LRUCache(size=2)
+        lru.put(1, 'a')
+        lru.put(2, 'b')
+        # Reading 1 makes 2 the least recently used entry
+        self.assertEqual(lru.get(1), 'a')
+        lru.put(3, 'c')
+        self.assertNotIn(2, lru)
+        self.assertIn(1, lru)
+        self.assertIn(3, lru)
+        self.assertEqual(len(lru), 2)
+
+    def test_put_refreshes_an_entry(self):
+        lru = cache.LRUCache(size=2)
+        lru.put(1, 'a')
+        lru.put(2, 'b')
+        lru.put(1, 'A')
+        lru.put(3, 'c')
+        self.assertEqual(lru.get(1), 'A')
+        self.assertNotIn(2, lru)
+
+    def test_hits_and_misses(self):
+        lru = cache.LRUCache(size=4)
+        lru.put(1, 'a')
+        self.assertEqual(lru.get(1), 'a')
+        self.assertIsNone(lru.get(2))
+        self.assertEqual(lru.get(3, -1), -1)
+        # A membership test is not a lookup
+        self.assertIn(1, lru)
+        self.assertEqual(lru.stats(), {'entries': 1, 'hits': 1, 'misses': 2})
+
+    def test_invalidate(self):
+        lru = cache.LRUCache(size=4)
+        lru.put(1, 'a')
+        lru.invalidate(1)
+        lru.invalidate(2)
+        self.assertIsNone(lru.get(1))
+        self.assertEqual(lru.stats(), {'entries': 0, 'hits': 0, 'misses': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import tempfile
+import unittest
+
+import enc
+
+# Unit tests of the session keys of the direct and group messages (enc.SessionKeys) and of the authenticated
+# encryption of the attachments (enc.GCMCipher).
+
+
+class SessionKeysTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.alice = enc.Encrypt()
+        cls.bob = enc.Encrypt()
+
+    def setUp(self):
+        self.sender = enc.SessionKeys(self.alice)
+        self.receiver = enc.SessionKeys(self.bob)
+
+    def send(self, message):
+        return self.sender.encrypt_message(message, 2, self.bob.get_public_key())
+
+    def test_key_sent_with_the_first_message_only(self):
+        key_id, first, key = self.send('hello')
+        self.assertIsNotNone(key)
+        self.assertEqual(self.receiver.decrypt_message(1, first, key_id, key), 'hello')
+        next_id, second, next_key = self.send('again')
+        self.assertEqual(next_id, key_id)
+        self.assertIsNone(next_key)
+        self.assertEqual(self.receiver.decrypt_message(1, second, key_id), 'again')
+
+    def test_unknown_key_id(self):
+        key_id, message, key = self.send('hello')
+        self.assertIsNone(self.receiver.decrypt_message(1, message, key_id))
+        self.receiver.decrypt_message(1, message, key_id, key)
+        self.assertIsNone(self.receiver.decrypt_message(1, message, 'unknown'))
+
+    def test_keys_kept_by_sender(self):
+        key_id, message, key = self.send('hello')
+        self.receiver.decrypt_message(1, message, key_id, key)
+        # Another peer can not use (nor replace) the key of the sender
+        self.assertIsNone(self.receiver.decrypt_message(3, message, key_id))
+
+    def test_rotation_after_max_messages(self):
+        self.sender = enc.SessionKeys(self.alice, max_messages=2)
+        key_ids = [self.send('hello')[0] for i in range(3)]
+        self.assertEqual(key_ids[0], key_ids[1])
+        self.assertNotEqual(key_ids[1], key_ids[2])
+        key_id, message, key = self.send('hello')
+        self.assertEqual(key_id, key_ids[2])
+        self.assertIsNone(key)
+
+    def test_rotation_after_max_age(self):
+        self.sender = enc.SessionKeys(self.alice, max_age=0)
+        first = self.send('hello')
+        second = self.send('hello')
+        self.assertNotEqual(first[0], second[0])
+        self.assertIsNotNone(second[2])
+
+    def test_key_resent(self):
+        self.sender = enc.SessionKeys(self.alice, resend=3)
+        sent = [self.send('message {0}'.format(i)) for i in range(5)]
+        self.assertEqual([key is not None for key_id, message, key in sent], [True, False, False, True, False])
+        # A peer which has missed the first message decrypts the messages from the next one with the key
+        key_id, message, key = sent[1]
+        self.assertIsNone(self.receiver.decrypt_message(1, message, key_id, key))
+        key_id, message, key = sent[3]
+        self.assertEqual(self.receiver.decrypt_message(1, message, key_id, key), 'message 3')
+        key_id, message, key = sent[4]
+        self.assertEqual(self.receiver.decrypt_message(1, message, key_id, key), 'message 4')
+
+    def test_saved_keys(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, 'bob')
+            receiver = enc.SessionKeys(self.bob, file)
+            key_id, message, key = self.send('hello')
+            receiver.decrypt_message(1, message, key_id, key)
+            self.assertEqual(enc.SessionKeys(self.bob, file).decrypt_message(1, message, key_id), 'hello')
+            # The file can only be read with the private key of its owner
+            self.assertEqual(len(enc.SessionKeys(self.alice, file).receiving), 0)
+
+    def test_group_key_shared_with_participants(self):
+        keys = {'2': self.bob.get_public_key(), '3': self.alice.get_public_key()}
+        key_id, message, encrypted_keys = self.sender.encrypt_group('hello', 7, keys, 1)
+        self.assertEqual(sorted(encrypted_keys), ['2', '3'])
+        self.assertEqual(self.receiver.decrypt_message(1, message, key_id, encrypted_keys['2']), 'hello')
+        next_id, message, next_keys = self.sender.encrypt_group('again', 7, keys, 1)
+        self.assertEqual(next_id, key_id)
+        self.assertIsNone(next_keys)
+        self.assertEqual(self.receiver.decrypt_message(1, message, key_id), 'again')
+
+    def test_group_key_rotated_on_membership_change(self):
+        keys = {'2': self.bob.get_public_key()}
+        key_id = self.sender.encrypt_group('hello', 7, keys, 1)[0]
+        # The participants have changed : the removed ones do not get the new key
+        next_id, message, next_keys = self.sender.encrypt_group('hello', 7, {'3': self.alice.get_public_key()}, 2)
+        self.assertNotEqual(next_id, key_id)
+        self.assertEqual(list(next_keys), ['3'])
+        self.assertIsNone(self.receiver.decrypt_message(1, message, next_id))
+
+    def test_group_keys_separate_from_direct_keys(self):
+        direct_id = self.send('hello')[0]
+        group_id = self.sender.encrypt_group('hello', 2, {'2': self.bob.get_public_key()}, 1)[0]
+        self.assertNotEqual(direct_id, group_id)
+
+    def test_binary_message(self):
+        key_id, message, key = self.sender.encrypt_message(b'\x00\xff' * 100, 2, self.bob.get_public_key(), binary=True)
+        self.assertIsInstance(message, bytes)
+        self.assertEqual(self.receiver.decrypt_message(1, message, key_id, key, binary=True), b'\x00\xff' * 100)
+        tampered = bytearray(message)
+        tampered[-1] ^= 1
+        self.assertIsNone(self.receiver.decrypt_message(1, bytes(tampered), key_id, binary=True))
+
+
+class GCMCipherTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        cipher = enc.GCMCipher(b'key')
+        for data in (b'', b'\x00' * 1000, bytes(range(256))):
+            encrypted = cipher.encrypt(data)
+            self.assertEqual(len(encrypted), len(data) + enc.GCMCipher.NONCE + enc.GCMCipher.TAG)
+            self.assertEqual(cipher.decrypt(encrypted), data)
+            self.assertEqual(cipher.decrypt(memoryview(encrypted)), data)
+
+    def test_random_nonce(self):
+        cipher = enc.GCMCipher('key')
+        self.assertNotEqual(cipher.encrypt(b'data'), cipher.encrypt(b'data'))
+
+    def test_tampered_data_rejected(self):
+        cipher = enc.GCMCipher(b'key')
+        encrypted = cipher.encrypt(b'some image bytes')
+        for i in (0, enc.GCMCipher.NONCE, len(encrypted) - 1):
+            tampered = bytearray(encrypted)
+            tampered[i] ^= 1
+            with self.assertRaises(ValueError):
+                cipher.decrypt(bytes(tampered))
+
+    def test_wrong_key_rejected(self):
+        encrypted = enc.GCMCipher(b'key').encrypt(b'data')
+        with self.assertRaises(ValueError):
+            enc.GCMCipher(b'other key').decrypt(encrypted)
+
+
+if __name__ == '__main__':
+    unittest.main()
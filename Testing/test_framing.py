@@ -0,0 +1,118 @@
+import unittest
+
+import framing
+
+# Unit tests of the framing layer of the wire protocol (framing.FrameDecoder and framing.WriteQueue).
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_whole_frames(self):
+        decoder = framing.FrameDecoder()
+        self.assertEqual(decoder.feed(framing.encode({'a': 1}) + framing.encode('text')), [b'{"a": 1}', b'text'])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_partial_frame_buffered(self):
+        decoder = framing.FrameDecoder()
+        frame = framing.encode(b'payload')
+        self.assertEqual(decoder.feed(frame[:2]), [])
+        self.assertEqual(decoder.feed(frame[2:6]), [])
+        self.assertEqual(decoder.pending(), 6)
+        self.assertEqual(decoder.feed(frame[6:]), [b'payload'])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_frames_split_across_reads(self):
+        decoder = framing.FrameDecoder()
+        data = framing.encode(b'first') + framing.encode(b'second') + framing.encode(b'')
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual(frames, [b'first', b'second', b''])
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_next_frame_kept_after_a_complete_one(self):
+        decoder = framing.FrameDecoder()
+        second = framing.encode(b'second')
+        self.assertEqual(decoder.feed(framing.encode(b'first') + second[:5]), [b'first'])
+        self.assertEqual(decoder.feed(second[5:]), [b'second'])
+
+    def test_oversized_frame_rejected(self):
+        decoder = framing.FrameDecoder(max_frame=10)
+        self.assertEqual(decoder.feed(framing.encode(b'x' * 10)), [b'x' * 10])
+        with self.assertRaises(framing.FrameError):
+            decoder.feed(framing.HEADER.pack(11))
+
+
+class Socket(object):
+    '''Stands for a non-blocking socket whose kernel buffer accepts ``accepted`` bytes per ``sendmsg`` (None when it
+    would block).
+    '''
+
+    def __init__(self, *accepted):
+        self.accepted = list(accepted)
+        self.data = b''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        size = self.accepted.pop(0) if self.accepted else None
+        if size is None:
+            raise BlockingIOError()
+        sent = b''.join(bytes(buffer) for buffer in buffers)[:size]
+        self.data += sent
+        return len(sent)
+
+
+class WriteQueueTest(unittest.TestCase):
+
+    def test_frames_written_with_one_call(self):
+        queue = framing.WriteQueue()
+        queue.push({'a': 1})
+        queue.push(b'second')
+        sock = Socket(1000)
+        self.assertTrue(queue.flush(sock))
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(sock.data, framing.encode({'a': 1}) + framing.encode(b'second'))
+        self.assertEqual(queue.pending(), 0)
+
+    def test_partial_send_resumed(self):
+        queue = framing.WriteQueue()
+        queue.push(b'first')
+        queue.push(b'second')
+        sock = Socket(3, 6, None)
+        self.assertFalse(queue.flush(sock))
+        self.assertEqual(queue.pending(), 19 - 3)
+        self.assertFalse(queue.flush(sock))
+        self.assertEqual(queue.pending(), 19 - 9)
+        self.assertFalse(queue.flush(sock))
+        self.assertEqual(queue.pending(), 19 - 9)
+        sock.accepted = [1000]
+        self.assertTrue(queue.flush(sock))
+        self.assertEqual(queue.pending(), 0)
+        self.assertEqual(framing.FrameDecoder().feed(sock.data), [b'first', b'second'])
+
+    def test_unsent_messages(self):
+        queue = framing.WriteQueue()
+        for message in (b'first', b'second', {'a': 1}):
+            queue.push(message)
+        self.assertFalse(queue.flush(Socket(3, None)))
+        self.assertEqual(queue.unsent(), [b'first', b'second', {'a': 1}])
+        self.assertFalse(queue.flush(Socket(6, None)))
+        self.assertEqual(queue.unsent(), [b'second', {'a': 1}])
+        self.assertTrue(queue.flush(Socket(1000)))
+        self.assertEqual(queue.unsent(), [])
+
+    def test_frame_made_of_several_buffers(self):
+        envelope = framing.decode(framing.envelope({'type': 'msg', 'dest': 2, 'from': 1, 'message': 'hi'}))
+        queue = framing.WriteQueue()
+        queue.push([envelope, {'type': 'inbox'}])
+        sock = Socket(*range(1, 100))
+        while not queue.flush(sock):
+            pass
+        frames = framing.FrameDecoder().feed(sock.data)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(framing.decode(frames[0])[1], {'type': 'inbox'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import loadreport
+
+# Unit tests of the view of the loads of the servers kept by the load balancer (loadreport.LoadView).
+
+
+def sample(server, worker=0, connections=0, queue=0, lag_ms=0):
+    return {'server': server, 'worker': worker, 'ip': '127.0.0.1', 'port': 8000 + server,
+            'connections': connections, 'queue': queue, 'lag_ms': lag_ms}
+
+
+class LoadViewTest(unittest.TestCase):
+
+    def test_least_loaded_first(self):
+        view = loadreport.LoadView()
+        self.assertIsNone(view.pick())
+        view.update(sample(1, connections=5))
+        view.update(sample(2, connections=3))
+        self.assertEqual(view.pick(), ('127.0.0.1', 8002))
+        view.update(sample(3, connections=1, lag_ms=500))
+        # Overloaded servers come last, whatever their connections
+        self.assertEqual(view.pick(), ('127.0.0.1', 8002))
+
+    def test_outdated_entries_skipped(self):
+        view = loadreport.LoadView()
+        view.update(sample(1, connections=0))
+        view.update(sample(2, connections=5))
+        # The entry of server 1 with no connection is still in the heap, below the current one
+        view.update(sample(1, connections=10))
+        self.assertEqual(len(view.heap), 3)
+        self.assertEqual(view.pick(), ('127.0.0.1', 8002))
+        # The outdated entry has been dropped on the way
+        self.assertEqual(sorted(server for _, _, server in view.heap), [1, 2])
+
+    def test_heap_compacted(self):
+        view = loadreport.LoadView()
+        view.update(sample(2, connections=1000))
+        for i in range(100):
+            view.update(sample(1, connections=1000 + i))
+        self.assertLessEqual(len(view.heap), 2 * len(view.versions) + 16)
+        self.assertEqual(view.pick(), ('127.0.0.1', 8002))
+
+    def test_assigned_until_every_worker_reports(self):
+        view = loadreport.LoadView()
+        view.update(sample(1, worker=0))
+        view.update(sample(1, worker=1))
+        view.pick()
+        view.pick()
+        self.assertEqual(len(view.assigned[1]), 2)
+        view.update(sample(1, worker=0, connections=1))
+        self.assertEqual(len(view.assigned[1]), 2)
+        view.update(sample(1, worker=1, connections=1))
+        self.assertEqual(len(view.assigned[1]), 0)
+
+    def test_remove(self):
+        view = loadreport.LoadView()
+        view.update(sample(1, worker=0))
+        view.update(sample(1, worker=1))
+        view.update(sample(2, connections=1))
+        view.pick()
+        # Worker 1 is gone, worker 0 has reported since the client was placed
+        view.remove(1, 1)
+        self.assertEqual(len(view.assigned[1]), 1)
+        view.update(sample(1, worker=0, connections=1))
+        self.assertEqual(len(view.assigned[1]), 0)
+        view.remove(1, 0)
+        self.assertNotIn(1, view.addresses)
+        self.assertNotIn(1, view.versions)
+        self.assertEqual(view.pick(), ('127.0.0.1', 8002))
+        view.remove(2, 0)
+        self.assertIsNone(view.pick())
+        self.assertEqual(view.stats(), {'servers': 0, 'picks': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
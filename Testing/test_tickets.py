@@ -0,0 +1,69 @@
+import time
+import unittest
+
+import tickets
+
+# Unit tests of the tickets signed by the load balancer (tickets.TicketCache).
+
+
+class Signer(object):
+    '''Stands for the keys of the load balancer, the signature is the message signed.
+    '''
+
+    def RSA_sign(self, message):
+        return message.encode()
+
+
+class TicketCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = tickets.TicketCache(Signer(), ttl=100)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def wait_renewal(self):
+        # The renewals run one at a time on the background thread, in order
+        self.cache.signer.submit(int).result()
+
+    def test_signed_once(self):
+        self.cache.warm([('127.0.0.1', 8001), ('127.0.0.1', 8002)])
+        ticket = self.cache.get('127.0.0.1', 8001)
+        self.assertIs(self.cache.get('127.0.0.1', 8001), ticket)
+        self.assertEqual(ticket['sign'], tickets.ticket_message('127.0.0.1', 8001, ticket['expires']))
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'signed': 2})
+
+    def test_expired_ticket_signed_again(self):
+        ticket = self.cache.get('127.0.0.1', 8001)
+        ticket['expires'] = int(time.time()) - 1
+        fresh = self.cache.get('127.0.0.1', 8001)
+        self.assertIsNot(fresh, ticket)
+        self.assertGreater(fresh['expires'], time.time())
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'signed': 2})
+
+    def test_renewed_in_background(self):
+        ticket = self.cache.get('127.0.0.1', 8001)
+        # Less than a quarter of its lifetime left
+        ticket['expires'] = int(time.time()) + 20
+        # The current ticket is still handed out while the new one is signed
+        self.assertIs(self.cache.get('127.0.0.1', 8001), ticket)
+        self.wait_renewal()
+        fresh = self.cache.get('127.0.0.1', 8001)
+        self.assertIsNot(fresh, ticket)
+        self.assertGreaterEqual(fresh['expires'], int(time.time()) + 99)
+        self.assertEqual(self.cache.renewing, set())
+        self.assertEqual(self.cache.stats()['signed'], 2)
+
+    def test_renewed_once(self):
+        ticket = self.cache.get('127.0.0.1', 8001)
+        ticket['expires'] = int(time.time()) + 20
+        # As if the background thread was signing it already : no other renewal is started
+        self.cache.renewing.add(('127.0.0.1', 8001))
+        for i in range(5):
+            self.assertIs(self.cache.get('127.0.0.1', 8001), ticket)
+        self.wait_renewal()
+        self.assertEqual(self.cache.stats(), {'hits': 5, 'signed': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import writebehind
+
+# Unit tests of the write-behind buffer of the messages for offline users (writebehind.WriteBehind).
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def test_written_at_max_rows(self):
+        buffer = writebehind.WriteBehind(max_rows=3, linger_us=10 ** 6)
+        self.assertIsNone(buffer.add('messages', (1, 2, 't', 'a')))
+        self.assertIsNone(buffer.add('groupmessages', (1, 3, 't', 7, 'b')))
+        tables = buffer.add('messages', (1, 4, 't', 'c'))
+        self.assertEqual(tables, {'messages': [(1, 2, 't', 'a'), (1, 4, 't', 'c')],
+                                  'groupmessages': [(1, 3, 't', 7, 'b')]})
+        self.assertEqual(list(tables), ['messages', 'groupmessages'])
+        self.assertEqual(buffer.count, 0)
+        self.assertIsNone(buffer.timeout())
+
+    def test_take(self):
+        buffer = writebehind.WriteBehind()
+        self.assertEqual(buffer.take(), {})
+        self.assertEqual(buffer.stats(), {'batches': 0, 'rows': 0, 'largest': 0})
+        buffer.add('messages', (1, 2, 't', 'a'))
+        buffer.add('messages', (1, 2, 't', 'b'))
+        self.assertEqual(buffer.take(), {'messages': [(1, 2, 't', 'a'), (1, 2, 't', 'b')]})
+        buffer.add('messages', (1, 2, 't', 'c'))
+        buffer.take()
+        self.assertEqual(buffer.stats(), {'batches': 2, 'rows': 3, 'largest': 2})
+
+    def test_due_after_linger(self):
+        buffer = writebehind.WriteBehind(linger_us=1000)
+        self.assertEqual(buffer.due(), {})
+        buffer.add('messages', (1, 2, 't', 'a'))
+        # The deadline is set by the oldest row
+        deadline = buffer.deadline
+        buffer.add('messages', (1, 2, 't', 'b'))
+        self.assertEqual(buffer.deadline, deadline)
+        self.assertEqual(buffer.due(deadline - 0.0005), {})
+        self.assertAlmostEqual(buffer.timeout(deadline - 0.0005), 0.0005)
+        self.assertEqual(buffer.due(deadline), {'messages': [(1, 2, 't', 'a'), (1, 2, 't', 'b')]})
+        self.assertEqual(buffer.due(deadline + 1), {})
+
+
+if __name__ == '__main__':
+    unittest.main()